@@ -7,14 +7,88 @@ from .libro_execution import (
     execute_notebook,
     execute_notebook_sync,
     inspect_execution_result,
+    create_notebook_client,
+)
+from .libro_client import (
+    LibroNotebookClient,
+    LibroExecution,
+    ExecutionStopped,
+    LibroCellProfile,
+    LibroResultDescriptor,
+)
+from .result_format import (
+    ResultFormat,
+    ArrowResultFormat,
+    NpyResultFormat,
+    PickleResultFormat,
+    BufferedPickleResultFormat,
+    register_result_format,
+    sweep_shared_memory,
+)
+from .execution_scheduler import LibroExecutionScheduler, ExecutionQueueFull
+from .admission_control import LibroAdmissionController, ExecutionRejected
+from .kernel_pool import LibroKernelPool
+from .execution_record import (
+    ExecutionRecordJournal,
+    read_execution_journal,
+    read_execution_record,
+    compress_execution_records,
+)
+from .execution_checkpoint import ExecutionCheckpointer
+from .execution_registry import LibroExecutionRegistry
+from .execution_events import ExecutionEventLog, LibroExecutionEvent
+from .execution_cache import LibroExecutionCache
+from .inprocess_execution import (
+    LibroInProcessExecutor,
+    LibroInProcessNotebookClient,
+    get_inprocess_executor,
+)
+from .notebook_cache import NotebookNodeCache, NotebookCacheStats, notebook_cache
+from .output_store import OutputBlobStore, externalize_outputs
+from .incremental_execution import NamespaceSnapshotStore, cell_fingerprints
+from .parallel_execution import CellDependencyGraph, ParallelCellExecutor, analyze_cell
+from .batch_execution import (
+    execute_notebook_batch,
+    LibroBatchExecution,
+    LibroForkedBatchExecution,
+    LibroBatchResult,
+    LibroBatchStats,
+)
+from .execution_handler import (
+    LibroExecutionHandler,
+    LibroExecutionEventsHandler,
+    LibroBatchExecutionHandler,
+    LibroExecutionBlobHandler,
+    LibroExecutionJobsHandler,
+)
+from .distributed_execution import (
+    LibroFlowWorker,
+    LibroJob,
+    LibroJobQueue,
+    LibroJobReport,
+    LibroRemoteNotebookClient,
 )
-from .libro_client import LibroNotebookClient
-from .execution_handler import LibroExecutionHandler
 
 
 def _load_jupyter_server_extension(serverapp: jupyter_server.serverapp.ServerApp):
     """
     This function is called when the extension is loaded.
     """
-    handlers = [(rf"/{serverapp.name}/api/execution", LibroExecutionHandler)]
+    # segments of a server or kernels that did not shut down cleanly
+    sweep_shared_memory()
+    # configured with the tornado settings of the server, e.g.
+    # c.ServerApp.tornado_settings = {"libro_execution_max_workers": 8}
+    settings = serverapp.web_app.settings
+    if "libro_execution_scheduler" not in settings:
+        settings["libro_execution_scheduler"] = LibroExecutionScheduler(
+            max_workers=settings.get("libro_execution_max_workers", 4),
+            max_queue_size=settings.get("libro_execution_max_queue_size", 100),
+        )
+    handlers = [
+        (rf"/{serverapp.name}/api/execution", LibroExecutionHandler),
+        (rf"/{serverapp.name}/api/execution/events", LibroExecutionEventsHandler),
+        (rf"/{serverapp.name}/api/execution/batch", LibroBatchExecutionHandler),
+        (rf"/{serverapp.name}/api/execution/blob", LibroExecutionBlobHandler),
+        (rf"/{serverapp.name}/api/execution/jobs/(\w+)", LibroExecutionJobsHandler),
+    ]
     serverapp.web_app.add_handlers(".*$", handlers)
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from .libro_client import LibroExecution, LibroNotebookClient
+from .incremental_execution import cell_fingerprints
+from .execution_registry import LibroExecutionRegistry
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionRejected(Exception):
+    pass
+
+
+def host_memory() -> tuple[int, int] | None:
+    """``(total, available)`` memory of the host in bytes, None if unknown."""
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            meminfo = dict(line.split(":", 1) for line in f if ":" in line)
+        return (
+            int(meminfo["MemTotal"].split()[0]) * 1024,
+            int(meminfo["MemAvailable"].split()[0]) * 1024,
+        )
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def host_load() -> float | None:
+    """One minute load average per cpu, None if unknown."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        return None
+
+
+def execution_peak_rss(execution: LibroExecution) -> int:
+    return max((profile.peak_rss for profile in execution.cell_profiles), default=0)
+
+
+class LibroAdmissionController:
+    """Hold back executions the host has no room for.
+
+    Before an execution starts, its footprint is projected from the peak rss
+    of the last ``history`` runs of the same notebook (``default_rss`` for an
+    unknown notebook) times ``safety_factor``. It is admitted once the
+    available memory minus what the running executions may still grow to
+    leaves ``min_free_memory`` bytes after it, and the load per cpu is below
+    ``max_load``. Executions wait up to ``max_wait`` seconds for that and are
+    rejected after; executions that cannot fit into the host at all are
+    rejected right away.
+    """
+
+    def __init__(
+        self,
+        min_free_memory: int = 1024**3,
+        max_load: float | None = 1.5,
+        default_rss: int = 512 * 1024**2,
+        safety_factor: float = 1.2,
+        history: int = 5,
+        max_wait: float = 300.0,
+        interval: float = 1.0,
+    ):
+        self.min_free_memory = min_free_memory
+        self.max_load = max_load
+        self.default_rss = default_rss
+        self.safety_factor = safety_factor
+        self.history = history
+        self.max_wait = max_wait
+        self.interval = interval
+        self._peaks: dict[str, deque[int]] = {}
+        self.history_loaded = False
+        # admitted executions still running -> their projected rss
+        self._running: dict[LibroNotebookClient, int] = {}
+
+    @staticmethod
+    def key(client: LibroNotebookClient) -> str:
+        if client.notebook_path is not None:
+            return client.notebook_path
+        fingerprints = cell_fingerprints(client.nb)
+        return fingerprints[-1] if fingerprints else ""
+
+    def load_history(self, registry: LibroExecutionRegistry):
+        """Learn the peak rss of the executions archived in ``registry``."""
+        for file, execution in registry.history():
+            self.observe(file, execution)
+        self.history_loaded = True
+
+    def observe(self, key: str, execution: LibroExecution):
+        peak = execution_peak_rss(execution)
+        if peak:
+            self._peaks.setdefault(key, deque(maxlen=self.history)).append(peak)
+
+    def estimate(self, client: LibroNotebookClient) -> int:
+        peaks = self._peaks.get(self.key(client))
+        peak = max(peaks) if peaks else self.default_rss
+        return int(peak * self.safety_factor)
+
+    def check(self, client: LibroNotebookClient):
+        """Raise ``ExecutionRejected`` if the host can never run ``client``."""
+        memory = host_memory()
+        if memory is None:
+            return
+        estimate = self.estimate(client)
+        if estimate + self.min_free_memory > memory[0]:
+            raise ExecutionRejected(
+                f"execution needs about {estimate} bytes, "
+                f"the host has {memory[0]} bytes"
+            )
+
+    def reason(self, client: LibroNotebookClient) -> str | None:
+        """Why ``client`` can not start now, None if it can."""
+        load = host_load()
+        if self.max_load is not None and load is not None and load > self.max_load:
+            return f"load per cpu is {load:.2f}"
+        memory = host_memory()
+        if memory is None:
+            return None
+        # what running executions may still allocate is not available yet
+        reserved = sum(
+            max(estimate - running.kernel_rss(), 0)
+            for running, estimate in self._running.items()
+        )
+        free = memory[1] - reserved - self.estimate(client)
+        if free < self.min_free_memory:
+            return f"only {max(free, 0)} bytes would be left free"
+        return None
+
+    async def admit(self, client: LibroNotebookClient) -> bool:
+        """Wait until ``client`` may start, returns False if it was rejected
+        or cancelled meanwhile."""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            if client.execution.status in ("failed", "cancelled"):
+                return False
+            reason = self.reason(client)
+            if reason is None:
+                break
+            if time.monotonic() >= deadline:
+                logger.info("rejecting execution %s: %s", client.execution.id, reason)
+                await client.async_cancel(f"rejected: {reason}")
+                return False
+            await asyncio.sleep(self.interval)
+        self._running[client] = self.estimate(client)
+        key = self.key(client)
+        client.add_done_callback(lambda c: self._release(key, c))
+        return True
+
+    def _release(self, key: str, client: LibroNotebookClient):
+        self._running.pop(client, None)
+        if client.execution.status == "finished":
+            self.observe(key, client.execution)
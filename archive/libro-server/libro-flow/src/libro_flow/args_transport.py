@@ -0,0 +1,75 @@
+import json
+import os
+import pickle
+from collections.abc import Mapping
+from typing import Any
+
+
+def inline_args(args: Any, limit: int) -> str | None:
+    """Python literal for ``args`` if they are json data of at most ``limit``
+    bytes, None if they should go through a file."""
+    try:
+        encoded = json.dumps(args, allow_nan=False)
+    except (TypeError, ValueError):
+        return None
+    if len(encoded) > limit:
+        return None
+    return repr(args)
+
+
+def dump_args(args: Any, path: str) -> str:
+    """Write ``args`` next to ``path`` (without extension), returns the file.
+
+    msgpack is used when it is installed and can encode the args, pickle
+    otherwise, so args are not limited to json types.
+    """
+    try:
+        import msgpack
+
+        data = msgpack.packb(args, use_bin_type=True)
+        path += ".msgpack"
+    except (ImportError, TypeError, ValueError):
+        data = pickle.dumps(args, protocol=5)
+        path += ".pickle"
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_args(path: str) -> Any:
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".msgpack"):
+        import msgpack
+
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return pickle.loads(data)
+
+
+class LazyArgs(Mapping):
+    """Read-only args mapping that loads its file on first access."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._args: Mapping | None = None
+
+    def _load(self) -> Mapping:
+        if self._args is None:
+            self._args = load_args(self.path)
+        return self._args
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def __repr__(self) -> str:
+        if self._args is None:
+            return f"LazyArgs({self.path!r})"
+        return repr(self._args)
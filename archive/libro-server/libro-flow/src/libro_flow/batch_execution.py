@@ -0,0 +1,386 @@
+import ast
+import asyncio
+import contextlib
+import copy
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, AsyncIterator, Callable, Iterable, Union
+import nbformat
+from nbformat import NotebookNode
+from pydantic import BaseModel
+from .libro_client import LibroNotebookClient, LibroExecution, LibroResultDescriptor
+from .execution_scheduler import LibroExecutionScheduler
+from .execution_record import ExecutionRecordJournal
+from .kernel_pool import LibroKernelPool
+from .kernel_module import ARGS_MODULE, FORK_MODULE
+from .args_transport import dump_args, inline_args
+from .output_streams import compact_stream_outputs
+from .libro_execution import load_notebook_node
+
+
+class LibroBatchResult(BaseModel):
+    index: int
+    args: Any = None
+    execution: LibroExecution
+    error: str = ""
+
+
+class LibroBatchStats(BaseModel):
+    submitted: int = 0
+    finished: int = 0
+    failed: int = 0
+    running: int = 0
+    elapsed: float = 0.0
+    # finished runs per second
+    throughput: float = 0.0
+
+
+class LibroBatchExecution:
+    """Run one notebook once per args dict, ``concurrency`` kernels at a time.
+
+    The notebook is parsed once and copied for each run. ``args_list`` may be
+    a generator, it is consumed only as kernels become free. Iterate the batch
+    to get a ``LibroBatchResult`` per run in completion order; ``stats`` is
+    updated as runs finish. With a ``scheduler`` every run is submitted to it
+    with ``priority``, so it shares the scheduler's workers and admission
+    with single executions.
+    """
+
+    def __init__(
+        self,
+        nb,
+        args_list: Iterable[Any],
+        concurrency: int = 4,
+        execute_record_dir: str | None = None,
+        execute_result_dir: str | None = None,
+        kernel_pool: LibroKernelPool | None = None,
+        scheduler: LibroExecutionScheduler | None = None,
+        priority: int = 0,
+        **kwargs: Any,
+    ):
+        self.nb = nb
+        self.args_list = args_list
+        self.concurrency = concurrency
+        self.execute_record_dir = execute_record_dir
+        self.execute_result_dir = execute_result_dir
+        self.kernel_pool = kernel_pool
+        self.scheduler = scheduler
+        self.priority = priority
+        self.client_kwargs = kwargs
+        self.stats = LibroBatchStats()
+        self._start = 0.0
+
+    def _client(self, index: int, args: Any) -> LibroNotebookClient:
+        record_path = None
+        if self.execute_record_dir is not None:
+            record_path = os.path.join(self.execute_record_dir, f"{index}.ipynb")
+        result_path = None
+        if self.execute_result_dir is not None:
+            result_path = os.path.join(self.execute_result_dir, f"{index}.pickle")
+        client = LibroNotebookClient(
+            nb=copy.deepcopy(self.nb),
+            args=args,
+            execute_record_path=record_path,
+            execute_result_path=result_path,
+            kernel_pool=self.kernel_pool,
+            **self.client_kwargs,
+        )
+        client.update_execution()
+        return client
+
+    async def _run(self, index: int, args: Any) -> LibroBatchResult:
+        client = self._client(index, args)
+        error = ""
+        try:
+            if self.scheduler is None:
+                await client.async_execute()
+            else:
+                await self._schedule(client)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+        return LibroBatchResult(
+            index=index, args=args, execution=client.get_status(), error=error
+        )
+
+    async def _schedule(self, client: LibroNotebookClient):
+        assert self.scheduler is not None
+        done = asyncio.get_running_loop().create_future()
+        client.add_done_callback(lambda _: done.done() or done.set_result(None))
+        try:
+            await self.scheduler.async_submit(client, self.priority)
+            await done
+        except asyncio.CancelledError:
+            await client.async_cancel()
+            raise
+        if client.execution.status != "finished":
+            raise RuntimeError(client.execution.error or client.execution.status)
+
+    @contextlib.asynccontextmanager
+    async def _hold(self, count: int):
+        if self.scheduler is None:
+            yield count
+        else:
+            async with self.scheduler.hold(count, self.priority) as held:
+                yield held
+
+    def _update_stats(self, result: LibroBatchResult):
+        if result.error:
+            self.stats.failed += 1
+        else:
+            self.stats.finished += 1
+        self.stats.running -= 1
+        self.stats.elapsed = time.monotonic() - self._start
+        if self.stats.elapsed > 0:
+            done = self.stats.finished + self.stats.failed
+            self.stats.throughput = done / self.stats.elapsed
+
+    async def __aiter__(self) -> AsyncIterator[LibroBatchResult]:
+        for dir in (self.execute_record_dir, self.execute_result_dir):
+            if dir is not None:
+                os.makedirs(dir, exist_ok=True)
+        self._start = time.monotonic()
+        args_iter = enumerate(self.args_list)
+        pending: set[asyncio.Task] = set()
+        try:
+            while True:
+                while len(pending) < self.concurrency:
+                    try:
+                        index, args = next(args_iter)
+                    except StopIteration:
+                        break
+                    pending.add(asyncio.create_task(self._run(index, args)))
+                    self.stats.submitted += 1
+                    self.stats.running += 1
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    result = task.result()
+                    self._update_stats(result)
+                    yield result
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                # let cancelled runs stop their kernels
+                await asyncio.wait(pending)
+
+
+def fork_index(nb) -> int:
+    """Index of the first cell run per args in forked execution.
+
+    That is the cell with ``libro_fork`` metadata, else the first one calling
+    ``notebook_args`` or reading ``__libro_execute_args_dict__``.
+    """
+    for index, cell in enumerate(nb.cells):
+        if cell.metadata.get("libro_fork"):
+            return index
+    for index, cell in enumerate(nb.cells):
+        if cell.cell_type == "code" and (
+            "notebook_args" in cell.source or "__libro_execute_args_dict__" in cell.source
+        ):
+            return index
+    raise ValueError("no cell reads the notebook args, mark one with libro_fork")
+
+
+class LibroForkedBatchExecution(LibroBatchExecution):
+    """Run the setup cells once, then fork the kernel once per args dict.
+
+    The cells before ``fork_index`` run in a template kernel. Each run is a
+    fork of that kernel (Linux only) sharing the loaded state copy-on-write,
+    it runs the remaining cells with its own args outside of the kernel
+    protocol: outputs are captured per cell, stream output comes before
+    display output, and widgets are not live. With a ``scheduler`` the
+    template kernel and the forks hold its workers for the whole batch.
+    """
+
+    def _record(
+        self, index: int, template: LibroNotebookClient, output: dict
+    ) -> tuple[NotebookNode, str | None]:
+        nb = copy.deepcopy(template.nb)
+        for cell_index, cell in output.get("cells", {}).items():
+            outputs = compact_stream_outputs(
+                template._filter_outputs(cell["outputs"]), template.stream_line_limit
+            )
+            nb.cells[int(cell_index)].outputs = [nbformat.from_dict(o) for o in outputs]
+            nb.cells[int(cell_index)].execution_count = cell["execution_count"]
+        record_path = None
+        if self.execute_record_dir is not None:
+            record_path = os.path.join(self.execute_record_dir, f"{index}.ipynb")
+            ExecutionRecordJournal(record_path, template.record_compression).compact(nb)
+        return nb, record_path
+
+    def _result(
+        self,
+        index: int,
+        args: Any,
+        template: LibroNotebookClient,
+        output_path: str,
+        start_time: str,
+        exit_code: int,
+    ) -> LibroBatchResult:
+        try:
+            with open(output_path, encoding="utf-8") as f:
+                output = json.load(f)
+        except (OSError, ValueError):
+            output = {"error": f"forked run exited with code {exit_code}"}
+        nb, record_path = self._record(index, template, output)
+        error = output.get("error", "")
+        if exit_code and not error:
+            error = f"forked run exited with code {exit_code}"
+        executed = [int(cell_index) for cell_index in output.get("cells", {})]
+        # the child reports where it dumped the result, a temporary file
+        # without execute_result_dir
+        descriptor = None
+        if output.get("result") is not None:
+            descriptor = LibroResultDescriptor.model_validate(output["result"])
+        result_path = descriptor.path if descriptor is not None else self._result_path(index)
+        execution = LibroExecution(
+            status="failed" if error else "finished",
+            error=error,
+            current_index=max(executed, default=template.execution.current_index),
+            cell_count=len(nb.cells),
+            code_cells_executed=template.code_cells_executed + len(executed),
+            start_time=start_time,
+            end_time=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            execute_result_path=result_path or "",
+            execute_record_path=record_path or "",
+            cell_profiles=template.execution.cell_profiles,
+            result_descriptor=descriptor,
+        )
+        return LibroBatchResult(index=index, args=args, execution=execution, error=error)
+
+    def _result_path(self, index: int) -> str | None:
+        if self.execute_result_dir is None:
+            return None
+        return os.path.join(self.execute_result_dir, f"{index}.pickle")
+
+    async def __aiter__(self) -> AsyncIterator[LibroBatchResult]:
+        for dir in (self.execute_record_dir, self.execute_result_dir):
+            if dir is not None:
+                os.makedirs(dir, exist_ok=True)
+        self._start = time.monotonic()
+        start = fork_index(self.nb)
+        # one worker for the template kernel, the others for its forks
+        async with self._hold(self.concurrency + 1) as held:
+            concurrency = max(held - 1, 1)
+            template = LibroNotebookClient(
+                nb=copy.deepcopy(self.nb), args={}, **self.client_kwargs
+            )
+            template.update_execution()
+            work_dir = tempfile.mkdtemp(prefix="libro-fork-")
+            running: dict[int, tuple[int, Any, str, str]] = {}
+            async with template.async_setup_kernel(cleanup_kc=True):
+                try:
+                    await template._async_inject_globals()
+                    for index, cell in enumerate(template.nb.cells[:start]):
+                        await template._async_run_cell(index, cell)
+                    plan_path = os.path.join(work_dir, "plan.json")
+                    with open(plan_path, "w", encoding="utf-8") as f:
+                        json.dump(
+                            {
+                                "cells": [
+                                    [index, cell.source]
+                                    for index, cell in enumerate(template.nb.cells)
+                                    if index >= start and cell.cell_type == "code"
+                                ],
+                                "execution_count": template.code_cells_executed,
+                                "allow_errors": template.allow_errors,
+                            },
+                            f,
+                        )
+                    args_iter = enumerate(self.args_list)
+                    while True:
+                        while len(running) < concurrency:
+                            try:
+                                index, args = next(args_iter)
+                            except StopIteration:
+                                break
+                            if isinstance(args, str):
+                                args = json.loads(args)
+                            output_path = os.path.join(work_dir, f"{index}.json")
+                            literal = inline_args(args, template.args_inline_limit)
+                            args_file = None
+                            if literal is None:
+                                args_file = dump_args(
+                                    args, os.path.join(work_dir, f"{index}.args")
+                                )
+                                literal = f"{ARGS_MODULE}.LazyArgs({args_file!r})"
+                            pid = await template.async_eval_in_kernel(
+                                f"{FORK_MODULE}.fork_child({plan_path!r}, {literal}, "
+                                f"{self._result_path(index)!r}, {output_path!r}, {args_file!r})"
+                            )
+                            start_time = datetime.datetime.now(datetime.timezone.utc)
+                            running[int(pid)] = (index, args, output_path, start_time.isoformat())
+                            self.stats.submitted += 1
+                            self.stats.running += 1
+                        if not running:
+                            break
+                        exited = await template.async_eval_in_kernel(
+                            f"{FORK_MODULE}.wait_children({list(running)!r})"
+                        )
+                        for pid, exit_code in ast.literal_eval(exited or "[]"):
+                            index, args, output_path, start_time = running.pop(pid)
+                            result = self._result(
+                                index, args, template, output_path, start_time, exit_code
+                            )
+                            self._update_stats(result)
+                            yield result
+                finally:
+                    if running:
+                        await template.async_eval_in_kernel(
+                            f"{FORK_MODULE}.kill_children({list(running)!r})"
+                        )
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def execute_notebook_batch(
+    notebook: Any,
+    args_list: Iterable[Any],
+    concurrency: int = 4,
+    execute_record_dir: str | None = None,
+    execute_result_dir: str | None = None,
+    notebook_parser: Callable | None = None,
+    kernel_pool: Union[LibroKernelPool, None] = None,
+    fork: bool = False,
+    scheduler: LibroExecutionScheduler | None = None,
+    priority: int = 0,
+    **kwargs: Any,
+) -> LibroBatchExecution:
+    """Run ``notebook`` once per args, see ``LibroBatchExecution``.
+
+    With ``fork`` the setup cells run once and every run is a fork of that
+    kernel, see ``LibroForkedBatchExecution``; it does not use ``kernel_pool``.
+    """
+    if notebook_parser is not None:
+        nb = notebook_parser(notebook)
+    else:
+        nb = load_notebook_node(notebook)
+    if fork:
+        return LibroForkedBatchExecution(
+            nb,
+            args_list,
+            concurrency=concurrency,
+            execute_record_dir=execute_record_dir,
+            execute_result_dir=execute_result_dir,
+            scheduler=scheduler,
+            priority=priority,
+            **kwargs,
+        )
+    return LibroBatchExecution(
+        nb,
+        args_list,
+        concurrency=concurrency,
+        execute_record_dir=execute_record_dir,
+        execute_result_dir=execute_result_dir,
+        kernel_pool=kernel_pool,
+        scheduler=scheduler,
+        priority=priority,
+        **kwargs,
+    )
@@ -0,0 +1,494 @@
+import argparse
+import asyncio
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from typing import Any
+from urllib.parse import quote
+import nbformat
+from nbformat import NotebookNode
+from pydantic import BaseModel
+from .libro_client import LibroExecution, LibroNotebookClient
+from .execution_record import ExecutionRecordJournal, read_execution_record
+
+logger = logging.getLogger(__name__)
+
+# execution fields a worker reports back to the coordinator
+_REPORTED_FIELDS = {
+    "current_index",
+    "cell_count",
+    "code_cells_executed",
+    "start_time",
+    "end_time",
+    "skipped_cells",
+    "cell_profiles",
+    "result_descriptor",
+}
+
+
+class LibroJob(BaseModel):
+    id: str
+    notebook: dict
+    args: Any = None
+    priority: int = 0
+    # LibroNotebookClient traits the coordinator wants the worker to apply
+    options: dict = {}
+    # claims so far, a job whose worker stopped sending heartbeats is retried
+    attempts: int = 0
+    worker: str = ""
+
+
+class LibroJobReport(BaseModel):
+    execution: LibroExecution
+    # the executed notebook, None if the worker could not produce it
+    record: dict | None = None
+
+
+class LibroJobQueue:
+    """Jobs of a coordinator, waiting for workers to claim them.
+
+    A claimed job is leased to its worker for ``lease_timeout`` seconds and
+    every heartbeat renews the lease. Jobs whose lease expired go back to the
+    queue, after ``max_attempts`` claims they fail; leases are checked every
+    ``lease_timeout / 2`` seconds while there are jobs. The execution of a
+    job is queued until a worker claimed it.
+    """
+
+    def __init__(self, lease_timeout: float = 60.0, max_attempts: int = 3):
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        self._pending: list[tuple[int, int, str]] = []
+        self._counter = itertools.count()
+        self._jobs: dict[
+            str, tuple[LibroJob, "LibroRemoteNotebookClient", asyncio.Future]
+        ] = {}
+        self._leases: dict[str, float] = {}
+        self._changed: asyncio.Event | None = None
+        self._reaper: asyncio.Task | None = None
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    @property
+    def leased_count(self) -> int:
+        return len(self._leases)
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+
+    def submit(self, client: "LibroRemoteNotebookClient", priority: int = 0) -> asyncio.Future:
+        job = LibroJob(
+            id=str(client.execution.id),
+            notebook=client.nb,
+            args=client.args_value,
+            priority=priority,
+            options={
+                "headless": client.headless,
+                "output_mime_types": client.output_mime_types,
+                "merge_streams": client.merge_streams,
+                "stream_line_limit": client.stream_line_limit,
+                "stream_flush_interval": client.stream_flush_interval,
+            },
+        )
+        future = asyncio.get_running_loop().create_future()
+        self._jobs[job.id] = (job, client, future)
+        heapq.heappush(self._pending, (-priority, next(self._counter), job.id))
+        self._notify()
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.get_running_loop().create_task(self._reap())
+        return future
+
+    async def _reap(self):
+        """Expire leases even when no worker comes back to claim."""
+        while self._jobs:
+            await asyncio.sleep(self.lease_timeout / 2)
+            self._expire()
+
+    def _expire(self):
+        now = time.monotonic()
+        for id, deadline in list(self._leases.items()):
+            if deadline > now:
+                continue
+            del self._leases[id]
+            job, client, future = self._jobs[id]
+            logger.warning("worker %s of job %s stopped responding", job.worker, id)
+            if job.attempts >= self.max_attempts:
+                self._fail(id, f"job lost its worker {job.attempts} times")
+            else:
+                client.execution.status = "queued"
+                heapq.heappush(self._pending, (-job.priority, next(self._counter), id))
+                self._notify()
+
+    def _fail(self, id: str, error: str):
+        _, _, future = self._jobs.pop(id)
+        if not future.done():
+            future.set_exception(RuntimeError(error))
+
+    async def claim(self, worker: str, wait: float = 0.0) -> LibroJob | None:
+        """Lease the next job to ``worker``, waiting up to ``wait`` seconds."""
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        deadline = time.monotonic() + wait
+        while True:
+            self._expire()
+            while self._pending:
+                _, _, id = heapq.heappop(self._pending)
+                if id not in self._jobs:
+                    # cancelled while pending
+                    continue
+                job, client, _ = self._jobs[id]
+                job.attempts += 1
+                job.worker = worker
+                client.execution.status = "running"
+                self._leases[id] = time.monotonic() + self.lease_timeout
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            self._changed.clear()
+            try:
+                await asyncio.wait_for(
+                    self._changed.wait(), min(remaining, self.lease_timeout)
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def client(self, id: str, worker: str) -> "LibroRemoteNotebookClient | None":
+        """The client of job ``id`` if it is leased to ``worker``."""
+        entry = self._jobs.get(id)
+        if entry is None or id not in self._leases or entry[0].worker != worker:
+            return None
+        return entry[1]
+
+    def heartbeat(self, id: str, worker: str, execution: dict | None = None) -> bool:
+        """Renew the lease of ``worker`` on job ``id``, False if it lost the job."""
+        client = self.client(id, worker)
+        if client is None:
+            return False
+        self._leases[id] = time.monotonic() + self.lease_timeout
+        if execution is not None:
+            client.update_from_worker(execution)
+        return True
+
+    def complete(self, id: str, worker: str, report: LibroJobReport) -> bool:
+        if self.client(id, worker) is None:
+            return False
+        del self._leases[id]
+        _, _, future = self._jobs.pop(id)
+        if not future.done():
+            future.set_result(report)
+        return True
+
+    def cancel(self, id: str):
+        self._leases.pop(id, None)
+        self._jobs.pop(id, None)
+
+
+class LibroRemoteNotebookClient(LibroNotebookClient):
+    """Run a notebook on a remote worker through a ``LibroJobQueue``.
+
+    The execution waits until a worker completed the job, its progress comes
+    with the worker heartbeats. The record the worker uploads is written to
+    ``execute_record_path``, oversized outputs are externalized here.
+    """
+
+    def __init__(self, nb: NotebookNode, job_queue: LibroJobQueue, priority: int = 0, **kw):
+        kw.pop("kernel_pool", None)
+        super().__init__(nb=nb, **kw)
+        self.job_queue = job_queue
+        self.priority = priority
+
+    def update_from_worker(self, execution: dict):
+        reported = LibroExecution.model_validate(execution)
+        for name in _REPORTED_FIELDS:
+            setattr(self.execution, name, getattr(reported, name))
+        self.execution.worker = reported.worker
+
+    def result_path(self, name: str) -> str:
+        """Where to store the result file ``name`` uploaded by the worker."""
+        if self.execute_result_path is not None:
+            return self.execute_result_path
+        ext = os.path.splitext(name)[1]
+        if self.execute_record_path is not None:
+            return f"{self.execute_record_path}.result{ext}"
+        return os.path.join(
+            tempfile.gettempdir(), f"libro_execute_result_{self.execution.id}{ext}"
+        )
+
+    async def _async_execute_notebook(
+        self, reset_kc: bool = False, **kwargs: Any
+    ) -> NotebookNode:
+        self.start_time = datetime.datetime.now(datetime.timezone.utc)
+        self.execution.start_time = self.start_time.isoformat()
+        self.execution.cell_count = len(self.nb.cells)
+        if self.execute_record_path is not None:
+            self.execution.execute_record_path = self.execute_record_path
+        self.execution.status = "queued"
+        future = self.job_queue.submit(self, self.priority)
+        try:
+            report: LibroJobReport = await future
+        except asyncio.CancelledError:
+            self.job_queue.cancel(str(self.execution.id))
+            raise
+        finally:
+            self._write_record()
+        self.update_from_worker(report.execution.model_dump())
+        if report.record is not None:
+            self.nb = nbformat.from_dict(report.record)
+            self._inline_output_bytes = 0
+            for cell in self.nb.cells:
+                if cell.get("outputs"):
+                    self._externalize_outputs(cell)
+            self._write_record()
+        if report.execution.result_descriptor is not None:
+            self.execution.execute_result_path = report.execution.result_descriptor.path
+        if report.execution.error:
+            raise RuntimeError(report.execution.error)
+        return self.nb
+
+    def _write_record(self):
+        if self.execute_record_path is not None:
+            ExecutionRecordJournal(self.execute_record_path, self.record_compression).compact(
+                self.nb
+            )
+
+
+class LibroFlowWorker:
+    """Pull jobs from a coordinator and run them with ``LibroNotebookClient``.
+
+    ``url`` is the execution api of the coordinator, e.g.
+    ``http://host:8888/jupyter-server/api/execution``. Up to ``concurrency``
+    jobs run at once, each in a temporary directory that is removed
+    afterwards; the record and the result file are uploaded to the
+    coordinator. ``client_kwargs`` configure the clients. Requests that
+    can not reach the coordinator are retried up to ``request_attempts``
+    times, ``heartbeat_interval`` seconds apart. Result files are uploaded
+    in chunks of ``upload_chunk_size`` bytes, below the body size limit of
+    the server.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        token: str = "",
+        name: str | None = None,
+        concurrency: int = 1,
+        poll_wait: float = 30.0,
+        heartbeat_interval: float = 10.0,
+        request_attempts: int = 5,
+        upload_chunk_size: int = 8 * 1024**2,
+        client_kwargs: dict | None = None,
+    ):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self.concurrency = concurrency
+        self.poll_wait = poll_wait
+        self.heartbeat_interval = heartbeat_interval
+        self.request_attempts = request_attempts
+        self.upload_chunk_size = upload_chunk_size
+        self.client_kwargs = client_kwargs or {}
+        self._stopping = False
+
+    async def _request(
+        self, action: str, id: str = "", body: bytes = b"", method: str = "POST", **query: str
+    ):
+        from tornado.httpclient import AsyncHTTPClient
+
+        query["worker"] = self.name
+        if id:
+            query["id"] = id
+        url = f"{self.url}/jobs/{action}?" + "&".join(
+            f"{key}={quote(value)}" for key, value in query.items()
+        )
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"token {self.token}"
+        return await AsyncHTTPClient().fetch(
+            url,
+            method=method,
+            body=body,
+            headers=headers,
+            request_timeout=self.poll_wait + 30,
+            raise_error=False,
+        )
+
+    async def _retry_request(self, action: str, id: str, body: bytes = b"", **kwargs: str):
+        """``_request``, retried while the coordinator can not be reached. None
+        if it never could."""
+        for attempt in range(self.request_attempts):
+            if attempt:
+                await asyncio.sleep(self.heartbeat_interval)
+            try:
+                return await self._request(action, id, body, **kwargs)
+            except OSError as e:
+                logger.warning("%s of job %s failed: %s", action, id, e)
+        return None
+
+    async def run(self):
+        await asyncio.gather(*(self._loop() for _ in range(self.concurrency)))
+
+    def stop(self):
+        """Finish the running jobs, claim no new ones."""
+        self._stopping = True
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                response = await self._request("claim", wait=str(self.poll_wait))
+            except OSError as e:
+                logger.warning("failed to reach coordinator %s: %s", self.url, e)
+                await asyncio.sleep(self.heartbeat_interval)
+                continue
+            if response.code == 204:
+                continue
+            if response.code != 200:
+                logger.warning("claim failed with %s: %s", response.code, response.body[:200])
+                await asyncio.sleep(self.heartbeat_interval)
+                continue
+            job = LibroJob.model_validate_json(response.body)
+            try:
+                await self.execute(job)
+            except Exception:
+                # the lease expires and the coordinator retries the job
+                logger.exception("job %s failed on this worker", job.id)
+
+    async def execute(self, job: LibroJob):
+        work_dir = tempfile.mkdtemp(prefix="libro-worker-")
+        record_path = os.path.join(work_dir, "record.ipynb")
+        kwargs = {
+            # outputs are externalized by the coordinator
+            "cell_output_limit": sys.maxsize,
+            "run_output_limit": sys.maxsize,
+            **self.client_kwargs,
+            **job.options,
+        }
+        client = LibroNotebookClient(
+            nb=nbformat.from_dict(job.notebook),
+            args=job.args,
+            execute_record_path=record_path,
+            **kwargs,
+        )
+        client.update_execution()
+        client.execution.worker = self.name
+        logger.info("running job %s", job.id)
+        task = asyncio.create_task(client.async_execute())
+        try:
+            while not task.done():
+                await asyncio.wait([task], timeout=self.heartbeat_interval)
+                if task.done():
+                    break
+                body = json.dumps({"execution": client.get_status().model_dump(mode="json")})
+                try:
+                    response = await self._request("heartbeat", job.id, body.encode())
+                except OSError as e:
+                    logger.warning("heartbeat of job %s failed: %s", job.id, e)
+                    continue
+                if response.code == 410:
+                    logger.info("job %s was taken from this worker", job.id)
+                    await client.async_cancel()
+                    await asyncio.wait([task])
+                    if not task.cancelled():
+                        # consume the ExecutionStopped of the cancelled run
+                        task.exception()
+                    return
+            if task.exception() is not None:
+                logger.info("job %s failed: %s", job.id, task.exception())
+            await self._upload(job, client, record_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    async def _upload(self, job: LibroJob, client: LibroNotebookClient, record_path: str):
+        execution = client.get_status()
+        descriptor = execution.result_descriptor
+        if descriptor is not None and os.path.exists(descriptor.path):
+            local_path = descriptor.path
+            try:
+                path = await self._upload_result(job, local_path)
+            finally:
+                if client.execute_result_path is None:
+                    # dumped to a temporary file or shared memory
+                    os.remove(local_path)
+            if path is not None:
+                descriptor.path = path
+                descriptor.shared_memory = ""
+            else:
+                execution.error = execution.error or "failed to upload the result"
+        try:
+            record = read_execution_record(record_path)
+        except (OSError, ValueError):
+            record = client.nb
+        report = LibroJobReport(execution=execution, record=record)
+        response = await self._retry_request(
+            "complete", job.id, report.model_dump_json().encode()
+        )
+        if response is None:
+            logger.warning("giving up completing job %s", job.id)
+        elif response.code != 200:
+            logger.warning("completing job %s failed with %s", job.id, response.code)
+
+    async def _upload_result(self, job: LibroJob, local_path: str) -> str | None:
+        """PUT the result file chunk by chunk, returns its path on the coordinator."""
+        size = os.path.getsize(local_path)
+        offset = 0
+        with open(local_path, "rb") as f:
+            while True:
+                data = f.read(self.upload_chunk_size)
+                done = offset + len(data) >= size
+                response = await self._retry_request(
+                    "result",
+                    job.id,
+                    data,
+                    method="PUT",
+                    name=os.path.basename(local_path),
+                    offset=str(offset),
+                    done="1" if done else "0",
+                )
+                if response is None or response.code != 200:
+                    logger.warning("uploading the result of job %s failed", job.id)
+                    return None
+                if done:
+                    return json.loads(response.body)["path"]
+                offset += len(data)
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="libro-flow-worker",
+        description="Run flow executions for a libro_flow coordinator.",
+    )
+    parser.add_argument(
+        "url", help="execution api, e.g. http://host:8888/jupyter-server/api/execution"
+    )
+    parser.add_argument("--token", default=os.environ.get("LIBRO_FLOW_TOKEN", ""))
+    parser.add_argument("--name", default=None)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--poll-wait", type=float, default=30.0)
+    parser.add_argument("--heartbeat-interval", type=float, default=10.0)
+    parser.add_argument("--request-attempts", type=int, default=5)
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    worker = LibroFlowWorker(
+        options.url,
+        token=options.token,
+        name=options.name,
+        concurrency=options.concurrency,
+        poll_wait=options.poll_wait,
+        heartbeat_interval=options.heartbeat_interval,
+        request_attempts=options.request_attempts,
+    )
+    asyncio.run(worker.run())
+
+
+if __name__ == "__main__":
+    main()
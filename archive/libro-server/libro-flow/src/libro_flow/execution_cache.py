@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import nbformat
+from nbformat import NotebookNode
+from .libro_client import LibroNotebookClient, LibroResultDescriptor
+from .execution_record import read_execution_record, record_file
+from .result_format import detect_result_format
+
+logger = logging.getLogger(__name__)
+
+
+class LibroExecutionCache:
+    """Content-addressed cache of finished executions.
+
+    Entries are keyed by the notebook cell sources, the args and the kernel
+    name, and hold the record notebook plus the result file if there was one.
+    The least recently used entries are evicted once the cache grows beyond
+    ``max_size`` bytes. Runs with filtered outputs get their own entries,
+    keyed by the notebook key plus a suffix for the filter.
+    """
+
+    record_name = "record.ipynb"
+    result_name = "result"
+    # one thread, so that stores and evictions do not race each other
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="libro-cache")
+
+    def __init__(self, cache_dir: str, max_size: int = 1024**3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(
+        nb: NotebookNode, args, kernel_name: str = "", output_filter: str = ""
+    ) -> str:
+        digest = hashlib.sha256()
+        for cell in nb.cells:
+            digest.update(cell.cell_type.encode())
+            digest.update(b"\0")
+            digest.update(cell.source.encode())
+            digest.update(b"\0")
+        if isinstance(args, str):
+            try:
+                args = json.loads(args)
+            except ValueError:
+                pass
+        digest.update(json.dumps(args, sort_keys=True, default=str).encode())
+        digest.update(b"\0")
+        digest.update(kernel_name.encode())
+        key = digest.hexdigest()
+        if output_filter:
+            # records of headless or mime filtered runs lack outputs
+            key += "-" + hashlib.sha256(output_filter.encode()).hexdigest()[:16]
+        return key
+
+    def client_key(self, client: LibroNotebookClient) -> str:
+        kernel_name = client.kernel_name or client.nb.metadata.get(
+            "kernelspec", {}
+        ).get("name", "")
+        output_filter = ""
+        if (
+            client.headless
+            or client.output_mime_types is not None
+            or client.stream_line_limit
+        ):
+            output_filter = json.dumps(
+                [client.headless, client.output_mime_types, client.stream_line_limit]
+            )
+        return self.key(client.nb, client.args, kernel_name, output_filter)
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key: str) -> str | None:
+        entry_dir = self._entry_dir(key)
+        if record_file(os.path.join(entry_dir, self.record_name)) is None:
+            return None
+        # the directory mtime is the last access time for eviction
+        os.utime(entry_dir)
+        return entry_dir
+
+    def restore(self, key: str, client: LibroNotebookClient) -> bool:
+        """Finish ``client`` from the cache, returns False on a miss."""
+        entry_dir = self.get(key)
+        if entry_dir is None:
+            return False
+        result_path = os.path.join(entry_dir, self.result_name)
+        has_result = os.path.exists(result_path)
+        if client.execute_result_path is not None:
+            if not has_result:
+                return False
+            shutil.copyfile(result_path, client.execute_result_path)
+            result_path = client.execute_result_path
+        nb = read_execution_record(os.path.join(entry_dir, self.record_name))
+        if has_result:
+            # without an execute_result_path the result is read from the cache
+            client.execution.execute_result_path = result_path
+            client.execution.result_descriptor = LibroResultDescriptor(
+                path=result_path,
+                format=detect_result_format(result_path).name,
+                size=os.path.getsize(result_path),
+            )
+        client.restore_execution(nb)
+        return True
+
+    def store(self, key: str, client: LibroNotebookClient):
+        if client.execution.status != "finished":
+            return
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        with open(os.path.join(tmp_dir, self.record_name), "w", encoding="utf-8") as f:
+            nbformat.write(client.nb, f)
+        descriptor = client.execution.result_descriptor
+        result_path = descriptor.path if descriptor is not None else client.execute_result_path
+        if result_path and os.path.exists(result_path):
+            shutil.copyfile(result_path, os.path.join(tmp_dir, self.result_name))
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+        self.evict()
+
+    def store_later(self, key: str, client: LibroNotebookClient):
+        """``store`` in ``executor``, for done callbacks on the event loop."""
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.store, key, client
+        )
+        future.add_done_callback(lambda f: self._log_store_error(key, f))
+
+    @staticmethod
+    def _log_store_error(key: str, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.warning("failed to cache execution %s: %s", key, future.exception())
+
+    def invalidate(self, key: str) -> bool:
+        entry_dir = self._entry_dir(key)
+        if not os.path.exists(entry_dir):
+            return False
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return True
+
+    def invalidate_notebook(self, nb: NotebookNode, args, kernel_name: str = "") -> bool:
+        """Remove the entries of ``nb`` with ``args``, whatever their output filter."""
+        key = self.key(nb, args, kernel_name)
+        prefix_dir = os.path.dirname(self._entry_dir(key))
+        if not os.path.isdir(prefix_dir):
+            return False
+        removed = False
+        for name in os.listdir(prefix_dir):
+            if name == key or (name.startswith(f"{key}-") and not name.endswith(".tmp")):
+                removed = self.invalidate(name) or removed
+        return removed
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, key)
+                if key.endswith(".tmp"):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(entry_dir, name))
+                    for name in os.listdir(entry_dir)
+                )
+                entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
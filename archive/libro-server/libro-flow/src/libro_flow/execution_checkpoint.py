@@ -0,0 +1,102 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from nbformat import NotebookNode
+from .execution_record import ExecutionRecordJournal
+
+
+class ExecutionCheckpointer:
+    """Write execution record checkpoints from a thread pool.
+
+    Changed cells are collected with ``mark_cell`` and flushed to the record
+    journal once ``interval`` seconds passed or ``max_cells`` cells are pending,
+    whichever comes first. Cells are serialized on the event loop, file I/O
+    happens in ``executor``. ``close`` always flushes and compacts the record,
+    serializing the whole notebook in ``executor`` too.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="libro-checkpoint")
+
+    def __init__(
+        self,
+        journal: ExecutionRecordJournal,
+        interval: float = 1.0,
+        max_cells: int = 10,
+    ):
+        self.journal = journal
+        self.interval = interval
+        self.max_cells = max_cells
+        self._dirty: dict[int, NotebookNode] = {}
+        self._dirty_since: float | None = None
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self.checkpoint_index = -1
+
+    @property
+    def lag(self) -> float:
+        """Seconds the oldest unwritten change has been waiting."""
+        if self._dirty_since is None:
+            return 0.0
+        return time.monotonic() - self._dirty_since
+
+    async def _run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, func, *args)
+
+    async def start(self, nb: NotebookNode):
+        line = self.journal.encode_notebook(nb)
+        async with self._lock:
+            await self._run_in_executor(self.journal.write_lines, [line], True)
+
+    def mark_cell(self, index: int, cell: NotebookNode):
+        self._dirty[index] = cell
+        if self._dirty_since is None:
+            self._dirty_since = time.monotonic()
+        due = self._last_flush + self.interval
+        if len(self._dirty) >= self.max_cells or time.monotonic() >= due:
+            self._schedule_flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_at(
+                loop.time() + max(0.0, due - time.monotonic()), self._schedule_flush
+            )
+
+    def _schedule_flush(self):
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, {}
+        dirty_since, self._dirty_since = self._dirty_since, None
+        lines = [self.journal.encode_cell(i, cell) for i, cell in sorted(dirty.items())]
+        self._last_flush = time.monotonic()
+        try:
+            async with self._lock:
+                await self._run_in_executor(self.journal.write_lines, lines)
+        except BaseException:
+            # keep the cells so the next flush retries them
+            self._dirty = {**dirty, **self._dirty}
+            self._dirty_since = dirty_since
+            raise
+        self.checkpoint_index = max(self.checkpoint_index, max(dirty))
+
+    async def close(self, nb: NotebookNode):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._dirty = {}
+        self._dirty_since = None
+        async with self._lock:
+            # the execution is over, nothing changes nb while it is written
+            await self._run_in_executor(self.journal.compact, nb)
+        self.checkpoint_index = len(nb.cells) - 1
@@ -0,0 +1,73 @@
+import asyncio
+import collections
+from typing import Any, AsyncIterator
+from pydantic import BaseModel
+
+
+class LibroExecutionEvent(BaseModel):
+    id: int
+    type: str
+    data: dict[str, Any] = {}
+
+
+class ExecutionEventLog:
+    """Bounded log of execution events that subscribers can follow.
+
+    Event ids increase by one per event, so a reconnecting subscriber passes
+    the last id it saw and only receives what came after it. Only the last
+    ``max_events`` events are kept.
+    """
+
+    def __init__(self, max_events: int = 1000):
+        self.events: collections.deque[LibroExecutionEvent] = collections.deque(
+            maxlen=max_events
+        )
+        self.closed = False
+        self._next_id = 0
+        self._waiters: list[asyncio.Future] = []
+
+    def emit(self, type: str, **data: Any) -> LibroExecutionEvent:
+        event = LibroExecutionEvent(id=self._next_id, type=type, data=data)
+        self._next_id += 1
+        self.events.append(event)
+        self._wake()
+        return event
+
+    def close(self):
+        self.closed = True
+        self._wake()
+
+    def _wake(self):
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def since(self, last_event_id: int = -1) -> list[LibroExecutionEvent]:
+        if not self.events or last_event_id >= self.events[-1].id:
+            return []
+        start = max(0, last_event_id + 1 - self.events[0].id)
+        return list(self.events)[start:]
+
+    async def subscribe(
+        self, last_event_id: int = -1, keepalive: float | None = None
+    ) -> AsyncIterator[LibroExecutionEvent | None]:
+        """Yield events after ``last_event_id`` until the log is closed.
+
+        ``None`` is yielded when no event arrived within ``keepalive`` seconds.
+        """
+        while True:
+            events = self.since(last_event_id)
+            for event in events:
+                last_event_id = event.id
+                yield event
+            if events:
+                continue
+            if self.closed:
+                return
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, keepalive)
+            except asyncio.TimeoutError:
+                yield None
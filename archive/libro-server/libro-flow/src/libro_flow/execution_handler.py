@@ -3,18 +3,39 @@ import os
 from jupyter_server.base.handlers import APIHandler
 from jupyter_server.auth.decorator import allow_unauthenticated
 from tornado.web import HTTPError, authenticated
-from .libro_execution import execute_notebook, LibroNotebookClient
+from tornado.iostream import StreamClosedError
+from .libro_execution import execute_notebook
+from .execution_scheduler import LibroExecutionScheduler, ExecutionQueueFull
+from .admission_control import ExecutionRejected
+from .kernel_pool import LibroKernelPool
+from .execution_record import read_execution_record
+from .execution_registry import LibroExecutionRegistry
+from .batch_execution import execute_notebook_batch
+from .execution_cache import LibroExecutionCache
+from .output_store import OutputBlobStore
+from .distributed_execution import LibroJobQueue, LibroJobReport
+from pydantic import ValidationError
 from jupyter_server.utils import ApiPath, to_os_path, to_api_path
 from jupyter_core.utils import ensure_dir_exists
 from contextlib import contextmanager
 import errno
+import nbformat
+from uuid import uuid4
 
 
-class LibroExecutionHandler(APIHandler):
-    executors: dict[str, LibroNotebookClient] = {}
+class LibroExecutionBaseHandler(APIHandler):
+    # shared by every execution handler, configure it on this class
+    registry: LibroExecutionRegistry | None = None
+    # set to a LibroJobQueue to leave executions to remote workers
+    job_queue: LibroJobQueue | None = None
 
     execution_dir = "execution"
 
+    @property
+    def scheduler(self) -> LibroExecutionScheduler:
+        """The scheduler of the server app, see ``_load_jupyter_server_extension``."""
+        return self.settings["libro_execution_scheduler"]
+
     def _get_os_path(self, path):
         """Given an API path, return its file system path.
 
@@ -72,6 +93,17 @@ class LibroExecutionHandler(APIHandler):
             else:
                 raise
 
+    def get_registry(self) -> LibroExecutionRegistry:
+        if LibroExecutionBaseHandler.registry is None:
+            root = os.path.abspath(self.contents_manager.root_dir)
+            execution_dir = os.path.join(root, self.execution_dir)
+            with self.perm_to_403():
+                ensure_dir_exists(execution_dir)
+            LibroExecutionBaseHandler.registry = LibroExecutionRegistry(
+                os.path.join(execution_dir, "executions.sqlite")
+            )
+        return LibroExecutionBaseHandler.registry
+
     # Checkpoint-related utilities
     def result_path(self, path: str):
         path = path.strip("/")
@@ -86,6 +118,21 @@ class LibroExecutionHandler(APIHandler):
         execution_path = os.path.join(execution_dir, filename)
         return execution_path
 
+
+class LibroExecutionHandler(LibroExecutionBaseHandler):
+    # set to a LibroKernelPool to run executions on pre-started kernels
+    kernel_pool: LibroKernelPool | None = None
+    # set to a LibroExecutionCache to let requests opt in with "cache": true
+    cache: LibroExecutionCache | None = None
+    # "gzip" or "zstd" to compress the execution records
+    record_compression: str | None = None
+    # let requests run trusted notebooks without a kernel with "inprocess": true
+    allow_inprocess = False
+    # default of the "headless" request option, see LibroNotebookClient.headless
+    headless = False
+    # mime types of rich outputs to keep, None for all
+    output_mime_types: list[str] | None = None
+
     @authenticated
     @allow_unauthenticated
     async def post(self) -> None:
@@ -95,17 +142,45 @@ class LibroExecutionHandler(APIHandler):
             raise HTTPError(400, "can not get arguments")
         file = model.get("file")
         args = model.get("args")
+        priority = model.get("priority", 0)
+        use_cache = model.get("cache", False)
+        inprocess = model.get("inprocess", False)
+        headless = model.get("headless", self.headless)
         if file is None:
             raise HTTPError(400, "file is missing")
         if not isinstance(file, str):
             raise HTTPError(400, "file is invalid")
+        if not isinstance(priority, int):
+            raise HTTPError(400, "priority is invalid")
+        if not isinstance(headless, bool):
+            raise HTTPError(400, "headless is invalid")
+        if inprocess and not self.allow_inprocess:
+            raise HTTPError(403, "in-process execution is not allowed")
         file_full_path = self._get_os_path(file)
         result_path = self.result_path(file)
-        client = execute_notebook(
-            notebook=file_full_path, args=args, execute_record_path=result_path
-        )
-        self.executors[file_full_path] = client
-        self.executors[str(client.execution.id)] = client
+        admission = self.scheduler.admission
+        if admission is not None and not admission.history_loaded:
+            admission.load_history(self.get_registry())
+        try:
+            client = execute_notebook(
+                notebook=file_full_path,
+                args=args,
+                execute_record_path=result_path,
+                scheduler=self.scheduler,
+                priority=priority,
+                kernel_pool=self.kernel_pool,
+                cache=self.cache if use_cache else None,
+                record_compression=self.record_compression,
+                inprocess=bool(inprocess),
+                job_queue=self.job_queue,
+                headless=headless,
+                output_mime_types=self.output_mime_types,
+            )
+        except ExecutionQueueFull as e:
+            raise HTTPError(429, str(e)) from e
+        except ExecutionRejected as e:
+            raise HTTPError(503, str(e)) from e
+        self.get_registry().add(client, file_full_path)
         self.write(json.dumps({"file": file, "id": str(client.execution.id)}))
 
     @authenticated
@@ -117,13 +192,297 @@ class LibroExecutionHandler(APIHandler):
         id = self.request.query_arguments.get("id")
         if id is not None:
             id = "".join(map(bytes.decode, id))
-        client = None
+        registry = self.get_registry()
+        execution = None
         if isinstance(id, str):
-            client = self.executors.get(id)
-        if client is None:
+            execution = registry.get(id=id)
+        if execution is None:
             if isinstance(file, str):
                 file_full_path = self._get_os_path(file)
-                client = self.executors[file_full_path]
-        if client is None:
+                execution = registry.get(file=file_full_path)
+        if execution is None:
             raise HTTPError(400, "client not found")
+        if self.get_query_argument("record", None) is not None:
+            record_path = execution.execute_record_path
+            if not record_path:
+                raise HTTPError(404, "execution has no record")
+            with self.perm_to_403(record_path):
+                nb = read_execution_record(record_path)
+            self.write(nbformat.writes(nb))
+            return
+        self.write(execution.model_dump_json())
+
+    @authenticated
+    @allow_unauthenticated
+    async def delete(self) -> None:
+        """Cancel execution ``id``, answers once it stopped."""
+        id = self.get_query_argument("id", None)
+        if id is None:
+            raise HTTPError(400, "id is missing")
+        registry = self.get_registry()
+        client = registry.get_client(id)
+        if client is None:
+            if registry.get(id=id) is None:
+                raise HTTPError(404, "execution not found")
+            raise HTTPError(409, "execution already ended")
+        await client.async_cancel()
+        self.set_header("Content-Type", "application/json")
         self.write(client.get_status().model_dump_json())
+
+
+class LibroBatchExecutionHandler(LibroExecutionBaseHandler):
+    """Run a notebook over a list of args, streaming one json line per run.
+
+    Each finished run is written as ``{"type": "result", ...}``, the response
+    ends with ``{"type": "stats", ...}``. With ``"fork": true`` the setup cells
+    run once and every run is a fork of that kernel. Runs go through the
+    scheduler of the server app, a full queue answers 429.
+    """
+
+    max_concurrency = 8
+    kernel_pool: LibroKernelPool | None = None
+    record_compression: str | None = None
+    headless = False
+    output_mime_types: list[str] | None = None
+
+    @authenticated
+    @allow_unauthenticated
+    async def post(self) -> None:
+        model = self.get_json_body()
+        if model is None:
+            raise HTTPError(400, "can not get arguments")
+        file = model.get("file")
+        args_list = model.get("args_list")
+        concurrency = model.get("concurrency", self.max_concurrency)
+        fork = model.get("fork", False)
+        headless = model.get("headless", self.headless)
+        priority = model.get("priority", 0)
+        if not isinstance(file, str):
+            raise HTTPError(400, "file is invalid")
+        if not isinstance(args_list, list):
+            raise HTTPError(400, "args_list is invalid")
+        if not isinstance(concurrency, int) or concurrency < 1:
+            raise HTTPError(400, "concurrency is invalid")
+        if not isinstance(fork, bool):
+            raise HTTPError(400, "fork is invalid")
+        if not isinstance(headless, bool):
+            raise HTTPError(400, "headless is invalid")
+        if not isinstance(priority, int):
+            raise HTTPError(400, "priority is invalid")
+        scheduler = self.scheduler
+        if scheduler.full:
+            raise HTTPError(
+                429, f"execution queue is full ({scheduler.max_queue_size} jobs waiting)"
+            )
+        admission = scheduler.admission
+        if admission is not None and not admission.history_loaded:
+            admission.load_history(self.get_registry())
+        file_full_path = self._get_os_path(file)
+        record_dir = f"{self.result_path(file)}.batch-{uuid4().hex[:16]}"
+        batch = execute_notebook_batch(
+            file_full_path,
+            args_list,
+            concurrency=min(concurrency, self.max_concurrency),
+            execute_record_dir=record_dir,
+            # keep the results with the records instead of in temporary files
+            execute_result_dir=record_dir,
+            kernel_pool=self.kernel_pool,
+            fork=fork,
+            scheduler=scheduler,
+            priority=priority,
+            record_compression=self.record_compression,
+            headless=headless,
+            output_mime_types=self.output_mime_types,
+        )
+        self.set_header("Content-Type", "application/x-ndjson")
+        async for result in batch:
+            self.write(json.dumps({"type": "result", **result.model_dump(mode="json")}))
+            self.write("\n")
+            try:
+                await self.flush()
+            except StreamClosedError:
+                return
+        self.write(json.dumps({"type": "stats", **batch.stats.model_dump(mode="json")}))
+        self.write("\n")
+
+
+class LibroExecutionEventsHandler(LibroExecutionBaseHandler):
+    """Stream execution events as server-sent events.
+
+    Reconnecting clients resume after the ``Last-Event-ID`` header (or the
+    ``last_event_id`` query argument).
+    """
+
+    keepalive = 15.0
+
+    def write_event(self, type: str, data: dict, id: int | None = None):
+        if id is not None:
+            self.write(f"id: {id}\n")
+        self.write(f"event: {type}\ndata: {json.dumps(data)}\n\n")
+
+    @authenticated
+    @allow_unauthenticated
+    async def get(self) -> None:
+        id = self.get_query_argument("id", None)
+        if id is None:
+            raise HTTPError(400, "id is missing")
+        last_event_id = self.request.headers.get(
+            "Last-Event-ID", self.get_query_argument("last_event_id", "-1")
+        )
+        try:
+            last_event_id = int(last_event_id)
+        except ValueError:
+            raise HTTPError(400, "last event id is invalid") from None
+        registry = self.get_registry()
+        client = registry.get_client(id)
+        execution = None
+        if client is None:
+            execution = registry.get(id=id)
+            if execution is None:
+                raise HTTPError(404, "execution not found")
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        if client is None:
+            assert execution is not None
+            self.write_event("complete", {"execution": execution.model_dump(mode="json")})
+            return
+        async for event in client.events.subscribe(last_event_id, self.keepalive):
+            if event is None:
+                self.write(": keepalive\n\n")
+            else:
+                self.write_event(event.type, event.data, event.id)
+            try:
+                await self.flush()
+            except StreamClosedError:
+                return
+
+
+class LibroExecutionBlobHandler(LibroExecutionBaseHandler):
+    """Serve an output moved out of an execution record.
+
+    The blob store is the one next to the record of execution ``id``, or of
+    the last execution of ``file``.
+    """
+
+    @authenticated
+    @allow_unauthenticated
+    async def get(self) -> None:
+        digest = self.get_query_argument("digest", None)
+        if digest is None:
+            raise HTTPError(400, "digest is missing")
+        id = self.get_query_argument("id", None)
+        file = self.get_query_argument("file", None)
+        if id is not None:
+            execution = self.get_registry().get(id=id)
+            if execution is None or not execution.execute_record_path:
+                raise HTTPError(404, "execution not found")
+            record_path = execution.execute_record_path
+        elif file is not None:
+            record_path = self.result_path(file)
+        else:
+            raise HTTPError(400, "id or file is missing")
+        store = OutputBlobStore(os.path.join(os.path.dirname(record_path), ".blobs"))
+        try:
+            with self.perm_to_403():
+                data = store.get(digest)
+        except ValueError as e:
+            raise HTTPError(400, str(e)) from e
+        if data is None:
+            raise HTTPError(404, "blob not found")
+        self.set_header("Content-Type", "application/json")
+        # blobs are content-addressed, they never change
+        self.set_header("Cache-Control", "private, max-age=31536000, immutable")
+        self.write(data)
+
+
+class LibroExecutionJobsHandler(LibroExecutionBaseHandler):
+    """Endpoints for the workers of a coordinator with a ``job_queue``.
+
+    Every request names its ``worker``. ``POST claim`` leases the next job
+    (waiting up to ``wait`` seconds, 204 if none), ``POST heartbeat`` renews
+    the lease of job ``id`` and reports its progress, ``PUT result`` uploads
+    its result file ``name`` and ``POST complete`` ends it with a
+    ``LibroJobReport``. A worker that lost its job gets 410.
+
+    Results may come in chunks: every ``PUT result`` writes its body at
+    ``offset`` and the one with ``done=1`` (the default) finishes the file.
+    """
+
+    max_wait = 60.0
+
+    def get_job_queue(self) -> LibroJobQueue:
+        if self.job_queue is None:
+            raise HTTPError(404, "distributed execution is not enabled")
+        return self.job_queue
+
+    def get_worker_job(self) -> tuple[str, str]:
+        worker = self.get_query_argument("worker", None)
+        id = self.get_query_argument("id", None)
+        if not worker or not id:
+            raise HTTPError(400, "worker or id is missing")
+        return worker, id
+
+    @authenticated
+    @allow_unauthenticated
+    async def post(self, action: str) -> None:
+        queue = self.get_job_queue()
+        self.set_header("Content-Type", "application/json")
+        if action == "claim":
+            worker = self.get_query_argument("worker", None)
+            if not worker:
+                raise HTTPError(400, "worker is missing")
+            try:
+                wait = min(float(self.get_query_argument("wait", "0")), self.max_wait)
+            except ValueError:
+                raise HTTPError(400, "wait is invalid") from None
+            job = await queue.claim(worker, wait)
+            if job is None:
+                self.set_status(204)
+                return
+            self.write(job.model_dump_json())
+            return
+        worker, id = self.get_worker_job()
+        if action == "heartbeat":
+            body = self.get_json_body() or {}
+            if not queue.heartbeat(id, worker, body.get("execution")):
+                raise HTTPError(410, "job is not leased to this worker")
+        elif action == "complete":
+            try:
+                report = LibroJobReport.model_validate_json(self.request.body)
+            except ValidationError as e:
+                raise HTTPError(400, f"report is invalid: {e}") from e
+            if not queue.complete(id, worker, report):
+                raise HTTPError(410, "job is not leased to this worker")
+        else:
+            raise HTTPError(404, f"unknown action {action}")
+        self.write("{}")
+
+    @authenticated
+    @allow_unauthenticated
+    async def put(self, action: str) -> None:
+        if action != "result":
+            raise HTTPError(404, f"unknown action {action}")
+        worker, id = self.get_worker_job()
+        client = self.get_job_queue().client(id, worker)
+        if client is None:
+            raise HTTPError(410, "job is not leased to this worker")
+        name = os.path.basename(self.get_query_argument("name", ""))
+        try:
+            offset = int(self.get_query_argument("offset", "0"))
+        except ValueError:
+            raise HTTPError(400, "offset is invalid") from None
+        done = self.get_query_argument("done", "1") != "0"
+        path = client.result_path(name)
+        # one upload per job, a retried chunk overwrites itself
+        tmp_path = f"{path}.upload"
+        with self.perm_to_403(path):
+            if offset and (not os.path.exists(tmp_path) or os.path.getsize(tmp_path) < offset):
+                raise HTTPError(409, "offset is past the uploaded data")
+            with open(tmp_path, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+                f.write(self.request.body)
+            if done:
+                os.replace(tmp_path, path)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps({"path": path}))
@@ -0,0 +1,222 @@
+import argparse
+import gzip
+import io
+import json
+import os
+import nbformat
+from nbformat import NotebookNode
+
+# compression -> suffix the compressed record adds to the record path
+RECORD_COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst"}
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def open_record_writer(path: str, compression: str | None = None) -> io.TextIOBase:
+    """Text stream writing a record file, compressed while it is written."""
+    if compression is None:
+        return open(path, "w", encoding="utf-8")
+    if compression == "gzip":
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+    if compression == "zstd":
+        import zstandard
+
+        writer = zstandard.ZstdCompressor(level=3).stream_writer(open(path, "wb"))
+        return io.TextIOWrapper(writer, encoding="utf-8")
+    raise ValueError(f"unknown record compression {compression!r}")
+
+
+def open_record_reader(path: str) -> io.TextIOBase:
+    """Text stream reading a plain, gzip or zstd record file."""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic[:2] == _GZIP_MAGIC:
+        return gzip.open(path, "rt", encoding="utf-8")
+    if magic == _ZSTD_MAGIC:
+        import zstandard
+
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def record_file(record_path: str) -> str | None:
+    """The file holding the finished record ``record_path``, if any."""
+    for suffix in ("", *RECORD_COMPRESSIONS.values()):
+        if os.path.exists(record_path + suffix):
+            return record_path + suffix
+    return None
+
+
+class ExecutionRecordJournal:
+    """Append-only journal for an execution record.
+
+    While a notebook runs, only the cells that changed are appended to
+    ``<record_path>.journal`` as json lines. ``compact`` turns the journal into
+    the final ``.ipynb`` at ``record_path`` and removes it. With a
+    ``compression`` from ``RECORD_COMPRESSIONS`` the final record is written
+    compressed to ``record_path`` plus the suffix of the compression.
+    """
+
+    suffix = ".journal"
+
+    def __init__(self, record_path: str, compression: str | None = None):
+        if compression is not None and compression not in RECORD_COMPRESSIONS:
+            raise ValueError(f"unknown record compression {compression!r}")
+        self.record_path = record_path
+        self.journal_path = record_path + self.suffix
+        self.compression = compression
+        self._file = None
+
+    @staticmethod
+    def encode(entry: dict) -> str:
+        return json.dumps(entry, ensure_ascii=False) + "\n"
+
+    @classmethod
+    def encode_notebook(cls, nb: NotebookNode) -> str:
+        return cls.encode({"type": "notebook", "notebook": nb})
+
+    @classmethod
+    def encode_cell(cls, index: int, cell: NotebookNode) -> str:
+        return cls.encode({"type": "cell", "index": index, "cell": cell})
+
+    @classmethod
+    def encode_metadata(cls, metadata: dict) -> str:
+        return cls.encode({"type": "metadata", "metadata": metadata})
+
+    def write_lines(self, lines: list[str], truncate: bool = False):
+        if truncate:
+            self.close()
+            self._file = open(self.journal_path, "w", encoding="utf-8")
+        elif self._file is None:
+            self._file = open(self.journal_path, "a", encoding="utf-8")
+        self._file.writelines(lines)
+        self._file.flush()
+
+    def start(self, nb: NotebookNode):
+        self.write_lines([self.encode_notebook(nb)], truncate=True)
+
+    def append_cell(self, index: int, cell: NotebookNode):
+        self.write_lines([self.encode_cell(index, cell)])
+
+    def append_metadata(self, metadata: dict):
+        self.write_lines([self.encode_metadata(metadata)])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def compact(self, nb: NotebookNode | None = None, text: str | None = None):
+        """Write the final record from ``text``, ``nb`` or the journal itself."""
+        self.close()
+        if text is None:
+            if nb is None:
+                nb = read_execution_journal(self.journal_path)
+            text = nbformat.writes(nb)
+        if not text.endswith("\n"):
+            text += "\n"
+        path = self.record_path + RECORD_COMPRESSIONS.get(self.compression, "")
+        tmp_path = path + ".tmp"
+        with open_record_writer(tmp_path, self.compression) as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        # a previous run may have left the record in another format
+        for suffix in ("", *RECORD_COMPRESSIONS.values()):
+            if self.record_path + suffix != path and os.path.exists(self.record_path + suffix):
+                os.remove(self.record_path + suffix)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+
+def read_execution_journal(journal_path: str) -> NotebookNode:
+    nb = None
+    with open(journal_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may still be being written
+                break
+            if entry["type"] == "notebook":
+                nb = entry["notebook"]
+            elif nb is None:
+                continue
+            elif entry["type"] == "cell":
+                nb["cells"][entry["index"]] = entry["cell"]
+            elif entry["type"] == "metadata":
+                nb["metadata"].update(entry["metadata"])
+    if nb is None:
+        raise ValueError(f"{journal_path} has no notebook entry")
+    return nbformat.from_dict(nb)
+
+
+def read_execution_record(record_path: str) -> NotebookNode:
+    """Read the current state of a record, running or finished."""
+    journal_path = record_path + ExecutionRecordJournal.suffix
+    try:
+        return read_execution_journal(journal_path)
+    except FileNotFoundError:
+        pass
+    path = record_file(record_path)
+    if path is None:
+        raise FileNotFoundError(record_path)
+    with open_record_reader(path) as f:
+        return nbformat.read(f, as_version=4)
+
+
+def compress_execution_records(
+    root: str, compression: str = "gzip"
+) -> list[tuple[str, int, int]]:
+    """Compress the finished ``.ipynb`` records below ``root``.
+
+    Records that are still running (have a journal) and the blob and snapshot
+    directories are left alone, modification times are kept. Returns the
+    ``(record path, size before, size after)`` of every compressed record.
+    """
+    compressed = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [
+            name for name in dirnames
+            if name != ".blobs" and not name.endswith(".snapshots")
+        ]
+        for name in filenames:
+            record_path = os.path.join(dirpath, name)
+            if not name.endswith(".ipynb") or os.path.exists(
+                record_path + ExecutionRecordJournal.suffix
+            ):
+                continue
+            stat = os.stat(record_path)
+            with open(record_path, encoding="utf-8") as f:
+                text = f.read()
+            journal = ExecutionRecordJournal(record_path, compression)
+            journal.compact(text=text)
+            path = record_path + RECORD_COMPRESSIONS[compression]
+            os.utime(path, (stat.st_atime, stat.st_mtime))
+            compressed.append((record_path, stat.st_size, os.path.getsize(path)))
+    return compressed
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m libro_flow.execution_record",
+        description="Compress the execution records below the given directories.",
+    )
+    parser.add_argument("dirs", nargs="+", help="execution directories")
+    parser.add_argument(
+        "--compression", choices=sorted(RECORD_COMPRESSIONS), default="gzip"
+    )
+    options = parser.parse_args(argv)
+    before = after = 0
+    for root in options.dirs:
+        for record_path, size, compressed_size in compress_execution_records(
+            root, options.compression
+        ):
+            print(f"{record_path}: {size} -> {compressed_size}")
+            before += size
+            after += compressed_size
+    print(f"total: {before} -> {after}")
+
+
+if __name__ == "__main__":
+    main()
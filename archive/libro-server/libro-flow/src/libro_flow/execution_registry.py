@@ -0,0 +1,140 @@
+import os
+import sqlite3
+import time
+from .libro_client import LibroNotebookClient, LibroExecution
+from .result_format import release_shared_result
+
+
+class LibroExecutionRegistry:
+    """Track executions by id and by notebook file.
+
+    Only running clients are kept in memory. Once a client is done its
+    ``LibroExecution`` summary moves to a SQLite index at ``db_path``. Summaries
+    older than ``ttl`` seconds, or beyond the ``max_entries`` most recently
+    used ones, are evicted, together with their results in shared memory.
+    """
+
+    def __init__(
+        self,
+        db_path: str = ":memory:",
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 10000,
+    ):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.active: dict[str, LibroNotebookClient] = {}
+        self._active_files: dict[str, str] = {}
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS executions ("
+                "id TEXT PRIMARY KEY, file TEXT, summary TEXT, "
+                "finished_at REAL, accessed_at REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS executions_file "
+                "ON executions (file, finished_at)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS executions_accessed "
+                "ON executions (accessed_at)"
+            )
+
+    def add(self, client: LibroNotebookClient, file: str):
+        if client.execution.status in ("finished", "failed"):
+            # e.g. served from the execution cache
+            self.archive(client, file)
+            return
+        id = str(client.execution.id)
+        self.active[id] = client
+        self._active_files[file] = id
+        client.add_done_callback(lambda c: self.archive(c, file))
+
+    def archive(self, client: LibroNotebookClient, file: str):
+        id = str(client.execution.id)
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO executions VALUES (?, ?, ?, ?, ?)",
+                (id, file, client.get_status().model_dump_json(), now, now),
+            )
+        self.active.pop(id, None)
+        if self._active_files.get(file) == id:
+            del self._active_files[file]
+        self.evict()
+
+    def get_client(self, id: str) -> LibroNotebookClient | None:
+        return self.active.get(id)
+
+    def get(self, id: str | None = None, file: str | None = None) -> LibroExecution | None:
+        if id is None and file is not None:
+            id = self._active_files.get(file)
+            if id is None:
+                row = self._db.execute(
+                    "SELECT id FROM executions WHERE file = ? "
+                    "ORDER BY finished_at DESC LIMIT 1",
+                    (file,),
+                ).fetchone()
+                id = row[0] if row else None
+        if id is None:
+            return None
+        client = self.active.get(id)
+        if client is not None:
+            return client.get_status()
+        row = self._db.execute(
+            "SELECT summary FROM executions WHERE id = ?", (id,)
+        ).fetchone()
+        if row is None:
+            return None
+        with self._db:
+            self._db.execute(
+                "UPDATE executions SET accessed_at = ? WHERE id = ?", (time.time(), id)
+            )
+        return LibroExecution.model_validate_json(row[0])
+
+    def history(self):
+        """``(file, execution)`` of the finished executions, oldest first."""
+        rows = self._db.execute(
+            "SELECT file, summary FROM executions ORDER BY finished_at"
+        ).fetchall()
+        for file, summary in rows:
+            execution = LibroExecution.model_validate_json(summary)
+            if execution.status == "finished":
+                yield file, execution
+
+    def evict(self):
+        deadline = time.time() - self.ttl
+        rows = self._db.execute(
+            "SELECT id, summary FROM executions WHERE accessed_at < ? UNION "
+            "SELECT * FROM (SELECT id, summary FROM executions "
+            "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (deadline, self.max_entries),
+        ).fetchall()
+        if not rows:
+            return
+        _release_results(
+            LibroExecution.model_validate_json(summary) for _, summary in rows
+        )
+        with self._db:
+            self._db.executemany(
+                "DELETE FROM executions WHERE id = ?", [(id,) for id, _ in rows]
+            )
+
+    def close(self):
+        """Release the results in shared memory of every tracked execution."""
+        _release_results(client.get_status() for client in self.active.values())
+        _release_results(
+            LibroExecution.model_validate_json(summary)
+            for summary, in self._db.execute("SELECT summary FROM executions")
+        )
+        self._db.close()
+
+
+def _release_results(executions):
+    for execution in executions:
+        descriptor = execution.result_descriptor
+        if descriptor is not None and descriptor.shared_memory:
+            release_shared_result(descriptor.path)
@@ -0,0 +1,136 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+from .libro_client import ExecutionStopped, LibroNotebookClient
+from .admission_control import LibroAdmissionController
+
+logger = logging.getLogger(__name__)
+
+
+class ExecutionQueueFull(Exception):
+    pass
+
+
+class _Slot:
+    """A queue entry holding a worker for work that is not a notebook client."""
+
+    def __init__(self):
+        loop = asyncio.get_running_loop()
+        self.acquired = loop.create_future()
+        self.released = loop.create_future()
+
+
+class LibroExecutionScheduler:
+    """Run notebook clients on a bounded number of workers.
+
+    Jobs wait in a priority queue, higher ``priority`` first and FIFO for equal
+    priorities. ``submit`` raises ``ExecutionQueueFull`` once ``max_queue_size``
+    jobs are waiting. With an ``admission`` controller a job only starts once
+    the host has room for it, and ``submit`` raises ``ExecutionRejected`` for
+    jobs that never fit.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_queue_size: int = 100,
+        admission: LibroAdmissionController | None = None,
+    ):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.admission = admission
+        self._queue: asyncio.PriorityQueue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._counter = itertools.count()
+        self.running: set[LibroNotebookClient] = set()
+
+    def _ensure_workers(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue(maxsize=self.max_queue_size)
+        self._workers = [w for w in self._workers if not w.done()]
+        while len(self._workers) < self.max_workers:
+            self._workers.append(asyncio.create_task(self._worker()))
+
+    @property
+    def queued_count(self) -> int:
+        if self._queue is None:
+            return 0
+        return self._queue.qsize()
+
+    @property
+    def full(self) -> bool:
+        return self._queue is not None and self._queue.full()
+
+    @property
+    def running_count(self) -> int:
+        return len(self.running)
+
+    def submit(self, client: LibroNotebookClient, priority: int = 0):
+        if self.admission is not None:
+            self.admission.check(client)
+        self._ensure_workers()
+        assert self._queue is not None
+        try:
+            self._queue.put_nowait((-priority, next(self._counter), client))
+        except asyncio.QueueFull:
+            raise ExecutionQueueFull(
+                f"execution queue is full ({self.max_queue_size} jobs waiting)"
+            ) from None
+        client.execution.status = "queued"
+        return client
+
+    async def async_submit(self, client: LibroNotebookClient, priority: int = 0):
+        """Like ``submit``, but wait for room in a full queue."""
+        if self.admission is not None:
+            self.admission.check(client)
+        self._ensure_workers()
+        assert self._queue is not None
+        client.execution.status = "queued"
+        await self._queue.put((-priority, next(self._counter), client))
+        return client
+
+    @contextlib.asynccontextmanager
+    async def hold(self, count: int, priority: int = 0):
+        """Hold up to ``count`` workers for the duration of the block, for
+        processes started outside of the scheduler. Yields the number of
+        workers held."""
+        count = max(min(count, self.max_workers), 1)
+        self._ensure_workers()
+        assert self._queue is not None
+        slots = [_Slot() for _ in range(count)]
+        try:
+            for slot in slots:
+                await self._queue.put((-priority, next(self._counter), slot))
+            await asyncio.gather(*(slot.acquired for slot in slots))
+            yield count
+        finally:
+            for slot in slots:
+                if not slot.released.done():
+                    slot.released.set_result(None)
+
+    async def _run(self, client: LibroNotebookClient):
+        self.running.add(client)
+        try:
+            await client.async_execute()
+        except ExecutionStopped as e:
+            logger.info("execution %s stopped: %s", client.execution.id, e)
+        except Exception:
+            logger.exception("execution %s failed", client.execution.id)
+        finally:
+            self.running.discard(client)
+
+    async def _worker(self):
+        assert self._queue is not None
+        while True:
+            _, _, client = await self._queue.get()
+            try:
+                if isinstance(client, _Slot):
+                    if not client.released.done():
+                        if not client.acquired.done():
+                            client.acquired.set_result(None)
+                        await client.released
+                elif self.admission is None or await self.admission.admit(client):
+                    await self._run(client)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,186 @@
+import ast
+import json
+import os
+import signal
+import sys
+import time
+import traceback
+
+
+class _NullSocket:
+    """Stands in for the kernel zmq sockets, which a forked child must not use."""
+
+    def send_multipart(self, *args, **kwargs):
+        pass
+
+    def send(self, *args, **kwargs):
+        pass
+
+
+def _null_send(*args, **kwargs):
+    return None
+
+
+def _detach(shell):
+    """Keep the kernel of a forked child from sending messages, its sockets
+    and sessions belong to the parent."""
+    null = _NullSocket()
+    kernel = getattr(shell, "kernel", None)
+    if kernel is not None:
+        kernel.iopub_socket = null
+    for publisher in (shell.display_pub, shell.displayhook):
+        if hasattr(publisher, "pub_socket"):
+            publisher.pub_socket = null
+    # comms, raw_input and the kernel streams send through the sessions
+    for owner in (kernel, shell.display_pub, shell.displayhook, sys.stdout, sys.stderr):
+        session = getattr(owner, "session", None)
+        if session is not None:
+            session.send = _null_send
+
+
+def _execute(shell, source: str):
+    """Execute a cell, returns the value of a trailing expression."""
+    tree = ast.parse(shell.transform_cell(source))
+    last = None
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        last = ast.Expression(tree.body.pop().value)
+    exec(compile(tree, "<cell>", "exec"), shell.user_ns)
+    if last is not None:
+        return eval(compile(last, "<cell>", "eval"), shell.user_ns)
+    return None
+
+
+def capture_cell(shell, source: str, execution_count: int) -> tuple[list[dict], bool]:
+    from IPython.utils.capture import capture_output
+
+    value = None
+    error = None
+    with capture_output() as captured:
+        try:
+            value = _execute(shell, source)
+        except BaseException as e:
+            error = e
+    outputs = []
+    for name in ("stdout", "stderr"):
+        text = getattr(captured, name)
+        if text:
+            outputs.append({"output_type": "stream", "name": name, "text": text})
+    for output in captured.outputs:
+        outputs.append(
+            {"output_type": "display_data", "data": output.data, "metadata": output.metadata}
+        )
+    if value is not None:
+        data, metadata = shell.display_formatter.format(value)
+        outputs.append(
+            {
+                "output_type": "execute_result",
+                "execution_count": execution_count,
+                "data": data,
+                "metadata": metadata,
+            }
+        )
+    if error is not None:
+        outputs.append(
+            {
+                "output_type": "error",
+                "ename": type(error).__name__,
+                "evalue": str(error),
+                "traceback": traceback.format_exception(
+                    type(error), error, error.__traceback__
+                ),
+            }
+        )
+    return outputs, error is None
+
+
+def _run_child(
+    plan_path: str, args, args_file: str | None, result_path: str | None, output_path: str
+) -> int:
+    from IPython.core.getipython import get_ipython
+
+    shell = get_ipython()
+    _detach(shell)
+    with open(plan_path, encoding="utf-8") as f:
+        plan = json.load(f)
+    user_ns = shell.user_ns  # type: ignore
+    user_ns["__libro_execute_args_dict__"] = args
+    user_ns["__libro_execute_args_file__"] = args_file
+    # nobody can interact with widgets of the child
+    user_ns["__libro_execute_headless__"] = True
+    if result_path is None:
+        user_ns.pop("__libro_execute_result__", None)
+    else:
+        user_ns["__libro_execute_result__"] = result_path
+    # a result dumped by the setup cells is not the result of this run
+    user_ns.pop("__libro_execute_result_descriptor__", None)
+    user_ns.pop("__libro_execute_result_dump_path__", None)
+    execution_count = plan["execution_count"]
+    cells = {}
+    error = ""
+    try:
+        for index, source in plan["cells"]:
+            execution_count += 1
+            outputs, ok = capture_cell(shell, source, execution_count)
+            cells[index] = {"outputs": outputs, "execution_count": execution_count}
+            if not ok and not plan["allow_errors"]:
+                error = f"cell {index} failed: {outputs[-1]['ename']}: {outputs[-1]['evalue']}"
+                break
+    finally:
+        tmp_path = output_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            result = user_ns.get("__libro_execute_result_descriptor__")
+            json.dump({"cells": cells, "error": error, "result": result}, f, default=str)
+        os.replace(tmp_path, output_path)
+    return 1 if error else 0
+
+
+def fork_child(
+    plan_path: str,
+    args,
+    result_path: str | None,
+    output_path: str,
+    args_file: str | None = None,
+) -> int:
+    """Fork the kernel and run the cells of the plan in the child, returns its pid.
+
+    The child shares the namespace of the kernel copy-on-write, runs the cells
+    with ``args`` as ``__libro_execute_args_dict__`` and ``args_file`` as the
+    file they came from, and writes the cell outputs and the descriptor of the
+    dumped result as json to ``output_path``.
+    """
+    if not hasattr(os, "fork"):
+        raise RuntimeError("forked execution needs os.fork")
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 1
+    try:
+        code = _run_child(plan_path, args, args_file, result_path, output_path)
+    finally:
+        os._exit(code)
+
+
+def wait_children(pids: list[int], timeout: float = 1.0) -> list[tuple[int, int]]:
+    """Wait up to ``timeout`` seconds for any of ``pids`` to exit.
+
+    Returns ``(pid, exit code)`` of the children that exited.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        exited = []
+        for pid in pids:
+            waited, status = os.waitpid(pid, os.WNOHANG)
+            if waited:
+                exited.append((pid, os.waitstatus_to_exitcode(status)))
+        if exited or time.monotonic() >= deadline:
+            return exited
+        time.sleep(0.02)
+
+
+def kill_children(pids: list[int]):
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ChildProcessError, ProcessLookupError):
+            pass
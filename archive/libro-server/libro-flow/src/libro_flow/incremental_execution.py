@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+from nbformat import NotebookNode
+
+
+def cell_fingerprints(nb: NotebookNode, seed: str = "") -> list[str]:
+    """Fingerprint every cell together with everything executed before it.
+
+    The fingerprint of a cell changes when its own source, the source of any
+    code cell above it or the ``seed`` (args, kernel) changes. Non-code cells
+    share the fingerprint of the code cell before them.
+    """
+    fingerprint = hashlib.sha256(seed.encode()).hexdigest()
+    fingerprints = []
+    for cell in nb.cells:
+        if cell.cell_type == "code":
+            fingerprint = hashlib.sha256(
+                f"{fingerprint}\0{cell.source}".encode()
+            ).hexdigest()
+        fingerprints.append(fingerprint)
+    return fingerprints
+
+
+class NamespaceSnapshotStore:
+    """Kernel namespace snapshots of one notebook, keyed by cell fingerprint."""
+
+    def __init__(self, snapshot_dir: str):
+        self.snapshot_dir = snapshot_dir
+        os.makedirs(snapshot_dir, exist_ok=True)
+
+    def path(self, fingerprint: str) -> str:
+        return os.path.join(self.snapshot_dir, f"{fingerprint}.pickle")
+
+    def replay_path(self, fingerprint: str) -> str:
+        return os.path.join(self.snapshot_dir, f"{fingerprint}.json")
+
+    def write_replay(self, fingerprint: str, replay: dict[str, int]):
+        """Store which cell defined each value the snapshot could not pickle."""
+        with open(self.replay_path(fingerprint), "w", encoding="utf-8") as f:
+            json.dump(replay, f)
+
+    def read_replay(self, fingerprint: str) -> dict[str, int]:
+        try:
+            with open(self.replay_path(fingerprint), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def exists(self, fingerprint: str) -> bool:
+        return os.path.exists(self.path(fingerprint))
+
+    def resume_index(self, nb: NotebookNode, fingerprints: list[str]) -> int:
+        """Index of the last code cell whose snapshot exists, -1 if none."""
+        for index in range(len(fingerprints) - 1, -1, -1):
+            if nb.cells[index].cell_type == "code" and self.exists(fingerprints[index]):
+                return index
+        return -1
+
+    def prune(self, keep: list[str]):
+        keep_names = {f"{fingerprint}.pickle" for fingerprint in keep}
+        keep_names |= {f"{fingerprint}.json" for fingerprint in keep}
+        for name in os.listdir(self.snapshot_dir):
+            if name not in keep_names:
+                os.remove(os.path.join(self.snapshot_dir, name))
@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+import gc
+import importlib
+import json
+import multiprocessing
+import platform
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+from nbclient.exceptions import CellExecutionError
+from nbformat import NotebookNode, from_dict
+from .libro_client import (
+    LibroCellProfile,
+    LibroNotebookClient,
+    LibroResultDescriptor,
+    summarize_outputs,
+)
+from .execution_checkpoint import ExecutionCheckpointer
+from .execution_record import ExecutionRecordJournal
+from .fork_execution import capture_cell
+from .output_streams import compact_stream_outputs
+from .kernel_profile import sample_memory
+
+_shell = None
+
+
+def _get_shell():
+    global _shell
+    if _shell is None:
+        from IPython.core.interactiveshell import InteractiveShell
+        from traitlets.config import Config
+
+        config = Config()
+        # workers must not fight over the history database
+        config.HistoryManager.hist_file = ":memory:"
+        _shell = InteractiveShell.instance(config=config)
+    return _shell
+
+
+def _init_worker(warm_modules: list[str]):
+    _get_shell()
+    for module in warm_modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+def run_notebook(plan: dict) -> dict:
+    """Run the cells of ``plan`` in the shell of this worker process.
+
+    The namespace is reset first, then ``plan["globals"]`` sets the
+    ``__libro_execute_*`` globals. Returns the outputs, execution count,
+    duration and memory of every executed cell and the result descriptor.
+    """
+    shell = _get_shell()
+    shell.reset(new_session=False)
+    shell.display_formatter.active_types = list(shell.display_formatter.format_types)
+    gc.collect()
+    sample_memory()
+    exec(plan["globals"], shell.user_ns)
+    cells = {}
+    error = None
+    for execution_count, (index, source) in enumerate(plan["cells"], 1):
+        start = time.monotonic()
+        outputs, ok = capture_cell(shell, source, execution_count)
+        cells[index] = {
+            "outputs": outputs,
+            "execution_count": execution_count,
+            "execution_time": time.monotonic() - start,
+            "memory": sample_memory() if plan["profile_memory"] else (0, 0),
+        }
+        if not ok and not plan["allow_errors"]:
+            error = index
+            break
+    return {
+        "cells": cells,
+        "error": error,
+        "descriptor": shell.user_ns.get("__libro_execute_result_descriptor__"),
+    }
+
+
+class LibroInProcessExecutor:
+    """Process pool running notebooks in an embedded ``InteractiveShell``.
+
+    Every worker keeps its shell across runs and resets its namespace before
+    each one. There is no kernel: cells run with ``exec`` outside of the
+    messaging protocol, outputs are captured per cell (stream before display
+    output), widgets are not live and a hung cell keeps its worker busy.
+    Only use it for trusted pure Python notebooks.
+    """
+
+    def __init__(self, max_workers: int = 2, warm_modules: list[str] | None = None):
+        self.max_workers = max_workers
+        self.warm_modules = warm_modules or []
+        self._pool: ProcessPoolExecutor | None = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn, forking the server with its threads is not safe
+            self._pool = ProcessPoolExecutor(
+                self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.warm_modules,),
+            )
+        return self._pool
+
+    async def run(self, plan: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, run_notebook, plan)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+_default_executor: LibroInProcessExecutor | None = None
+
+
+def get_inprocess_executor() -> LibroInProcessExecutor:
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = LibroInProcessExecutor()
+    return _default_executor
+
+
+class LibroInProcessNotebookClient(LibroNotebookClient):
+    """Run a notebook on a ``LibroInProcessExecutor`` instead of a kernel.
+
+    Status, events, record and result work as for a kernel run, but cells
+    are reported once the whole notebook ran. Kernel pools, incremental and
+    parallel execution do not apply.
+    """
+
+    def __init__(
+        self,
+        nb: NotebookNode,
+        executor: LibroInProcessExecutor | None = None,
+        **kw: Any,
+    ):
+        kw.pop("kernel_pool", None)
+        super().__init__(nb=nb, **kw)
+        self.executor = executor or get_inprocess_executor()
+
+    async def _async_execute_notebook(
+        self, reset_kc: bool = False, **kwargs: Any
+    ) -> NotebookNode:
+        self.reset_execution_trackers()
+        self._inline_output_bytes = 0
+        self.nb.metadata["language_info"] = {
+            "name": "python",
+            "version": platform.python_version(),
+            "mimetype": "text/x-python",
+            "file_extension": ".py",
+        }
+        self.start_time = datetime.datetime.now(datetime.timezone.utc)
+        self.execution.start_time = self.start_time.isoformat()
+        self.nb.metadata["libro_execute_start_time"] = self.start_time.isoformat()
+        if self.execute_result_path is not None:
+            self.execution.execute_result_path = self.execute_result_path
+        if self.execute_record_path is not None:
+            self.execution.execute_record_path = self.execute_record_path
+            self.checkpointer = ExecutionCheckpointer(
+                ExecutionRecordJournal(self.execute_record_path, self.record_compression),
+                interval=self.checkpoint_interval,
+                max_cells=self.checkpoint_cells,
+            )
+            await self.checkpointer.start(self.nb)
+        self.execution.cell_count = len(self.nb.cells)
+        code_cells = [
+            (index, cell.source)
+            for index, cell in enumerate(self.nb.cells)
+            if cell.cell_type == "code" and cell.source.strip()
+        ]
+        result = await self.executor.run(
+            {
+                "globals": self._globals_code(),
+                "cells": code_cells,
+                "allow_errors": self.allow_errors and not self.force_raise_errors,
+                "profile_memory": self.profile_memory,
+            }
+        )
+        for index, cell_result in sorted(result["cells"].items()):
+            cell = self.nb.cells[index]
+            self._apply_cell(index, cell, cell_result)
+            if index == result["error"]:
+                raise CellExecutionError.from_cell_and_msg(cell, cell.outputs[-1])
+        if result["descriptor"]:
+            descriptor = LibroResultDescriptor(**result["descriptor"])
+            self.execution.result_descriptor = descriptor
+            self.execution.execute_result_path = descriptor.path
+        self.end_time = datetime.datetime.now(datetime.timezone.utc)
+        self.execution.end_time = self.end_time.isoformat()
+        self.nb.metadata["libro_execute_end_time"] = self.end_time.isoformat()
+        return self.nb
+
+    def _apply_cell(self, index: int, cell: NotebookNode, cell_result: dict):
+        self.events.emit("cell_start", index=index, cell_type=cell.cell_type)
+        outputs = compact_stream_outputs(
+            self._filter_outputs(cell_result["outputs"]), self.stream_line_limit
+        )
+        cell.outputs = [from_dict(output) for output in outputs]
+        cell.execution_count = cell_result["execution_count"]
+        self.code_cells_executed += 1
+        profile = LibroCellProfile(
+            index=index,
+            execution_time=cell_result["execution_time"],
+            output_bytes=len(json.dumps(cell_result["outputs"], default=str)),
+        )
+        profile.rss, profile.peak_rss = cell_result["memory"]
+        cell.metadata["libro_profile"] = profile.model_dump(exclude={"index"})
+        self.execution.cell_profiles.append(profile)
+        if cell.outputs:
+            self._externalize_outputs(cell)
+        self.events.emit("cell_end", index=index, execution_count=cell.execution_count)
+        if cell.outputs:
+            self.events.emit("output", index=index, outputs=summarize_outputs(cell.outputs))
+        self.execution.current_index = index
+        self.execution.code_cells_executed = self.code_cells_executed
+        if self.checkpointer is not None:
+            self.checkpointer.mark_cell(index, cell)
@@ -0,0 +1,26 @@
+import os
+
+
+def kernel_module(name: str) -> str:
+    """Expression evaluating to the libro_flow module ``name`` inside a kernel.
+
+    The module file is run by path and cached in ``sys.modules``, so that the
+    kernel does not pay for importing the whole libro_flow package. Such
+    modules only use the standard library.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{name}.py")
+    key = f"_libro_{name}"
+    return (
+        f"(__import__('sys').modules.get({key!r}) or "
+        f"__import__('sys').modules.setdefault({key!r}, "
+        "__import__('types').SimpleNamespace("
+        f"**__import__('runpy').run_path({path!r}))))"
+    )
+
+
+SNAPSHOT_MODULE = kernel_module("namespace_snapshot")
+PROFILE_MODULE = kernel_module("kernel_profile")
+FORK_MODULE = kernel_module("fork_execution")
+ARGS_MODULE = kernel_module("args_transport")
+OUTPUT_MODULE = kernel_module("output_filter")
+STREAM_MODULE = kernel_module("output_streams")
@@ -0,0 +1,182 @@
+import ast
+import asyncio
+import logging
+from jupyter_client.manager import AsyncKernelManager
+from .kernel_module import PROFILE_MODULE
+
+logger = logging.getLogger(__name__)
+
+_RESET_CODE = (
+    "get_ipython().run_line_magic('reset', '-f')\n"
+    # undo the output_mime_types and stream_flush_interval of the previous run
+    "(lambda f: setattr(f, 'active_types', list(f.format_types)))"
+    "(get_ipython().display_formatter)\n"
+    "[vars(s).pop('flush_interval', None) for s in "
+    "(__import__('sys').stdout, __import__('sys').stderr)]\n"
+    "__import__('gc').collect()\n"
+)
+
+
+class LibroKernelPool:
+    """Keep ``size`` started kernels ready for every kernel name in use.
+
+    ``acquire`` hands out an idle kernel (or starts one when the pool is empty)
+    and refills the pool in the background. Kernels are not shared: by default
+    ``release`` shuts the borrowed kernel down.
+
+    With ``reuse`` a released kernel gets its namespace reset and goes back to
+    the pool instead, ``size`` then counts borrowed kernels too. A kernel is
+    recycled after ``max_runs`` executions or when its rss after the reset
+    exceeds ``max_rss`` bytes. ``warm_modules`` are imported into every new
+    kernel so that notebooks importing them do not pay for it; the clients
+    inject the ``__libro_execute_*`` globals again for every run.
+    """
+
+    def __init__(
+        self,
+        size: int = 2,
+        kernel_manager_class=AsyncKernelManager,
+        reuse: bool = False,
+        max_runs: int = 50,
+        max_rss: int = 2 * 1024**3,
+        warm_modules: list[str] | None = None,
+        reset_timeout: float = 30.0,
+        **km_kwargs,
+    ):
+        self.size = size
+        self.kernel_manager_class = kernel_manager_class
+        self.reuse = reuse
+        self.max_runs = max_runs
+        self.max_rss = max_rss
+        self.warm_modules = warm_modules or []
+        self.reset_timeout = reset_timeout
+        self.km_kwargs = km_kwargs
+        self._idle: dict[str, list[AsyncKernelManager]] = {}
+        self._starting: dict[str, int] = {}
+        self._tasks: set[asyncio.Task] = set()
+        # borrowed kernel -> kernel name, and executions per reused kernel
+        self._borrowed: dict[AsyncKernelManager, str] = {}
+        self._runs: dict[AsyncKernelManager, int] = {}
+
+    async def _start_kernel(self, kernel_name: str) -> AsyncKernelManager:
+        if kernel_name:
+            km = self.kernel_manager_class(kernel_name=kernel_name, **self.km_kwargs)
+        else:
+            km = self.kernel_manager_class(**self.km_kwargs)
+        await km.start_kernel()
+        if self.warm_modules:
+            try:
+                await self._execute(km, self._warm_code())
+            except Exception:
+                logger.warning("failed to import warm modules in %s", km.kernel_id)
+        return km
+
+    def _warm_code(self) -> str:
+        return "".join(
+            f"__import__('importlib').import_module({module!r})\n"
+            for module in self.warm_modules
+        )
+
+    async def _execute(self, km: AsyncKernelManager, code: str, **expressions: str) -> dict:
+        """Run ``code`` silently in ``km``, returns the evaluated ``expressions``."""
+        kc = km.client()
+        kc.start_channels()
+        try:
+            await kc.wait_for_ready(timeout=self.reset_timeout)
+            reply = await kc.execute_interactive(
+                code,
+                silent=True,
+                store_history=False,
+                user_expressions=expressions,
+                timeout=self.reset_timeout,
+                output_hook=lambda msg: None,
+            )
+        finally:
+            kc.stop_channels()
+        content = reply["content"]
+        if content["status"] != "ok":
+            raise RuntimeError(f"{content.get('ename')}: {content.get('evalue')}")
+        return content.get("user_expressions", {})
+
+    def _pooled_count(self, kernel_name: str) -> int:
+        count = len(self._idle.get(kernel_name, [])) + self._starting.get(kernel_name, 0)
+        if self.reuse:
+            count += sum(1 for name in self._borrowed.values() if name == kernel_name)
+        return count
+
+    async def _replenish(self, kernel_name: str):
+        idle = self._idle.setdefault(kernel_name, [])
+        while self._pooled_count(kernel_name) < self.size:
+            self._starting[kernel_name] = self._starting.get(kernel_name, 0) + 1
+            try:
+                km = await self._start_kernel(kernel_name)
+            except Exception:
+                logger.exception("failed to start pooled kernel %r", kernel_name)
+                return
+            finally:
+                self._starting[kernel_name] -= 1
+            idle.append(km)
+
+    def prewarm(self, kernel_name: str = ""):
+        task = asyncio.create_task(self._replenish(kernel_name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def acquire(self, kernel_name: str = "") -> AsyncKernelManager:
+        idle = self._idle.setdefault(kernel_name, [])
+        km = None
+        while idle:
+            candidate = idle.pop(0)
+            if await candidate.is_alive():
+                km = candidate
+                break
+            await self._discard(candidate)
+        if km is None:
+            km = await self._start_kernel(kernel_name)
+        self._borrowed[km] = kernel_name
+        self.prewarm(kernel_name)
+        return km
+
+    async def release(self, km: AsyncKernelManager):
+        kernel_name = self._borrowed.pop(km, None)
+        runs = self._runs.pop(km, 0) + 1
+        if not self.reuse or kernel_name is None:
+            await self._discard(km)
+            return
+        if runs >= self.max_runs or self._pooled_count(kernel_name) >= self.size:
+            await self._discard(km)
+            self.prewarm(kernel_name)
+            return
+        try:
+            if not await km.is_alive():
+                raise RuntimeError("kernel died")
+            expressions = await self._execute(
+                km, _RESET_CODE, memory=f"{PROFILE_MODULE}.sample_memory()"
+            )
+            rss, _ = ast.literal_eval(expressions["memory"]["data"]["text/plain"])
+        except Exception as e:
+            logger.warning("failed to reset kernel %s: %s", km.kernel_id, e)
+            await self._discard(km)
+            self.prewarm(kernel_name)
+            return
+        if rss > self.max_rss:
+            logger.info("recycling kernel %s using %d bytes", km.kernel_id, rss)
+            await self._discard(km)
+            self.prewarm(kernel_name)
+            return
+        self._runs[km] = runs
+        self._idle.setdefault(kernel_name, []).append(km)
+
+    async def _discard(self, km: AsyncKernelManager):
+        self._runs.pop(km, None)
+        try:
+            await km.shutdown_kernel(now=True)
+        except Exception:
+            logger.warning("failed to shutdown pooled kernel %s", km.kernel_id)
+
+    async def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+        for idle in self._idle.values():
+            while idle:
+                await self._discard(idle.pop())
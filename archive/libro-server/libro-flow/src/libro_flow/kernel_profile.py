@@ -0,0 +1,73 @@
+import sys
+
+# sample of the last cell, sent with the metadata of its execute_reply
+_cell_sample: tuple[int, int] | None = None
+
+
+def sample_memory() -> tuple[int, int]:
+    """Return ``(rss, peak_rss)`` of the kernel process in bytes.
+
+    On Linux the peak is reset after every sample, so it is the peak since the
+    previous sample. Elsewhere it is the peak of the process and rss is 0.
+    """
+    try:
+        with open("/proc/self/status", encoding="utf-8") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        rss = int(status["VmRSS"].split()[0]) * 1024
+        peak = int(status["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        try:
+            import resource
+        except ImportError:
+            return 0, 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes elsewhere
+        return 0, peak if sys.platform == "darwin" else peak * 1024
+    try:
+        # 5 resets the peak resident set size of the process
+        with open("/proc/self/clear_refs", "w", encoding="utf-8") as f:
+            f.write("5")
+    except OSError:
+        pass
+    return rss, peak
+
+
+def install_memory_hook():
+    """Sample the memory after every cell and send the sample along with the
+    metadata of the cell's execute_reply, as ``libro_memory``."""
+    from IPython.core.getipython import get_ipython
+
+    ipython = get_ipython()
+    kernel = getattr(ipython, "kernel", None)
+    if kernel is None or getattr(kernel, "_libro_memory_hook", False):
+        return
+
+    def post_run_cell(result):
+        global _cell_sample
+        _cell_sample = sample_memory()
+
+    finish_metadata = kernel.finish_metadata
+
+    def finish_metadata_with_memory(parent, metadata, reply_content):
+        global _cell_sample
+        metadata = finish_metadata(parent, metadata, reply_content)
+        if _cell_sample is not None:
+            metadata["libro_memory"] = list(_cell_sample)
+            _cell_sample = None
+        return metadata
+
+    ipython.events.register("post_run_cell", post_run_cell)  # type: ignore
+    kernel.finish_metadata = finish_metadata_with_memory
+    kernel._libro_memory_hook = True
+
+
+def process_memory(pid: int) -> int:
+    """Return the rss of process ``pid`` in bytes, 0 when it cannot be read."""
+    try:
+        with open(f"/proc/{pid}/status", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
@@ -1,13 +1,37 @@
 from uuid import uuid4, UUID
+import ast
+import asyncio
+import time
 from nbclient import NotebookClient
 from nbclient.util import ensure_async, run_sync
-import nbformat
 import datetime
 from nbformat import NotebookNode
 from typing import Any, Optional
 import json
+import os
+import tempfile
 from pydantic import BaseModel, Field
-from traitlets import Callable
+from textwrap import dedent
+from traitlets import Bool, Callable, Float, Integer, List, Unicode
+from .kernel_pool import LibroKernelPool
+from .execution_record import ExecutionRecordJournal, read_execution_record
+from .execution_checkpoint import ExecutionCheckpointer
+from .execution_events import ExecutionEventLog
+from .incremental_execution import NamespaceSnapshotStore, cell_fingerprints
+from .parallel_execution import ParallelCellExecutor
+from .kernel_module import (
+    ARGS_MODULE,
+    OUTPUT_MODULE,
+    PROFILE_MODULE,
+    SNAPSHOT_MODULE,
+    STREAM_MODULE,
+)
+from .args_transport import dump_args, inline_args
+from .result_format import own_shared_result, shared_memory_dir, shared_memory_name
+from .output_store import OutputBlobStore, externalize_outputs
+from .output_filter import filter_mime_bundle
+from .output_streams import StreamBuffer, cap_stream_text, dropped_lines_note
+from .kernel_profile import process_memory
 
 
 def cellStartExecution(cell, **kwargs):
@@ -16,8 +40,60 @@ def cellStartExecution(cell, **kwargs):
     ).isoformat()
 
 
+def summarize_outputs(outputs: list) -> list[dict]:
+    summary = []
+    for output in outputs:
+        item = {"output_type": output.get("output_type")}
+        if "name" in output:
+            item["name"] = output["name"]
+        if "data" in output:
+            item["mime_types"] = list(output["data"].keys())
+        if "ename" in output:
+            item["ename"] = output["ename"]
+        summary.append(item)
+    return summary
+
+
+def _parse_timestamp(value: str | None) -> datetime.datetime | None:
+    if not value:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value.rstrip("Z")).replace(
+            tzinfo=datetime.timezone.utc
+        )
+    except ValueError:
+        return None
+
+
+class ExecutionStopped(Exception):
+    """The execution was cancelled or exceeded one of its limits."""
+
+
+class LibroCellProfile(BaseModel):
+    index: int
+    # seconds between sending the cell and the kernel starting it
+    queue_time: float = 0.0
+    execution_time: float = 0.0
+    output_bytes: int = 0
+    # kernel memory in bytes after the cell and the peak while it ran,
+    # 0 when the kernel cannot tell
+    rss: int = 0
+    peak_rss: int = 0
+
+
+class LibroResultDescriptor(BaseModel):
+    path: str
+    format: str = ""
+    size: int = 0
+    # POSIX shared memory segment name when the result lives in /dev/shm
+    shared_memory: str = ""
+
+
 class LibroExecution(BaseModel):
     id: UUID = Field(default_factory=uuid4)
+    # created -> queued -> running -> finished | failed | cancelled
+    status: str = "created"
+    error: str = ""
     current_index: int = 0
     cell_count: int = 0
     code_cells_executed: int = 0
@@ -25,6 +101,20 @@ class LibroExecution(BaseModel):
     end_time: str = ""
     execute_result_path: str = ""
     execute_record_path: str = ""
+    # last cell index persisted to the record and seconds the oldest
+    # unpersisted change has been waiting
+    checkpoint_index: int = -1
+    checkpoint_lag: float = 0.0
+    # the record was served from LibroExecutionCache instead of a kernel
+    cached: bool = False
+    # cells not executed because incremental mode restored their state
+    skipped_cells: list[int] = []
+    cell_profiles: list[LibroCellProfile] = []
+    result_descriptor: LibroResultDescriptor | None = None
+    # outputs replaced by a stub and moved to the blob store
+    externalized_outputs: int = 0
+    # worker that ran a distributed execution
+    worker: str = ""
 
 
 class LibroNotebookClient(NotebookClient):
@@ -37,15 +127,44 @@ class LibroNotebookClient(NotebookClient):
         args: dict | None = None,
         execute_result_path: str | None = None,
         execute_record_path: str | None = None,
+        kernel_pool: LibroKernelPool | None = None,
         **kw,
     ):
         super().__init__(nb=nb, km=km, **kw)
+        self.kernel_pool = kernel_pool
+        self.checkpointer: ExecutionCheckpointer | None = None
+        self._done_callbacks: list = []
+        self.events = ExecutionEventLog()
+        self.snapshot_store: NamespaceSnapshotStore | None = None
+        self._fingerprints: list[str] = []
+        self._previous_outputs: dict[str, NotebookNode] = {}
+        self._unpicklable: dict[str, tuple[int, int]] = {}
+        self.blob_store: OutputBlobStore | None = None
+        self._inline_output_bytes = 0
+        self._task: asyncio.Future | None = None
+        self._stop_reason: str | None = None
+        self._ended: asyncio.Event | None = None
+        # index and start (monotonic time, kernel rss) of the running cell
+        self._running_cell: tuple[int, float, int] | None = None
+        # last stream output, while stream messages are merged into it
+        self._stream_buffer: StreamBuffer | None = None
+        # (rss, peak rss) the kernel sent with the last execute_reply
+        self._reply_memory: list[int] | None = None
         if isinstance(args, dict):
-            self.args = json.dumps(args)
+            self.args = json.dumps(args, default=str)
+            self.args_value = args
         else:
             self.args = args
+            try:
+                self.args_value = json.loads(args) if args is not None else None
+            except ValueError:
+                # not json, injected as the python source it is
+                self.args_value = args
+        self._args_file: str | None = None
         self.execute_result_path = execute_result_path
         self.execute_record_path = execute_record_path
+        # file the notebook was loaded from, if any
+        self.notebook_path: str | None = None
         self.start_time = None
         self.end_time = None
 
@@ -54,6 +173,239 @@ class LibroNotebookClient(NotebookClient):
         allow_none=True,
     ).tag(config=True)
 
+    checkpoint_interval = Float(
+        default_value=1.0,
+        help="Max seconds between two execution record checkpoints.",
+    ).tag(config=True)
+
+    checkpoint_cells = Integer(
+        default_value=10,
+        help="Checkpoint the execution record once this many cells changed.",
+    ).tag(config=True)
+
+    incremental = Bool(
+        default_value=False,
+        help=dedent(
+            """
+            Snapshot the kernel namespace after every code cell and, on the next
+            run, restore the snapshot of the longest unchanged prefix and only
+            execute the cells after it.
+            """
+        ),
+    ).tag(config=True)
+
+    snapshot_dir = Unicode(
+        default_value=None,
+        allow_none=True,
+        help=dedent(
+            """
+            Directory for the namespace snapshots of this notebook, defaults to
+            ``<execute_record_path>.snapshots``. Snapshots of other runs in it
+            are removed.
+            """
+        ),
+    ).tag(config=True)
+
+    shared_result = Bool(
+        default_value=False,
+        help=dedent(
+            """
+            Without an execute_result_path, dump the result into a shared memory
+            segment instead of a temporary file. The segment is removed when
+            the execution is evicted from the registry.
+            """
+        ),
+    ).tag(config=True)
+
+    profile_memory = Bool(
+        default_value=True,
+        help=dedent(
+            """
+            Sample the kernel memory after every code cell for the cell profile,
+            a post_run_cell hook of the kernel sends it with the execute_reply.
+            """
+        ),
+    ).tag(config=True)
+
+    args_inline_limit = Integer(
+        default_value=64 * 1024,
+        help=dedent(
+            """
+            Args that are json data of up to this many bytes are injected as a
+            python literal. Larger or non-json args are written to a msgpack
+            (or pickle) file, loaded on first access.
+            """
+        ),
+    ).tag(config=True)
+
+    record_compression = Unicode(
+        default_value=None,
+        allow_none=True,
+        help=dedent(
+            """
+            Compress the finished execution record, "gzip" or "zstd" (needs
+            zstandard). The record is then written to execute_record_path plus
+            ".gz" or ".zst"; read_execution_record finds it either way.
+            """
+        ),
+    ).tag(config=True)
+
+    cell_output_limit = Integer(
+        default_value=2 * 1024**2,
+        help="Bytes of outputs a cell keeps in the record, larger outputs become blobs.",
+    ).tag(config=True)
+
+    run_output_limit = Integer(
+        default_value=20 * 1024**2,
+        help="Bytes of outputs the whole run keeps in the record.",
+    ).tag(config=True)
+
+    blob_dir = Unicode(
+        default_value=None,
+        allow_none=True,
+        help=dedent(
+            """
+            Content-addressed store for outputs over the output limits, defaults
+            to ``.blobs`` in the directory of execute_record_path. Without
+            either, outputs are never externalized.
+            """
+        ),
+    ).tag(config=True)
+
+    headless = Bool(
+        default_value=False,
+        help=dedent(
+            """
+            Batch run nobody watches: notebook_args only sets the args, without
+            its form widget and schema display, and widget messages and views
+            are dropped instead of being kept in the record.
+            """
+        ),
+    ).tag(config=True)
+
+    output_mime_types = List(
+        Unicode(),
+        default_value=None,
+        allow_none=True,
+        help=dedent(
+            """
+            Mime types (or patterns like ``image/*``) of rich outputs to keep,
+            None for all. The kernel does not even compute the others, and
+            outputs left without data are dropped.
+            """
+        ),
+    ).tag(config=True)
+
+    merge_streams = Bool(
+        default_value=True,
+        help=dedent(
+            """
+            Merge consecutive stream messages of a cell into one output as
+            they arrive, with carriage returns and backspaces applied. Unlike
+            ``coalesce_streams`` it keeps the order of stdout, stderr and
+            other outputs.
+            """
+        ),
+    ).tag(config=True)
+
+    stream_line_limit = Integer(
+        default_value=0,
+        help=dedent(
+            """
+            Keep only the last this many lines of every stream output, with a
+            note of how many were dropped. 0 keeps all lines.
+            """
+        ),
+    ).tag(config=True)
+
+    stream_flush_interval = Float(
+        default_value=None,
+        allow_none=True,
+        help=dedent(
+            """
+            Seconds the kernel collects stdout and stderr before sending them,
+            None keeps its default (0.2 for ipykernel). Chatty cells then send
+            fewer and bigger stream messages.
+            """
+        ),
+    ).tag(config=True)
+
+    run_timeout = Float(
+        default_value=None,
+        allow_none=True,
+        help="Stop the run after this many seconds.",
+    ).tag(config=True)
+
+    cell_timeout = Float(
+        default_value=None,
+        allow_none=True,
+        help=dedent(
+            """
+            Stop the run once a cell ran for this many seconds. Unlike
+            ``timeout`` the kernel is interrupted and, if need be, killed.
+            """
+        ),
+    ).tag(config=True)
+
+    memory_limit = Integer(
+        default_value=0,
+        help="Stop the run once the kernel rss exceeds this many bytes, 0 for no limit.",
+    ).tag(config=True)
+
+    cell_memory_limit = Integer(
+        default_value=0,
+        help="Stop the run once a cell grew the kernel rss by this many bytes.",
+    ).tag(config=True)
+
+    watchdog_interval = Float(
+        default_value=0.5,
+        help="Seconds between two checks of the run limits.",
+    ).tag(config=True)
+
+    interrupt_timeout = Float(
+        default_value=5.0,
+        help=dedent(
+            """
+            Seconds a stopped run gets to end after interrupting the kernel,
+            and again after killing it, before its task is cancelled.
+            """
+        ),
+    ).tag(config=True)
+
+    parallel_kernels = Integer(
+        default_value=1,
+        help=dedent(
+            """
+            Run independent cells concurrently on up to this many kernels. The
+            cell dependency graph comes from the names every cell defines and
+            uses, values are moved between kernels by pickling them. Ignored
+            in incremental mode.
+            """
+        ),
+    ).tag(config=True)
+
+    async def async_eval_in_kernel(self, expression: str) -> str | None:
+        """Evaluate ``expression`` in the kernel and return its ``text/plain`` repr."""
+        assert self.kc is not None
+        msg_id = await ensure_async(
+            self.kc.execute(
+                "",
+                silent=True,
+                store_history=False,
+                user_expressions={"result": expression},
+            )
+        )
+        reply = await self.async_wait_for_reply(msg_id)
+        if reply is None:
+            return None
+        result = reply["content"].get("user_expressions", {}).get("result", {})
+        if result.get("status") != "ok":
+            raise RuntimeError(
+                f"{expression} failed in kernel: "
+                f"{result.get('ename')}: {result.get('evalue')}"
+            )
+        return result["data"]["text/plain"]
+
     async def inspect_execution_result(self):
         assert self.kc is not None
         cell_allows_errors = (not self.force_raise_errors) and (self.allow_errors)
@@ -72,6 +424,9 @@ class LibroNotebookClient(NotebookClient):
 
     def get_status(self):
         status = self.execution
+        if self.checkpointer is not None:
+            status.checkpoint_index = self.checkpointer.checkpoint_index
+            status.checkpoint_lag = self.checkpointer.lag
         return status
 
     def update_execution(self):
@@ -79,10 +434,565 @@ class LibroNotebookClient(NotebookClient):
 
     async def async_execute(
         self, reset_kc: bool = False, **kwargs: Any
+    ) -> NotebookNode:
+        if self._stop_reason is not None:
+            # cancelled while queued
+            return self.nb
+        self.execution.status = "running"
+        self._ended = asyncio.Event()
+        borrowed = self.km is None and self.kernel_pool is not None
+        watchdog = None
+        try:
+            if borrowed:
+                await self._async_borrow_kernel()
+            self._task = asyncio.ensure_future(
+                self._async_execute_notebook(reset_kc=reset_kc, **kwargs)
+            )
+            if (
+                self.run_timeout
+                or self.cell_timeout
+                or self.memory_limit
+                or self.cell_memory_limit
+            ):
+                watchdog = asyncio.create_task(self._async_watch())
+            try:
+                nb = await self._task
+            except asyncio.CancelledError:
+                if self._stop_reason is None or not self._task.cancelled():
+                    raise
+                raise ExecutionStopped(self._stop_reason) from None
+            except Exception as e:
+                # the interrupted or killed cell failed
+                if self._stop_reason is None or isinstance(e, ExecutionStopped):
+                    raise
+                raise ExecutionStopped(self._stop_reason) from e
+        except BaseException as e:
+            self.execution.error = self._stop_reason or str(e) or type(e).__name__
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            self._running_cell = None
+            await self._async_finish_record()
+            self._remove_args_file()
+            if borrowed:
+                await self._async_return_kernel()
+            if self._stop_reason == "cancelled":
+                self.execution.status = "cancelled"
+            else:
+                self.execution.status = "failed" if self.execution.error else "finished"
+            self.events.emit("complete", execution=self.get_status().model_dump(mode="json"))
+            self.events.close()
+            self._ended.set()
+            self._run_done_callbacks()
+        return nb
+
+    async def async_cancel(self, reason: str = "cancelled"):
+        """Stop the execution and wait until it ended.
+
+        A queued execution never starts. A running one stops before its next
+        cell; the running cell is interrupted, and when the kernel does not
+        react within ``interrupt_timeout`` seconds it is killed. The status
+        becomes cancelled, or failed with ``reason`` as error for any other
+        reason.
+        """
+        if self.execution.status in ("finished", "failed", "cancelled"):
+            return
+        if self._task is None:
+            self._stop_reason = reason
+            self.execution.status = "cancelled" if reason == "cancelled" else "failed"
+            self.execution.error = reason
+            self.events.emit("complete", execution=self.get_status().model_dump(mode="json"))
+            self.events.close()
+            self._run_done_callbacks()
+            return
+        await self._async_stop(reason)
+        if self._ended is not None:
+            await self._ended.wait()
+
+    async def _async_stop(self, reason: str):
+        task = self._task
+        assert task is not None
+        if self._stop_reason is None:
+            self._stop_reason = reason
+            self.log.info("stopping execution %s: %s", self.execution.id, reason)
+        steps = []
+        if self.km is not None:
+            steps = [self.km.interrupt_kernel, lambda: self.km.shutdown_kernel(now=True)]
+        for step in steps:
+            if task.done():
+                return
+            try:
+                await ensure_async(step())
+            except Exception as e:
+                self.log.warning("failed to stop kernel of %s: %s", self.execution.id, e)
+            await asyncio.wait([task], timeout=self.interrupt_timeout)
+        if not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+
+    def kernel_rss(self) -> int:
+        """Current rss of the local kernel process, 0 when unknown."""
+        process = getattr(getattr(self.km, "provisioner", None), "process", None)
+        return process_memory(process.pid) if process is not None else 0
+
+    async def _async_watch(self):
+        """Stop the run once it exceeds one of its limits."""
+        start = time.monotonic()
+        while self._task is not None and not self._task.done():
+            await asyncio.sleep(self.watchdog_interval)
+            now = time.monotonic()
+            rss = 0
+            if self.memory_limit or self.cell_memory_limit:
+                rss = self.kernel_rss()
+            running = self._running_cell
+            if running is not None and running[2] == 0 and rss:
+                running = self._running_cell = (running[0], running[1], rss)
+            reason = None
+            if self.run_timeout and now - start > self.run_timeout:
+                reason = f"run exceeded its timeout of {self.run_timeout}s"
+            elif self.memory_limit and rss > self.memory_limit:
+                reason = f"kernel exceeded its memory limit with {rss} bytes"
+            elif running is not None:
+                index, cell_start, cell_rss = running
+                if self.cell_timeout and now - cell_start > self.cell_timeout:
+                    reason = f"cell {index} exceeded its timeout of {self.cell_timeout}s"
+                elif (
+                    self.cell_memory_limit
+                    and cell_rss
+                    and rss - cell_rss > self.cell_memory_limit
+                ):
+                    reason = f"cell {index} grew the kernel by {rss - cell_rss} bytes"
+            if reason is not None:
+                await self._async_stop(reason)
+                return
+
+    async def _async_prepare_incremental(self) -> int:
+        """Restore the longest unchanged prefix, returns its last cell index."""
+        snapshot_dir = self.snapshot_dir
+        if snapshot_dir is None and self.execute_record_path is not None:
+            snapshot_dir = self.execute_record_path + ".snapshots"
+        if snapshot_dir is None:
+            self.log.warning("incremental execution needs a snapshot_dir")
+            return -1
+        self.snapshot_store = NamespaceSnapshotStore(snapshot_dir)
+        self._fingerprints = cell_fingerprints(
+            self.nb, f"{self.kernel_name}\0{self.args}"
+        )
+        for cell, fingerprint in zip(self.nb.cells, self._fingerprints):
+            cell.metadata["libro_fingerprint"] = fingerprint
+        self._previous_outputs = self._read_previous_outputs()
+        resume_index = self.snapshot_store.resume_index(self.nb, self._fingerprints)
+        if resume_index < 0:
+            return -1
+        fingerprint = self._fingerprints[resume_index]
+        path = self.snapshot_store.path(fingerprint)
+        replay = self.snapshot_store.read_replay(fingerprint)
+        try:
+            await self.async_eval_in_kernel(f"{SNAPSHOT_MODULE}.restore_namespace({path!r})")
+            replay_cells = sorted(set(replay.values()))
+            # values that could not be pickled are recreated by their cells,
+            # then the snapshot is restored again on top of what they changed
+            for index in replay_cells:
+                await self.async_execute_cell(self.nb.cells[index], index)
+            if replay_cells:
+                await self.async_eval_in_kernel(
+                    f"{SNAPSHOT_MODULE}.restore_namespace({path!r})"
+                )
+        except Exception:
+            self.log.warning("failed to restore namespace snapshot %s", path, exc_info=True)
+            await self.async_eval_in_kernel("get_ipython().reset(new_session=False)")
+            await self._async_inject_globals()
+            return -1
+        await self._async_snapshot_namespace(resume_index, defined_in=replay)
+        return resume_index
+
+    def _read_previous_outputs(self) -> dict[str, NotebookNode]:
+        if self.execute_record_path is None:
+            return {}
+        try:
+            previous = read_execution_record(self.execute_record_path)
+        except (OSError, ValueError):
+            return {}
+        return {
+            cell.metadata["libro_fingerprint"]: cell
+            for cell in previous.cells
+            if "libro_fingerprint" in cell.metadata
+        }
+
+    def _skip_cell(self, index: int, cell: NotebookNode):
+        previous = self._previous_outputs.get(self._fingerprints[index])
+        if previous is not None and cell.cell_type == "code":
+            cell.outputs = previous.get("outputs", [])
+            cell.execution_count = previous.get("execution_count")
+        cell.metadata["libro_skipped"] = True
+        self.execution.skipped_cells.append(index)
+        self.execution.current_index = index
+        self.events.emit("cell_skipped", index=index)
+        if self.checkpointer is not None:
+            self.checkpointer.mark_cell(index, cell)
+
+    async def _async_snapshot_namespace(
+        self, index: int, defined_in: dict[str, int] | None = None
+    ):
+        """Snapshot the namespace after cell ``index``.
+
+        Values that cannot be pickled are tracked by object id, the cell that
+        last rebound them is stored next to the snapshot to be replayed.
+        """
+        assert self.snapshot_store is not None
+        fingerprint = self._fingerprints[index]
+        path = self.snapshot_store.path(fingerprint)
+        try:
+            skipped = await self.async_eval_in_kernel(
+                f"{SNAPSHOT_MODULE}.snapshot_namespace({path!r})"
+            )
+        except RuntimeError:
+            self.log.warning("failed to snapshot namespace after cell %s", index)
+            return
+        skipped = ast.literal_eval(skipped) if skipped else {}
+        unpicklable = {}
+        for name, value_id in skipped.items():
+            previous = self._unpicklable.get(name)
+            if previous is not None and previous[0] == value_id:
+                unpicklable[name] = previous
+            elif defined_in is not None and name in defined_in:
+                unpicklable[name] = (value_id, defined_in[name])
+            else:
+                unpicklable[name] = (value_id, index)
+        self._unpicklable = unpicklable
+        self.snapshot_store.write_replay(
+            fingerprint, {name: cell for name, (_, cell) in unpicklable.items()}
+        )
+
+    async def _async_inject_globals(self):
+        assert self.kc is not None
+        cell_allows_errors = (not self.force_raise_errors) and (self.allow_errors)
+        await ensure_async(
+            self.kc.execute(
+                self._globals_code(),
+                store_history=False,
+                stop_on_error=not cell_allows_errors,
+            )
+        )
+
+    def _globals_code(self) -> str:
+        """Code setting the ``__libro_execute_*`` globals of a run."""
+        if isinstance(self.args_value, str):
+            code = f"__libro_execute_args_dict__={self.args_value}\n"
+        else:
+            code = self._args_code()
+        if self.execute_result_path is not None:
+            code += f"__libro_execute_result__='{self.execute_result_path}'\n"
+        if self.shared_result:
+            code += f"__libro_execute_result_shared__={os.getpid()}\n"
+        if self.headless:
+            code += "__libro_execute_headless__=True\n"
+        if self.output_mime_types is not None:
+            mime_types = list(self.output_mime_types)
+            code += f"{OUTPUT_MODULE}.restrict_display_formatter({mime_types!r})\n"
+        if self.stream_flush_interval is not None:
+            interval = self.stream_flush_interval
+            code += f"{STREAM_MODULE}.set_stream_flush_interval({interval!r})\n"
+        if self.profile_memory:
+            code += f"{PROFILE_MODULE}.install_memory_hook()\n"
+        return code
+
+    def _args_code(self) -> str:
+        literal = inline_args(self.args_value, self.args_inline_limit)
+        if literal is not None:
+            return (
+                f"__libro_execute_args_dict__={literal}\n"
+                "__libro_execute_args_file__=None\n"
+            )
+        if self._args_file is None:
+            args_dir = shared_memory_dir() or tempfile.gettempdir()
+            self._args_file = dump_args(
+                self.args_value,
+                os.path.join(args_dir, shared_memory_name("args")),
+            )
+        # the file is only read when the notebook asks for the args
+        return (
+            f"__libro_execute_args_dict__={ARGS_MODULE}.LazyArgs({self._args_file!r})\n"
+            f"__libro_execute_args_file__={self._args_file!r}\n"
+        )
+
+    def _remove_args_file(self):
+        if self._args_file is not None:
+            try:
+                os.remove(self._args_file)
+            except FileNotFoundError:
+                pass
+            self._args_file = None
+
+    async def _async_inspect_result(self):
+        # what inspect_execution_result returns, without importing libro_flow
+        # into a kernel that did not dump a result
+        try:
+            descriptor = await self.async_eval_in_kernel(
+                "get_ipython().user_ns.get('__libro_execute_result_descriptor__')"
+            )
+        except RuntimeError:
+            return
+        if not descriptor or descriptor == "None":
+            return
+        result = LibroResultDescriptor(**ast.literal_eval(descriptor))
+        if result.shared_memory:
+            own_shared_result(result.path)
+        self.execution.result_descriptor = result
+        self.execution.execute_result_path = result.path
+
+    def restore_execution(self, nb: NotebookNode):
+        """Finish the execution with an already executed notebook ``nb``."""
+        self.nb = nb
+        self.execution.cached = True
+        self.execution.cell_count = len(nb.cells)
+        self.execution.current_index = max(len(nb.cells) - 1, 0)
+        self.execution.code_cells_executed = sum(
+            1 for cell in nb.cells if cell.get("execution_count") is not None
+        )
+        self.execution.start_time = nb.metadata.get("libro_execute_start_time", "")
+        self.execution.end_time = nb.metadata.get("libro_execute_end_time", "")
+        if self.execute_result_path is not None:
+            self.execution.execute_result_path = self.execute_result_path
+        if self.execute_record_path is not None:
+            self.execution.execute_record_path = self.execute_record_path
+            ExecutionRecordJournal(
+                self.execute_record_path, self.record_compression
+            ).compact(nb)
+        self.execution.status = "finished"
+        self.events.emit("complete", execution=self.get_status().model_dump(mode="json"))
+        self.events.close()
+        self._run_done_callbacks()
+
+    def add_done_callback(self, callback):
+        """Call ``callback(client)`` once the execution finished or failed."""
+        self._done_callbacks.append(callback)
+
+    def _run_done_callbacks(self):
+        callbacks, self._done_callbacks = self._done_callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                self.log.exception("execution done callback failed")
+
+    async def _async_finish_record(self):
+        if self.checkpointer is not None:
+            await self.checkpointer.close(self.nb)
+            self.get_status()
+
+    async def _async_borrow_kernel(self):
+        assert self.kernel_pool is not None
+        if not self.kernel_name:
+            kn = self.nb.metadata.get("kernelspec", {}).get("name")
+            if kn is not None:
+                self.kernel_name = kn
+        self.km = await self.kernel_pool.acquire(self.kernel_name)
+        # the pool decides what happens to the kernel after the run
+        self.owns_km = False
+
+    async def _async_return_kernel(self):
+        assert self.kernel_pool is not None
+        km = self.km
+        if self.kc is not None:
+            await ensure_async(self.kc.stop_channels())
+            self.kc = None
+        self.km = None
+        if km is not None:
+            await self.kernel_pool.release(km)
+
+    async def _async_run_cell(
+        self,
+        index: int,
+        cell: NotebookNode,
+        client: "LibroNotebookClient | None" = None,
+        execution_count: int | None = None,
+    ):
+        """Execute one cell on ``client``, a sibling kernel client, or this client."""
+        client = client or self
+        if self._stop_reason is not None:
+            raise ExecutionStopped(self._stop_reason)
+        if client is self:
+            # the rss at the start is filled in by the watchdog
+            self._running_cell = (index, time.monotonic(), 0)
+        if execution_count is None:
+            execution_count = self.code_cells_executed + 1
+        self.events.emit("cell_start", index=index, cell_type=cell.cell_type)
+        executed = client.code_cells_executed
+        submitted = datetime.datetime.now(datetime.timezone.utc)
+        await client.async_execute_cell(cell, index, execution_count=execution_count)
+        if client.code_cells_executed > executed:
+            await self._async_profile_cell(index, cell, client, submitted)
+        if client is not self:
+            self.code_cells_executed += client.code_cells_executed - executed
+        if cell.get("outputs"):
+            self._externalize_outputs(cell)
+        self.events.emit(
+            "cell_end", index=index, execution_count=cell.get("execution_count")
+        )
+        if cell.get("outputs"):
+            self.events.emit(
+                "output", index=index, outputs=summarize_outputs(cell.outputs)
+            )
+        self.execution.current_index = index
+        self.execution.code_cells_executed = self.code_cells_executed
+        try:
+            if cell.metadata.execution is None:
+                cell.metadata.execution = {}
+            cell.metadata.execution["shell.execute_reply.end"] = (
+                datetime.datetime.now(datetime.timezone.utc).isoformat()
+            )
+        except:
+            pass
+        if self.checkpointer is not None:
+            self.checkpointer.mark_cell(index, cell)
+
+    def process_message(
+        self, msg: dict, cell: NotebookNode, cell_index: int
+    ) -> NotebookNode | None:
+        msg_type = msg["msg_type"]
+        if msg_type == "status" and msg["content"]["execution_state"] == "idle":
+            # the cell is done, nothing more is merged into its streams
+            self._flush_streams()
+        if self.headless and msg_type.startswith("comm"):
+            return None
+        if msg_type in ("execute_result", "display_data", "update_display_data") and (
+            self.headless or self.output_mime_types is not None
+        ):
+            content = msg["content"]
+            data = filter_mime_bundle(
+                content.get("data", {}), self.output_mime_types, self.headless
+            )
+            if not data:
+                if "execution_count" in content:
+                    cell["execution_count"] = content["execution_count"]
+                return None
+            msg = {**msg, "content": {**content, "data": data}}
+        return super().process_message(msg, cell, cell_index)
+
+    def output(
+        self,
+        outs: list[NotebookNode],
+        msg: dict,
+        display_id: str | None,
+        cell_index: int,
+    ) -> NotebookNode | None:
+        buffer = self._stream_buffer
+        if (
+            msg["msg_type"] == "stream"
+            and buffer is not None
+            and outs
+            and outs[-1] is buffer.output
+            and buffer.name == msg["content"]["name"]
+            and not self.clear_before_next_output
+            and not self.output_hook_stack[msg["parent_header"].get("msg_id")]
+        ):
+            buffer.write(msg["content"]["text"])
+            return buffer.output
+        self._flush_streams()
+        out = super().output(outs, msg, display_id, cell_index)
+        if out is not None and out.output_type == "stream":
+            if self.merge_streams:
+                self._stream_buffer = StreamBuffer(out, self.stream_line_limit)
+            elif self.stream_line_limit:
+                text, dropped = cap_stream_text(out.text, self.stream_line_limit)
+                if dropped:
+                    out.text = dropped_lines_note(dropped) + text
+        return out
+
+    def clear_output(self, outs: list[NotebookNode], msg: dict, cell_index: int):
+        self._flush_streams()
+        super().clear_output(outs, msg, cell_index)
+
+    def _flush_streams(self):
+        if self._stream_buffer is not None:
+            self._stream_buffer.flush()
+            self._stream_buffer = None
+
+    async def async_execute_cell(
+        self,
+        cell: NotebookNode,
+        cell_index: int,
+        execution_count: int | None = None,
+        store_history: bool = True,
+    ) -> NotebookNode:
+        try:
+            return await super().async_execute_cell(
+                cell, cell_index, execution_count, store_history
+            )
+        finally:
+            # the idle status may never come, after a timeout or an interrupt
+            self._flush_streams()
+
+    def _filter_outputs(self, outputs: list) -> list:
+        """``outputs`` without the data ``output_mime_types`` and headless
+        mode drop, for outputs that did not come through ``process_message``."""
+        if not self.headless and self.output_mime_types is None:
+            return outputs
+        filtered = []
+        for output in outputs:
+            if "data" in output:
+                data = filter_mime_bundle(
+                    output["data"], self.output_mime_types, self.headless
+                )
+                if not data:
+                    continue
+                output = {**output, "data": data}
+            filtered.append(output)
+        return filtered
+
+    def _externalize_outputs(self, cell: NotebookNode):
+        if self.blob_store is None:
+            blob_dir = self.blob_dir
+            if blob_dir is None and self.execute_record_path is not None:
+                blob_dir = os.path.join(os.path.dirname(self.execute_record_path), ".blobs")
+            if blob_dir is None:
+                return
+            self.blob_store = OutputBlobStore(blob_dir)
+        cell.outputs, inline_bytes, externalized = externalize_outputs(
+            cell.outputs,
+            self.blob_store,
+            self.cell_output_limit,
+            self.run_output_limit - self._inline_output_bytes,
+        )
+        self._inline_output_bytes += inline_bytes
+        self.execution.externalized_outputs += externalized
+
+    async def _async_poll_for_reply(self, msg_id: str, cell: NotebookNode, *args, **kwargs):
+        msg = await super()._async_poll_for_reply(msg_id, cell, *args, **kwargs)
+        self._reply_memory = msg.get("metadata", {}).get("libro_memory")
+        return msg
+
+    async def _async_profile_cell(
+        self,
+        index: int,
+        cell: NotebookNode,
+        client: "LibroNotebookClient",
+        submitted: datetime.datetime,
+    ):
+        finished = datetime.datetime.now(datetime.timezone.utc)
+        timing = cell.metadata.get("execution") or {}
+        started = _parse_timestamp(timing.get("iopub.status.busy")) or submitted
+        replied = _parse_timestamp(timing.get("shell.execute_reply")) or finished
+        profile = LibroCellProfile(
+            index=index,
+            queue_time=max((started - submitted).total_seconds(), 0.0),
+            execution_time=max((replied - started).total_seconds(), 0.0),
+            output_bytes=len(json.dumps(cell.get("outputs", []))),
+        )
+        if self.profile_memory and client._reply_memory:
+            profile.rss, profile.peak_rss = client._reply_memory
+        cell.metadata["libro_profile"] = profile.model_dump(exclude={"index"})
+        self.execution.cell_profiles.append(profile)
+
+    async def _async_execute_notebook(
+        self, reset_kc: bool = False, **kwargs: Any
     ) -> NotebookNode:
         if reset_kc and self.owns_km:
             await self._async_cleanup_kernel()
         self.reset_execution_trackers()
+        self._inline_output_bytes = 0
 
         async with self.async_setup_kernel(**kwargs):
             assert self.kc is not None
@@ -99,48 +1009,43 @@ class LibroNotebookClient(NotebookClient):
                         'Kernel info received message content has no "language_info" key. '
                         "Content is:\n" + str(info_msg["content"])
                     )
-            cell_allows_errors = (not self.force_raise_errors) and (self.allow_errors)
             self.start_time = datetime.datetime.now(datetime.timezone.utc)
             self.execution.start_time = self.start_time.isoformat()
             self.nb.metadata["libro_execute_start_time"] = self.start_time.isoformat()
-            await ensure_async(
-                self.kc.execute(
-                    f"__libro_execute_args_dict__={self.args}\n",
-                    store_history=False,
-                    stop_on_error=not cell_allows_errors,
-                )
-            )
+            await self._async_inject_globals()
             if self.execute_result_path is not None:
-                await ensure_async(
-                    self.kc.execute(
-                        f"__libro_execute_result__='{self.execute_result_path}'\n",
-                        store_history=False,
-                        stop_on_error=not cell_allows_errors,
-                    )
-                )
                 self.execution.execute_result_path = self.execute_result_path
+            resume_index = -1
+            if self.incremental:
+                # before the record checkpointer replaces the previous record
+                resume_index = await self._async_prepare_incremental()
             if self.execute_record_path is not None:
                 self.execution.execute_record_path = self.execute_record_path
-            self.execution.cell_count = len(self.nb.cells)
-            for index, cell in enumerate(self.nb.cells):
-                await self.async_execute_cell(
-                    cell, index, execution_count=self.code_cells_executed + 1
+                self.checkpointer = ExecutionCheckpointer(
+                    ExecutionRecordJournal(
+                        self.execute_record_path, self.record_compression
+                    ),
+                    interval=self.checkpoint_interval,
+                    max_cells=self.checkpoint_cells,
                 )
-                self.execution.current_index = index
-                self.execution.code_cells_executed = self.code_cells_executed
-                try:
-                    if cell.metadata.execution is None:
-                        cell.metadata.execution = {}
-                    cell.metadata.execution["shell.execute_reply.end"] = (
-                        datetime.datetime.now(datetime.timezone.utc).isoformat()
-                    )
-                except:
-                    pass
-                if self.execute_record_path is not None:
-                    with open(self.execute_record_path, "w", encoding="utf-8") as f:
-                        nbformat.write(self.nb, f)
+                await self.checkpointer.start(self.nb)
+            self.execution.cell_count = len(self.nb.cells)
+            if self.parallel_kernels > 1 and self.snapshot_store is None:
+                await ParallelCellExecutor(self, self.parallel_kernels).execute()
+            else:
+                for index, cell in enumerate(self.nb.cells):
+                    if index <= resume_index:
+                        self._skip_cell(index, cell)
+                        continue
+                    await self._async_run_cell(index, cell)
+                    if self.snapshot_store is not None and cell.cell_type == "code":
+                        await self._async_snapshot_namespace(index)
+            if self.snapshot_store is not None:
+                self.snapshot_store.prune(self._fingerprints)
+            await self._async_inspect_result()
             self.set_widgets_metadata()
-            self.kc.shutdown()
+            if self.kernel_pool is None:
+                self.kc.shutdown()
             # await self.inspect_execution_result()
             self.end_time = datetime.datetime.now(datetime.timezone.utc)
             self.execution.end_time = self.end_time.isoformat()
@@ -1,12 +1,27 @@
 import asyncio
 import json
+import os
 from nbclient.util import ensure_async, run_sync
-from libro_flow.libro_schema_form_widget import SchemaFormWidget
 from numpy import void
 from pydantic import BaseModel
 from nbformat import NotebookNode
 from IPython.display import display
 from .libro_client import LibroNotebookClient
+from .inprocess_execution import LibroInProcessNotebookClient
+from .distributed_execution import LibroJobQueue, LibroRemoteNotebookClient
+from .execution_scheduler import LibroExecutionScheduler
+from .kernel_pool import LibroKernelPool
+from .execution_cache import LibroExecutionCache
+from .args_transport import load_args
+from .notebook_cache import NotebookNodeCache, notebook_cache, read_notebook
+from .result_format import (
+    detect_result_format,
+    get_result_format,
+    result_formats,
+    select_result_format,
+    shared_memory_dir,
+    shared_memory_name,
+)
 from jupyter_client.manager import KernelManager
 from typing import Any, Union, Callable, TypeVar
 
@@ -14,13 +29,14 @@ ArgsType = TypeVar("ArgsType", bound=BaseModel)
 
 
 def inspect_execution_result():
+    """Descriptor of the last dumped result: path, format, size and the name of
+    the shared memory segment holding it, if any."""
     from IPython.core.getipython import get_ipython
 
     ipython = get_ipython()
     user_ns = ipython.user_ns  # type: ignore
     try:
-        result_dump_path = user_ns["__libro_execute_result_dump_path__"]
-        return result_dump_path
+        return user_ns["__libro_execute_result_descriptor__"]
     except (TypeError, KeyError):
         pass
 
@@ -33,21 +49,40 @@ def notebook_args(ArgsModel: type[ArgsType]) -> ArgsType:
     user_ns = ipython.user_ns  # type: ignore
 
     args_dict = user_ns.get("__libro_execute_args_dict__")
+    args_file = user_ns.get("__libro_execute_args_file__")
+    if args_dict is None and args_file is not None:
+        args_dict = load_args(args_file)
     if args_dict is not None:
+        args_dict = dict(args_dict)
+        user_ns["__libro_execute_args_dict__"] = args_dict
         args_model = ArgsModel(**args_dict)
 
     for args_key, args_value in args_model.__dict__.items():
         user_ns[args_key] = args_value
     user_ns["__libro_execute_args__"] = args_model
-    widget = SchemaFormWidget(dataModel=args_model)
-    data = {"application/vnd.libro.args+json": args_model.model_json_schema()}
+    if user_ns.get("__libro_execute_headless__"):
+        return args_model
+    # ipywidgets is only imported when there is someone to show the form to
+    from libro_flow.libro_schema_form_widget import SchemaFormWidget
+
+    schema = args_model.model_json_schema()
+    widget = SchemaFormWidget(dataModel=args_model, schema=schema)
+    data = {"application/vnd.libro.args+json": schema}
     display(data, raw=True)
     display(widget)
     return args_model
 
 
-def dump_execution_result(result, path=None):
-    import pickle
+def dump_execution_result(
+    result, path=None, format: str | None = None, shared: bool | None = None
+):
+    """Dump ``result`` for the caller of the execution.
+
+    Without a path the result goes to a temporary file, or with ``shared``
+    (defaults to the ``shared_result`` setting of the client) to a POSIX
+    shared memory segment under /dev/shm that in-process consumers can map
+    without copying.
+    """
     from IPython.core.getipython import get_ipython
     import tempfile
     import uuid
@@ -58,53 +93,100 @@ def dump_execution_result(result, path=None):
     result_path = user_ns.get("__libro_execute_result__")
     if result_path is None:
         result_path = path
-    if result_path is None:
-        result_dir = tempfile.mkdtemp()
+    # the pid of the client asking for a shared result, which owns the segment
+    owner = user_ns.get("__libro_execute_result_shared__")
+    if shared is None:
+        shared = bool(owner)
+    if format is not None:
+        result_format = get_result_format(format)
+    else:
+        result_format = select_result_format(result, result_path)
+    segment = ""
+    generated = result_path is None
+    if generated:
+        result_dir = shared_memory_dir() if shared else None
         _uuid = uuid.uuid4().hex[:16].lower()
-        result_file_name = "libro_execute_result_" + _uuid + ".pickle"
-        result_path = os.path.join(result_dir, result_file_name)
+        if result_dir is not None:
+            segment = shared_memory_name(
+                "result", owner if type(owner) is int else None
+            )
+            result_path = os.path.join(result_dir, segment)
+        else:
+            result_path = os.path.join(
+                tempfile.gettempdir(), "libro_execute_result_" + _uuid
+            )
+    known_extensions = tuple(ext for f in result_formats for ext in f.extensions)
+    if not generated and not result_path.endswith(known_extensions):
+        raise Exception(f"Output path should endwith one of {known_extensions}!")
+    if generated and not segment:
+        stem = result_path
+        result_path = stem + result_format.extensions[0]
+    try:
+        result_format.dump(result, result_path)
+    except result_format.dump_errors():
+        # a format picked for the result may still fail to convert it, a
+        # format the caller asked for by name or path does not fall back
+        if format is not None or not generated:
+            raise
+        if os.path.exists(result_path):
+            os.remove(result_path)
+        result_format = get_result_format("pickle5")
+        if not segment:
+            result_path = stem + result_format.extensions[0]
+        result_format.dump(result, result_path)
+    if generated:
         user_ns["__libro_execute_result__"] = result_path
-    if not result_path.endswith(".pickle"):
-        raise Exception("Output path should endwith .pickle!")
-    # 将数据序列化为字节流
-    with open(result_path, "wb") as f:
-        pickle.dump(result, f)
-        user_ns["__libro_execute_result_dump_path__"] = result_path
+    user_ns["__libro_execute_result_dump_path__"] = result_path
+    user_ns["__libro_execute_result_descriptor__"] = {
+        "path": result_path,
+        "format": result_format.name,
+        "size": os.path.getsize(result_path),
+        "shared_memory": segment,
+    }
     return result_path
 
 
-def load_execution_result(pickle_file_path):
-    import pickle
-
-    with open(pickle_file_path, "rb") as f:
-        nb_output = pickle.load(f)
-    return nb_output
-
+def load_execution_result(pickle_file_path, mmap: bool = False):
+    """Load a dumped result, memory mapping it for zero-copy reads if ``mmap``."""
+    result_format = detect_result_format(pickle_file_path)
+    return result_format.load(pickle_file_path, mmap=mmap)
 
-def load_notebook_node(notebook_path):
-    import nbformat
 
-    nb = nbformat.read(notebook_path, as_version=4)
-    nb_upgraded = nbformat.v4.upgrade(nb)
-    if nb_upgraded is not None:
-        nb = nb_upgraded
-    return nb
+def load_notebook_node(
+    notebook_path, cache: Union[NotebookNodeCache, None] = notebook_cache
+):
+    """Parse and upgrade a notebook, a copy of the cached template for paths."""
+    if cache is None or not isinstance(notebook_path, (str, os.PathLike)):
+        return read_notebook(notebook_path)
+    return cache.get(notebook_path)
 
 
-def execute_notebook(
+def create_notebook_client(
     notebook: Any,
     args=None,
     execute_result_path: str | None = None,
     execute_record_path: str | None = None,
     notebook_parser: Callable | None = None,
     km: Union[KernelManager, None] = None,
+    inprocess: bool = False,
+    job_queue: Union[LibroJobQueue, None] = None,
     **kwargs: Any,
 ):
+    """With ``inprocess`` the notebook runs on a ``LibroInProcessExecutor``
+    rather than a kernel, see ``LibroInProcessNotebookClient``; with a
+    ``job_queue`` on a remote worker, see ``LibroRemoteNotebookClient``."""
     if notebook_parser is not None:
         nb = notebook_parser(notebook)
     else:
         nb = load_notebook_node(notebook)
-    client = LibroNotebookClient(
+    if job_queue is not None:
+        kwargs["job_queue"] = job_queue
+        client_class = LibroRemoteNotebookClient
+    elif inprocess:
+        client_class = LibroInProcessNotebookClient
+    else:
+        client_class = LibroNotebookClient
+    client = client_class(
         nb=nb,
         km=km,
         args=args,
@@ -112,8 +194,58 @@ def execute_notebook(
         execute_record_path=execute_record_path,
         **kwargs,
     )
+    if isinstance(notebook, (str, os.PathLike)):
+        client.notebook_path = os.path.abspath(notebook)
     client.update_execution()
-    asyncio.create_task(client.async_execute())
+    return client
+
+
+def _use_cache(cache: LibroExecutionCache, client: LibroNotebookClient) -> bool:
+    """Finish ``client`` from ``cache`` on a hit, store its record on a miss."""
+    key = cache.client_key(client)
+    if cache.restore(key, client):
+        return True
+    client.add_done_callback(lambda c: cache.store_later(key, c))
+    return False
+
+
+def execute_notebook(
+    notebook: Any,
+    args=None,
+    execute_result_path: str | None = None,
+    execute_record_path: str | None = None,
+    notebook_parser: Callable | None = None,
+    km: Union[KernelManager, None] = None,
+    scheduler: Union[LibroExecutionScheduler, None] = None,
+    priority: int = 0,
+    kernel_pool: Union[LibroKernelPool, None] = None,
+    cache: Union[LibroExecutionCache, None] = None,
+    job_queue: Union[LibroJobQueue, None] = None,
+    **kwargs: Any,
+):
+    """Start executing ``notebook``, returns its client right away.
+
+    With a ``job_queue`` the execution is left to remote workers instead of
+    the ``scheduler``.
+    """
+    client = create_notebook_client(
+        notebook,
+        args=args,
+        execute_result_path=execute_result_path,
+        execute_record_path=execute_record_path,
+        notebook_parser=notebook_parser,
+        km=km,
+        kernel_pool=kernel_pool,
+        job_queue=job_queue,
+        **kwargs,
+    )
+    if job_queue is not None:
+        client.priority = priority
+    if cache is None or not _use_cache(cache, client):
+        if scheduler is not None and job_queue is None:
+            scheduler.submit(client, priority=priority)
+        else:
+            asyncio.create_task(client.async_execute())
     display(client.execute_result_path)
     return client
 
@@ -125,21 +257,19 @@ def execute_notebook_sync(
     execute_record_path: str | None = None,
     notebook_parser: Callable | None = None,
     km: Union[KernelManager, None] = None,
+    cache: Union[LibroExecutionCache, None] = None,
     **kwargs: Any,
 ):
-    if notebook_parser is not None:
-        nb = notebook_parser(notebook)
-    else:
-        nb = load_notebook_node(notebook)
-    client = LibroNotebookClient(
-        nb=nb,
-        km=km,
+    client = create_notebook_client(
+        notebook,
         args=args,
         execute_result_path=execute_result_path,
         execute_record_path=execute_record_path,
+        notebook_parser=notebook_parser,
+        km=km,
         **kwargs,
     )
-    client.update_execution()
-    client.execute()
+    if cache is None or not _use_cache(cache, client):
+        client.execute()
     display(client.execute_result_path)
     return client
@@ -20,9 +20,13 @@ class SchemaFormWidget(DOMWidget):
 
     dataModel: BaseModel
 
-    def __init__(self, *args: Any, dataModel: BaseModel, **kwargs) -> None:
+    def __init__(
+        self, *args: Any, dataModel: BaseModel, schema: dict | None = None, **kwargs
+    ) -> None:
         super().__init__(*args, **kwargs)
-        self.schema = json.dumps(dataModel.model_json_schema(), indent=2)
+        if schema is None:
+            schema = dataModel.model_json_schema()
+        self.schema = json.dumps(schema, indent=2)
         self.dataModel = dataModel
         self.init_value()
         # self.send_state()
@@ -34,7 +38,7 @@ class SchemaFormWidget(DOMWidget):
         user_ns = ipython.user_ns  # type: ignore
         vDic = user_ns.get("__libro_execute_args_dict__")
         if vDic is not None:
-            self.value = json.dumps(vDic)
+            self.value = json.dumps(vDic, default=str)
 
     @validate("value")
     def _valid_value(self, proposal):
@@ -0,0 +1,108 @@
+import importlib
+import io
+import os
+import pickle
+import re
+import types
+import warnings
+
+_EXCLUDED_NAMES = {"In", "Out", "exit", "quit", "get_ipython"}
+# output and input history of IPython (_, __, _5, _i, _ii, _i5, _oh, ...) and
+# dunder names like __builtins__ or the __libro_execute_*__ globals of a run
+_IPYTHON_NAME = re.compile(r"_+|_i+|_i?\d+|_[oid]h|_exit_code|__\w+__")
+
+
+class _NamespacePickler(pickle.Pickler):
+    def reducer_override(self, obj):
+        # pickle stores these by reference, they would not load in a new kernel
+        if isinstance(obj, (type, types.FunctionType)) and obj.__module__ == "__main__":
+            raise pickle.PicklingError(f"{obj!r} is defined in the notebook")
+        return NotImplemented
+
+
+def _dumps(value) -> bytes:
+    # dill can also pickle functions and classes defined in the notebook
+    try:
+        import dill
+    except ImportError:
+        pass
+    else:
+        with warnings.catch_warnings():
+            # dill warns and falls back to a reference it cannot load later
+            warnings.simplefilter("error", dill.PicklingWarning)
+            return dill.dumps(value, protocol=5)
+    buffer = io.BytesIO()
+    _NamespacePickler(buffer, protocol=5).dump(value)
+    return buffer.getvalue()
+
+
+def _loads(data: bytes):
+    try:
+        import dill
+
+        return dill.loads(data)
+    except ImportError:
+        return pickle.loads(data)
+
+
+def snapshot_namespace(path: str, names: list[str] | None = None) -> dict[str, int]:
+    """Pickle the kernel user namespace, or only ``names`` of it, to ``path``.
+
+    Returns ``{name: id(value)}`` for the values that could not be pickled, so
+    the caller can tell which cell has to be replayed to recreate them.
+    """
+    from IPython.core.getipython import get_ipython
+
+    ipython = get_ipython()
+    user_ns = ipython.user_ns  # type: ignore
+    hidden = ipython.user_ns_hidden  # type: ignore
+    if names is None:
+        items = [
+            (name, value)
+            for name, value in list(user_ns.items())
+            if not (
+                name in _EXCLUDED_NAMES
+                or name in hidden
+                or _IPYTHON_NAME.fullmatch(name)
+            )
+        ]
+    else:
+        items = [(name, user_ns[name]) for name in names if name in user_ns]
+    modules = {}
+    values = {}
+    skipped = {}
+    for name, value in items:
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            values[name] = _dumps(value)
+        except Exception:
+            skipped[name] = id(value)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump({"modules": modules, "values": values}, f, protocol=5)
+    os.replace(tmp_path, path)
+    return skipped
+
+
+def restore_namespace(path: str, names: list[str] | None = None) -> int:
+    """Load a snapshot written by ``snapshot_namespace`` into the user namespace.
+
+    Only ``names`` are loaded when given.
+    """
+    from IPython.core.getipython import get_ipython
+
+    user_ns = get_ipython().user_ns  # type: ignore
+    with open(path, "rb") as f:
+        snapshot = pickle.load(f)
+    restored = 0
+    for name, module in snapshot["modules"].items():
+        if names is None or name in names:
+            user_ns[name] = importlib.import_module(module)
+            restored += 1
+    for name, value in snapshot["values"].items():
+        if names is None or name in names:
+            user_ns[name] = _loads(value)
+            restored += 1
+    return restored
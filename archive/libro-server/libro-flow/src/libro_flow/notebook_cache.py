@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+import nbformat
+from nbformat import NotebookNode
+from pydantic import BaseModel
+
+
+class NotebookCacheStats(BaseModel):
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    entries: int = 0
+    # size of the cached notebook files
+    bytes: int = 0
+
+
+def copy_notebook(node):
+    """Copy the dicts and lists of a parsed notebook, sharing the immutable
+    leaves; much cheaper than ``copy.deepcopy`` for json data."""
+    if isinstance(node, dict):
+        return type(node)((key, copy_notebook(value)) for key, value in node.items())
+    if isinstance(node, list):
+        return [copy_notebook(value) for value in node]
+    return node
+
+
+def read_notebook(path: str) -> NotebookNode:
+    nb = nbformat.read(path, as_version=4)
+    nb_upgraded = nbformat.v4.upgrade(nb)
+    if nb_upgraded is not None:
+        nb = nb_upgraded
+    return nb
+
+
+class NotebookNodeCache:
+    """Parsed and upgraded notebooks keyed by path, mtime and size.
+
+    ``get`` hands out a copy of the cached template, so a run can change its
+    notebook freely. The least recently used templates are dropped once there
+    are more than ``max_entries`` or their files add up to more than
+    ``max_bytes``.
+    """
+
+    def __init__(self, max_entries: int = 128, max_bytes: int = 256 * 1024**2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stats = NotebookCacheStats()
+        self._lock = threading.Lock()
+        # path -> (mtime_ns, size, notebook)
+        self._entries: OrderedDict[str, tuple[int, int, NotebookNode]] = OrderedDict()
+
+    def get(self, path: str) -> NotebookNode:
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+                self._entries.move_to_end(path)
+                self.stats.hits += 1
+                return copy_notebook(entry[2])
+            self.stats.misses += 1
+        nb = read_notebook(path)
+        if stat.st_size <= self.max_bytes:
+            with self._lock:
+                self._put(path, (stat.st_mtime_ns, stat.st_size, nb))
+        return copy_notebook(nb)
+
+    def _put(self, path: str, entry: tuple[int, int, NotebookNode]):
+        previous = self._entries.pop(path, None)
+        if previous is not None:
+            self.stats.bytes -= previous[1]
+        self._entries[path] = entry
+        self.stats.bytes += entry[1]
+        while self._entries and (
+            len(self._entries) > self.max_entries or self.stats.bytes > self.max_bytes
+        ):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self.stats.bytes -= size
+            self.stats.evictions += 1
+        self.stats.entries = len(self._entries)
+
+    def invalidate(self, path: str):
+        with self._lock:
+            entry = self._entries.pop(os.path.realpath(path), None)
+            if entry is not None:
+                self.stats.bytes -= entry[1]
+            self.stats.entries = len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.stats.entries = 0
+            self.stats.bytes = 0
+
+
+notebook_cache = NotebookNodeCache()
@@ -0,0 +1,33 @@
+from fnmatch import fnmatchcase
+
+WIDGET_VIEW_MIME_TYPE = "application/vnd.jupyter.widget-view+json"
+
+
+def allowed_mime_type(mime_type: str, mime_types) -> bool:
+    """Whether ``mime_type`` matches one of the ``mime_types`` patterns, like
+    ``text/plain`` or ``image/*``."""
+    return any(fnmatchcase(mime_type, pattern) for pattern in mime_types)
+
+
+def filter_mime_bundle(data: dict, mime_types=None, headless: bool = False) -> dict:
+    """The entries of the mime bundle ``data`` a run keeps."""
+    return {
+        mime_type: value
+        for mime_type, value in data.items()
+        if (mime_types is None or allowed_mime_type(mime_type, mime_types))
+        and not (headless and mime_type == WIDGET_VIEW_MIME_TYPE)
+    }
+
+
+def restrict_display_formatter(mime_types=None):
+    """Let the IPython display formatter only compute ``mime_types``, so that
+    filtered representations are neither rendered nor sent. None restores
+    all types."""
+    from IPython.core.getipython import get_ipython
+
+    formatter = get_ipython().display_formatter  # type: ignore
+    formatter.active_types = [
+        mime_type
+        for mime_type in formatter.format_types
+        if mime_types is None or allowed_mime_type(mime_type, mime_types)
+    ]
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import re
+from nbformat import NotebookNode, from_dict
+
+BLOB_MIME_TYPE = "application/vnd.libro.blob+json"
+
+_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+# outputs kept inline no matter the budget, stubs are about this large
+_MIN_EXTERNAL_SIZE = 1024
+_PREVIEW_CHARS = 1024
+
+
+class OutputBlobStore:
+    """Content-addressed store for cell outputs too large for the record.
+
+    Every blob is the json of one output, stored as ``<digest>.json`` below
+    ``blob_dir`` where ``digest`` is its sha256.
+    """
+
+    def __init__(self, blob_dir: str):
+        self.blob_dir = blob_dir
+
+    def path(self, digest: str) -> str:
+        if not _DIGEST.match(digest):
+            raise ValueError(f"invalid blob digest {digest!r}")
+        return os.path.join(self.blob_dir, digest[:2], f"{digest}.json")
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest: str) -> bytes | None:
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+def _preview(output: NotebookNode) -> str:
+    if output.output_type == "stream":
+        text = output.get("text", "")
+    else:
+        text = output.get("data", {}).get("text/plain", "")
+    if isinstance(text, list):
+        text = "".join(text)
+    if len(text) > _PREVIEW_CHARS:
+        text = text[:_PREVIEW_CHARS] + "\n..."
+    return text
+
+
+def blob_stub(output: NotebookNode, digest: str, size: int) -> NotebookNode:
+    """Display output standing in for ``output`` stored as blob ``digest``."""
+    preview = _preview(output)
+    note = f"[{output.output_type} output of {size} bytes stored as blob {digest[:12]}]"
+    return from_dict(
+        {
+            "output_type": "display_data",
+            "data": {
+                "text/plain": f"{preview}\n{note}" if preview else note,
+                BLOB_MIME_TYPE: {
+                    "digest": digest,
+                    "size": size,
+                    "output_type": output.output_type,
+                },
+            },
+            "metadata": {},
+        }
+    )
+
+
+def externalize_outputs(
+    outputs: list, store: OutputBlobStore, cell_limit: int, run_budget: int
+) -> tuple[list, int, int]:
+    """Move outputs exceeding the budgets of a cell into ``store``.
+
+    Outputs are kept inline in order while they fit both ``cell_limit`` and
+    the ``run_budget`` left for the run, later ones are replaced by stubs.
+    Errors and small outputs always stay inline. Returns the new outputs, the
+    bytes kept inline and the number of externalized outputs.
+    """
+    kept = []
+    inline_bytes = 0
+    externalized = 0
+    for output in outputs:
+        data = json.dumps(output, sort_keys=True).encode()
+        size = len(data)
+        fits = inline_bytes + size <= min(cell_limit, run_budget)
+        if fits or output.output_type == "error" or size <= _MIN_EXTERNAL_SIZE:
+            kept.append(output)
+            inline_bytes += size
+            continue
+        kept.append(blob_stub(output, store.put(data), size))
+        externalized += 1
+    return kept, inline_bytes, externalized
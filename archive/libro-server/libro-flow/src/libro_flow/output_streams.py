@@ -0,0 +1,95 @@
+import re
+import sys
+
+_CARRIAGE_RETURN = re.compile(r"[^\n]*\r(?=[^\n])")
+_BACKSPACE = re.compile(r"[^\n]\x08")
+
+
+def set_stream_flush_interval(interval: float):
+    """Let stdout and stderr of the kernel collect ``interval`` seconds of text
+    per stream message (ipykernel sends every 0.2 seconds)."""
+    for stream in (sys.stdout, sys.stderr):
+        if hasattr(stream, "flush_interval"):
+            stream.flush_interval = interval
+
+
+def render_stream_text(text: str) -> str:
+    """``text`` as a terminal shows it: carriage returns overwrite their line
+    and backspaces remove the character before them, progress bars become
+    their last state."""
+    while True:
+        rendered = _BACKSPACE.sub("", text)
+        if len(rendered) == len(text):
+            break
+        text = rendered
+    return _CARRIAGE_RETURN.sub("", text)
+
+
+def cap_stream_text(text: str, line_limit: int) -> tuple[str, int]:
+    """The last ``line_limit`` lines of ``text`` and the number of lines
+    dropped before them, 0 for no limit."""
+    if not line_limit:
+        return text, 0
+    lines = text.count("\n") + (not text.endswith("\n"))
+    if lines <= line_limit:
+        return text, 0
+    start = len(text) - text.endswith("\n")
+    for _ in range(line_limit):
+        start = text.rfind("\n", 0, start)
+    return text[start + 1 :], lines - line_limit
+
+
+def dropped_lines_note(dropped: int) -> str:
+    return f"[{dropped} lines dropped]\n"
+
+
+class StreamBuffer:
+    """Text of a stream output that more stream messages are merged into.
+
+    Written text is kept in chunks and only joined into the output every
+    ``max_chunks`` writes and on ``flush``, keeping at most ``line_limit``
+    lines (0 for all) behind a note of how many were dropped.
+    """
+
+    max_chunks = 256
+
+    def __init__(self, output: dict, line_limit: int = 0):
+        self.output = output
+        self.line_limit = line_limit
+        self.dropped = 0
+        self._text = output["text"]
+        self._chunks: list[str] = []
+        self.flush()
+
+    @property
+    def name(self) -> str:
+        return self.output["name"]
+
+    def write(self, text: str):
+        self._chunks.append(text)
+        if len(self._chunks) >= self.max_chunks:
+            self.flush()
+
+    def flush(self):
+        text = render_stream_text(self._text + "".join(self._chunks))
+        self._chunks.clear()
+        text, dropped = cap_stream_text(text, self.line_limit)
+        self.dropped += dropped
+        self._text = text
+        if self.dropped:
+            text = dropped_lines_note(self.dropped) + text
+        self.output["text"] = text
+
+
+def compact_stream_outputs(outputs: list, line_limit: int = 0) -> list:
+    """``outputs`` with the text of every stream output rendered and capped to
+    its last ``line_limit`` lines, for outputs captured all at once."""
+    compacted = []
+    for output in outputs:
+        if output.get("output_type") == "stream":
+            text, dropped = cap_stream_text(render_stream_text(output["text"]), line_limit)
+            if dropped:
+                text = dropped_lines_note(dropped) + text
+            output = {**output, "text": text}
+        compacted.append(output)
+    return compacted
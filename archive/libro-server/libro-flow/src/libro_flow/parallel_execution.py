@@ -0,0 +1,477 @@
+import ast
+import asyncio
+import builtins
+import logging
+import os
+import shutil
+import tempfile
+from nbformat import NotebookNode
+from .kernel_module import SNAPSHOT_MODULE
+
+logger = logging.getLogger(__name__)
+
+_BUILTINS = set(dir(builtins))
+# reading the args injects the fields of the args model into the namespace
+_ARGS_NAMES = {"notebook_args", "__libro_execute_args_dict__", "__libro_execute_args__"}
+
+
+class _NameCollector(ast.NodeVisitor):
+    """Names a cell binds at the top level and names it reads anywhere."""
+
+    def __init__(self):
+        self.defines: set[str] = set()
+        self.uses: set[str] = set()
+        self.imports: set[str] = set()
+        self.calls: set[str] = set()
+        self.depth = 0
+        self.star_import = False
+
+    def define(self, name: str):
+        if self.depth == 0:
+            self.defines.add(name)
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Load):
+            self.uses.add(node.id)
+        else:
+            self.define(node.id)
+
+    def visit_AugAssign(self, node: ast.AugAssign):
+        if isinstance(node.target, ast.Name):
+            self.uses.add(node.target.id)
+        self.generic_visit(node)
+
+    def _visit_target_base(self, node):
+        # df["a"] = 1 and obj.x = 1 modify the value bound to the base name
+        base = node.value
+        while isinstance(base, (ast.Attribute, ast.Subscript)):
+            base = base.value
+        if isinstance(base, ast.Name) and not isinstance(node.ctx, ast.Load):
+            self.uses.add(base.id)
+            self.define(base.id)
+        self.generic_visit(node)
+
+    visit_Attribute = _visit_target_base
+    visit_Subscript = _visit_target_base
+
+    def visit_Call(self, node: ast.Call):
+        # a method call like df.drop(..., inplace=True) may modify the value
+        if isinstance(node.func, ast.Attribute) and isinstance(node.func.value, ast.Name):
+            self.calls.add(node.func.value.id)
+        self.generic_visit(node)
+
+    def visit_Import(self, node: ast.Import):
+        for alias in node.names:
+            self.define(alias.asname or alias.name.split(".")[0])
+            self.imports.add(alias.asname or alias.name.split(".")[0])
+
+    def visit_ImportFrom(self, node: ast.ImportFrom):
+        for alias in node.names:
+            if alias.name == "*":
+                self.star_import = True
+            else:
+                self.define(alias.asname or alias.name)
+                self.imports.add(alias.asname or alias.name)
+
+    def visit_Global(self, node: ast.Global):
+        self.defines.update(node.names)
+
+    def _visit_scope(self, node):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            self.define(node.name)
+            for decorator in node.decorator_list:
+                self.visit(decorator)
+        if isinstance(node, ast.ClassDef):
+            for base in node.bases + node.keywords:
+                self.visit(base)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            for default in node.args.defaults + node.args.kw_defaults:
+                if default is not None:
+                    self.visit(default)
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            # annotations are evaluated when the function is defined
+            args = node.args
+            for arg in args.posonlyargs + args.args + args.kwonlyargs:
+                if arg.annotation is not None:
+                    self.visit(arg.annotation)
+            for arg in (args.vararg, args.kwarg):
+                if arg is not None and arg.annotation is not None:
+                    self.visit(arg.annotation)
+            if node.returns is not None:
+                self.visit(node.returns)
+        self.depth += 1
+        body = node.body if isinstance(node.body, list) else [node.body]
+        for child in body:
+            self.visit(child)
+        self.depth -= 1
+
+    visit_FunctionDef = _visit_scope
+    visit_AsyncFunctionDef = _visit_scope
+    visit_ClassDef = _visit_scope
+    visit_Lambda = _visit_scope
+
+    def _visit_comprehension(self, node):
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+
+    visit_ListComp = _visit_comprehension
+    visit_SetComp = _visit_comprehension
+    visit_DictComp = _visit_comprehension
+    visit_GeneratorExp = _visit_comprehension
+
+
+def analyze_cell(source: str) -> _NameCollector | None:
+    """Collect the names a code cell defines and uses, None if it cannot be analyzed.
+
+    Cells using magics, shell commands or star imports are not analyzed, the
+    names they touch are unknown.
+    """
+    try:
+        from IPython.core.inputtransformer2 import TransformerManager
+
+        source = TransformerManager().transform_cell(source)
+    except ImportError:
+        pass
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+    collector = _NameCollector()
+    collector.visit(tree)
+    if "get_ipython" in collector.uses or collector.star_import:
+        return None
+    collector.uses -= _BUILTINS
+    return collector
+
+
+class CellDependencyGraph:
+    """Dependencies between the code cells of a notebook.
+
+    A cell depends on the cells defining the names it uses, on the previous
+    definition of names it redefines and on the cells reading those names
+    before it. Calling a method of a value counts as redefining it, unless
+    the name was bound by an import. Cells that cannot be analyzed are
+    barriers: they see the whole namespace and may have redefined any name
+    read after them. So are cells reading the notebook args, which define
+    the fields of the args model. Cell metadata overrides the analysis:
+
+    - ``libro_defines`` / ``libro_uses``: extra names the cell defines / uses
+    - ``libro_depends_on``: indices or ids of cells that must run before it
+    - ``libro_barrier``: handle the cell like one that cannot be analyzed
+    """
+
+    def __init__(self, nb: NotebookNode):
+        self.cells: list[int] = []
+        self.defines: dict[int, set[str]] = {}
+        self.uses: dict[int, set[str]] = {}
+        self.depends: dict[int, set[int]] = {}
+        # the cell that defined each used name, as seen in notebook order
+        self.sources: dict[int, dict[str, int]] = {}
+        cell_ids = {cell.get("id"): index for index, cell in enumerate(nb.cells)}
+        last_define: dict[str, int] = {}
+        readers: dict[str, set[int]] = {}
+        imported: set[str] = set()
+        barrier = None
+        for index, cell in enumerate(nb.cells):
+            if cell.cell_type != "code" or not cell.source.strip():
+                continue
+            metadata = cell.metadata
+            analyzed = None
+            if not metadata.get("libro_barrier"):
+                analyzed = analyze_cell(cell.source)
+            if analyzed is not None and analyzed.uses & _ARGS_NAMES:
+                analyzed = None
+            if analyzed is None:
+                defines, uses = set(), set(last_define)
+            else:
+                defines = analyzed.defines | (analyzed.calls - imported)
+                uses = analyzed.uses
+                imported = (imported - analyzed.defines) | analyzed.imports
+            defines = defines | set(metadata.get("libro_defines", []))
+            uses = uses | set(metadata.get("libro_uses", []))
+            sources = {}
+            for name in uses:
+                if name in last_define:
+                    sources[name] = last_define[name]
+                elif barrier is not None:
+                    # first defined by the barrier as far as we can tell
+                    sources[name] = barrier
+                    self.defines[barrier].add(name)
+            depends = set(sources.values())
+            for name in defines:
+                if name in last_define:
+                    depends.add(last_define[name])
+                depends |= readers.get(name, set())
+            for dependency in metadata.get("libro_depends_on", []):
+                dependency = cell_ids.get(dependency, dependency)
+                if isinstance(dependency, int) and dependency < index:
+                    depends.add(dependency)
+            if analyzed is None:
+                depends |= set(self.cells)
+                defines |= set(last_define)
+            elif barrier is not None:
+                depends.add(barrier)
+            depends.discard(index)
+            for name in uses:
+                readers.setdefault(name, set()).add(index)
+            for name in defines:
+                last_define[name] = index
+                readers[name] = set()
+            if analyzed is None:
+                barrier = index
+            self.cells.append(index)
+            self.defines[index] = defines
+            self.uses[index] = uses
+            self.depends[index] = depends
+            self.sources[index] = sources
+
+    def readers(self, index: int) -> int:
+        """Number of cells using values defined by cell ``index``."""
+        return sum(1 for sources in self.sources.values() if index in sources.values())
+
+    def width(self) -> int:
+        """Largest number of cells on the same dependency level."""
+        levels: dict[int, int] = {}
+        for index in self.cells:
+            levels[index] = 1 + max((levels[d] for d in self.depends[index]), default=0)
+        counts: dict[int, int] = {}
+        for level in levels.values():
+            counts[level] = counts.get(level, 0) + 1
+        return max(counts.values(), default=0)
+
+
+class _Worker:
+    def __init__(self, client):
+        self.client = client
+        self.lock = asyncio.Lock()
+        # name -> index of the cell that defined the value held by the kernel
+        self.held: dict[str, int] = {}
+
+
+class ParallelCellExecutor:
+    """Run the code cells of ``client.nb`` on ``client`` and sibling kernels.
+
+    Cells are started as soon as the cells they depend on finished, on the
+    idle kernel already holding most of the values they use. Missing values
+    are pickled on the kernel holding them and loaded into the target kernel,
+    values that cannot be pickled pin the cell to the kernel holding them.
+    Values read by several cells are pickled right after the defining cell,
+    so that loading them does not wait for that kernel to become idle.
+
+    A cell needing values that cannot be pickled from more than one kernel
+    fits on none of them. The remaining cells then run one by one on the
+    main kernel, and cells defining values it cannot receive run again on it.
+    """
+
+    def __init__(self, client, max_kernels: int):
+        self.client = client
+        self.graph = CellDependencyGraph(client.nb)
+        self.max_kernels = max_kernels
+        self.workers: list[_Worker] = [_Worker(client)]
+        self.siblings = min(max_kernels, self.graph.width()) - 1
+        self.transfer_dir = ""
+        self._pinned: dict[int, _Worker] = {}
+        self._serial = False
+        # execution count of the last cell started, retried cells take none
+        self._execution_count = 0
+        # cell index -> (snapshot path, names it holds)
+        self._exports: dict[int, tuple[str, set[str]]] = {}
+
+    async def _start_sibling(self) -> _Worker:
+        client = self.client
+        # every configured trait, output filters and stream limits included
+        sibling = type(client)(
+            client.nb,
+            args=client.args_value if isinstance(client.args_value, dict) else client.args,
+            execute_result_path=client.execute_result_path,
+            resources=client.resources,
+            **client.trait_values(config=True),
+        )
+        if client.kernel_pool is not None:
+            sibling.km = await client.kernel_pool.acquire(client.kernel_name)
+            sibling.owns_km = False
+        else:
+            sibling.km = sibling.create_kernel_manager()
+            await sibling.async_start_new_kernel()
+        await sibling.async_start_new_kernel_client()
+        await sibling._async_inject_globals()
+        return _Worker(sibling)
+
+    async def _stop_sibling(self, worker: _Worker):
+        sibling = worker.client
+        sibling._remove_args_file()
+        try:
+            if self.client.kernel_pool is not None:
+                await sibling._async_return_kernel()
+            elif sibling.km is not None:
+                await sibling._async_cleanup_kernel()
+        except Exception:
+            logger.warning("failed to stop sibling kernel", exc_info=True)
+
+    def _choose(self, index: int, idle: list[_Worker]) -> _Worker | None:
+        if self._serial:
+            return self.workers[0] if self.workers[0] in idle else None
+        pinned = self._pinned.get(index)
+        if pinned is not None:
+            return pinned if pinned in idle else None
+        sources = self.graph.sources[index]
+        best = None
+        best_score = -1
+        for worker in idle:
+            score = sum(
+                1 for name, source in sources.items() if worker.held.get(name) == source
+            )
+            if score > best_score:
+                best, best_score = worker, score
+        return best
+
+    async def _snapshot(self, worker: _Worker, path: str, names: list[str]) -> set[str]:
+        """Pickle ``names`` on ``worker``, returns the names that were pickled."""
+        # never hold two kernel locks at once, two transfers in opposite
+        # directions would deadlock
+        async with worker.lock:
+            skipped = await worker.client.async_eval_in_kernel(
+                f"{SNAPSHOT_MODULE}.snapshot_namespace({path!r}, {names!r})"
+            )
+        return set(names) - set(ast.literal_eval(skipped) if skipped else {})
+
+    async def _transfer(self, index: int, worker: _Worker) -> dict[str, _Worker]:
+        """Load the values cell ``index`` uses into ``worker``. Returns the names
+        that cannot be pickled, with the worker holding them."""
+        sources = self.graph.sources[index]
+        exported: dict[str, list[str]] = {}
+        missing: dict[_Worker, list[str]] = {}
+        failed: dict[str, _Worker] = {}
+        for name, source in sources.items():
+            if worker.held.get(name) == source:
+                continue
+            if source in self._exports and name in self._exports[source][1]:
+                exported.setdefault(self._exports[source][0], []).append(name)
+                continue
+            for holder in self.workers:
+                if holder.held.get(name) == source:
+                    missing.setdefault(holder, []).append(name)
+                    break
+        for holder, names in missing.items():
+            path = os.path.join(self.transfer_dir, f"{index}-{self.workers.index(holder)}")
+            pickled = await self._snapshot(holder, path, names)
+            for name in names:
+                if name not in pickled:
+                    failed[name] = holder
+            if pickled:
+                exported[path] = sorted(pickled)
+        for path, names in exported.items():
+            async with worker.lock:
+                await worker.client.async_eval_in_kernel(
+                    f"{SNAPSHOT_MODULE}.restore_namespace({path!r}, {names!r})"
+                )
+            for name in names:
+                worker.held[name] = sources[name]
+        return failed
+
+    async def _provide(self, index: int, worker: _Worker):
+        """Load the values cell ``index`` uses into ``worker``, running the cells
+        defining values that cannot be pickled once more on it."""
+        failed = await self._transfer(index, worker)
+        if not failed:
+            return
+        sources = self.graph.sources[index]
+        for source in sorted({sources[name] for name in failed}):
+            await self._provide(source, worker)
+            cell = self.client.nb.cells[source]
+            async with worker.lock:
+                await self.client._async_run_cell(
+                    source, cell, client=worker.client, execution_count=cell.execution_count
+                )
+            for name in self.graph.defines[source]:
+                worker.held[name] = source
+        if await self._transfer(index, worker):
+            raise RuntimeError(f"values used by cell {index} cannot be moved to the main kernel")
+
+    async def _run(self, index: int, worker: _Worker) -> bool:
+        if self._serial:
+            await self._provide(index, worker)
+        else:
+            failed = await self._transfer(index, worker)
+            if failed:
+                holders = set(failed.values())
+                if len(holders) > 1 or index in self._pinned:
+                    logger.info("cell %s needs values of several kernels, running serially", index)
+                    self._serial = True
+                else:
+                    self._pinned[index] = holders.pop()
+                return False
+        self._execution_count += 1
+        execution_count = self._execution_count
+        async with worker.lock:
+            cell = self.client.nb.cells[index]
+            await self.client._async_run_cell(
+                index, cell, client=worker.client, execution_count=execution_count
+            )
+        defines = self.graph.defines[index]
+        for name in defines:
+            worker.held[name] = index
+        if self.siblings and defines and self.graph.readers(index) > 1:
+            path = os.path.join(self.transfer_dir, str(index))
+            self._exports[index] = (path, await self._snapshot(worker, path, sorted(defines)))
+        return True
+
+    async def execute(self):
+        nb = self.client.nb
+        for index, cell in enumerate(nb.cells):
+            if index not in self.graph.depends:
+                await self.client._async_run_cell(index, cell)
+        pending = set(self.graph.cells)
+        done: set[int] = set()
+        starting = {
+            asyncio.ensure_future(self._start_sibling()) for _ in range(self.siblings)
+        }
+        running: dict[asyncio.Future, tuple[int, _Worker]] = {}
+        idle = [self.workers[0]]
+        self._execution_count = self.client.code_cells_executed
+        self.transfer_dir = tempfile.mkdtemp(prefix="libro-transfer-")
+        try:
+            while pending or running:
+                for index in sorted(pending):
+                    if not idle:
+                        break
+                    if not self.graph.depends[index] <= done:
+                        continue
+                    worker = self._choose(index, idle)
+                    if worker is None:
+                        continue
+                    pending.discard(index)
+                    idle.remove(worker)
+                    task = asyncio.ensure_future(self._run(index, worker))
+                    running[task] = (index, worker)
+                if not running and not starting:
+                    raise RuntimeError(f"cells {sorted(pending)} cannot be scheduled")
+                finished, _ = await asyncio.wait(
+                    set(running) | starting, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in finished:
+                    if task in starting:
+                        starting.discard(task)
+                        if task.exception() is not None:
+                            logger.warning("failed to start sibling kernel: %s", task.exception())
+                            continue
+                        self.workers.append(task.result())
+                        idle.append(task.result())
+                        continue
+                    index, worker = running.pop(task)
+                    idle.append(worker)
+                    if task.result():
+                        done.add(index)
+                    else:
+                        pending.add(index)
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            for result in await asyncio.gather(*starting, return_exceptions=True):
+                if isinstance(result, _Worker):
+                    self.workers.append(result)
+            for worker in self.workers[1:]:
+                await self._stop_sibling(worker)
+            shutil.rmtree(self.transfer_dir, ignore_errors=True)
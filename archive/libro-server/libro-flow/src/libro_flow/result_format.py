@@ -0,0 +1,317 @@
+import atexit
+import json
+import mmap as mmap_module
+import os
+import pickle
+import re
+import struct
+import uuid
+from typing import Any
+
+
+class ResultFormat:
+    """How an execution result is written to and read from a file.
+
+    Formats are recognised on load by the ``magic`` bytes the file starts
+    with, so a result keeps loading whatever the file is called.
+    """
+
+    name = ""
+    extensions: tuple[str, ...] = ()
+    magic = b""
+
+    def accepts(self, result: Any) -> bool:
+        return False
+
+    def dump_errors(self) -> tuple[type[Exception], ...]:
+        """Errors of ``dump`` meaning the result can not be written in this
+        format, an automatically chosen format then falls back to pickle."""
+        return ()
+
+    def dump(self, result: Any, path: str):
+        raise NotImplementedError
+
+    def load(self, path: str, mmap: bool = False) -> Any:
+        raise NotImplementedError
+
+
+def _is_dataframe(result: Any) -> bool:
+    return type(result).__module__.split(".")[0] == "pandas" and type(
+        result
+    ).__name__ == "DataFrame"
+
+
+class ArrowResultFormat(ResultFormat):
+    """pandas DataFrames and pyarrow Tables as uncompressed Arrow IPC (Feather v2)."""
+
+    name = "arrow"
+    extensions = (".arrow", ".feather")
+    magic = b"ARROW1"
+
+    def accepts(self, result: Any) -> bool:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            return False
+        return _is_dataframe(result) or type(result).__module__.startswith("pyarrow")
+
+    def dump_errors(self) -> tuple[type[Exception], ...]:
+        import pyarrow
+
+        # e.g. an object column holding arbitrary python objects, ValueError
+        # for frames pandas refuses to convert like duplicate column names
+        return (
+            ValueError,
+            pyarrow.ArrowInvalid,
+            pyarrow.ArrowTypeError,
+            pyarrow.ArrowNotImplementedError,
+        )
+
+    def dump(self, result: Any, path: str):
+        from pyarrow import feather
+
+        # uncompressed so that the file can be memory mapped without a copy
+        feather.write_feather(result, path, compression="uncompressed")
+
+    def load(self, path: str, mmap: bool = False) -> Any:
+        from pyarrow import feather
+
+        table = feather.read_table(path, memory_map=mmap)
+        if table.schema.pandas_metadata is not None:
+            return table.to_pandas()
+        return table
+
+
+class NpyResultFormat(ResultFormat):
+    name = "npy"
+    extensions = (".npy",)
+    magic = b"\x93NUMPY"
+
+    def accepts(self, result: Any) -> bool:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        return isinstance(result, numpy.ndarray) and not result.dtype.hasobject
+
+    def dump(self, result: Any, path: str):
+        import numpy
+
+        with open(path, "wb") as f:
+            numpy.save(f, result, allow_pickle=False)
+
+    def load(self, path: str, mmap: bool = False) -> Any:
+        import numpy
+
+        return numpy.load(path, mmap_mode="r" if mmap else None, allow_pickle=False)
+
+
+class PickleResultFormat(ResultFormat):
+    """Plain pickle, for ``.pickle`` and ``.pkl`` paths that callers read
+    with ``pickle.load``."""
+
+    name = "pickle"
+    extensions = (".pickle", ".pkl")
+
+    def accepts(self, result: Any) -> bool:
+        return True
+
+    def dump(self, result: Any, path: str):
+        with open(path, "wb") as f:
+            pickle.dump(result, f, protocol=5)
+
+    def load(self, path: str, mmap: bool = False) -> Any:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+class BufferedPickleResultFormat(ResultFormat):
+    """Pickle protocol 5 with out-of-band buffers, the fallback for any result
+    without a path asking for another format.
+
+    Layout: magic, header size, json header, pickle stream, then every
+    out-of-band buffer aligned to ``alignment`` bytes, so that large buffers
+    can be memory mapped. Plain pickle files are still loaded.
+    """
+
+    name = "pickle5"
+    extensions = (".pickle5",)
+    magic = b"LIBROPK5"
+    alignment = 64
+
+    def accepts(self, result: Any) -> bool:
+        return True
+
+    def dump(self, result: Any, path: str):
+        buffers: list[pickle.PickleBuffer] = []
+        data = pickle.dumps(result, protocol=5, buffer_callback=buffers.append)
+        raws = [buffer.raw() for buffer in buffers]
+        layout = []
+        offset = len(data)
+        for raw in raws:
+            offset += -offset % self.alignment
+            layout.append([offset, raw.nbytes])
+            offset += raw.nbytes
+        header = json.dumps({"pickle_size": len(data), "buffers": layout}).encode()
+        header_size = len(self.magic) + 8 + len(header)
+        # make the body offsets absolute and keep buffers aligned in the file
+        header_size += -header_size % self.alignment
+        header = header.ljust(header_size - len(self.magic) - 8)
+        with open(path, "wb") as f:
+            f.write(self.magic)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.write(data)
+            position = len(data)
+            for (start, _), raw in zip(layout, raws):
+                f.write(b"\0" * (start - position))
+                f.write(raw)
+                position = start + raw.nbytes
+
+    def load(self, path: str, mmap: bool = False) -> Any:
+        with open(path, "rb") as f:
+            if f.read(len(self.magic)) != self.magic:
+                f.seek(0)
+                return pickle.load(f)
+            if mmap:
+                mapped = mmap_module.mmap(f.fileno(), 0, access=mmap_module.ACCESS_READ)
+                view = memoryview(mapped)
+            else:
+                # writable, so that loaded arrays are too
+                buffer = bytearray(os.fstat(f.fileno()).st_size)
+                f.seek(0)
+                f.readinto(buffer)
+                view = memoryview(buffer)
+        (size,) = struct.unpack_from("<Q", view, len(self.magic))
+        body = len(self.magic) + 8 + size
+        header = json.loads(bytes(view[len(self.magic) + 8 : body]))
+        data = view[body : body + header["pickle_size"]]
+        buffers = [
+            view[body + start : body + start + nbytes]
+            for start, nbytes in header["buffers"]
+        ]
+        return pickle.loads(data, buffers=buffers)
+
+
+result_formats: list[ResultFormat] = [
+    ArrowResultFormat(),
+    NpyResultFormat(),
+    BufferedPickleResultFormat(),
+    PickleResultFormat(),
+]
+
+
+def register_result_format(result_format: ResultFormat):
+    """Register a format ahead of the built-in ones."""
+    result_formats.insert(0, result_format)
+
+
+def get_result_format(name: str) -> ResultFormat:
+    for result_format in result_formats:
+        if result_format.name == name:
+            return result_format
+    raise ValueError(f"unknown result format {name}")
+
+
+def select_result_format(result: Any, path: str | None = None) -> ResultFormat:
+    """Pick the format for ``result``.
+
+    A path with the extension of a format (``.npy``, ``.arrow``, ``.pickle``)
+    forces that format, otherwise the first format accepting the result wins.
+    """
+    if path is not None:
+        for result_format in result_formats:
+            if result_format.extensions and path.endswith(result_format.extensions):
+                return result_format
+    for result_format in result_formats:
+        if result_format.accepts(result):
+            return result_format
+    return get_result_format("pickle5")
+
+
+def detect_result_format(path: str) -> ResultFormat:
+    with open(path, "rb") as f:
+        head = f.read(16)
+    for result_format in result_formats:
+        if result_format.magic and head.startswith(result_format.magic):
+            return result_format
+    # plain pickle files written before result formats existed
+    return get_result_format("pickle")
+
+
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+def shared_memory_dir() -> str | None:
+    """The tmpfs directory backing POSIX shared memory segments, if usable."""
+    if os.path.isdir(SHARED_MEMORY_DIR) and os.access(SHARED_MEMORY_DIR, os.W_OK):
+        return SHARED_MEMORY_DIR
+    return None
+
+
+# segments are named after the process owning them, so a sweep can tell the
+# ones left behind by processes that are gone
+_SEGMENT_NAME = re.compile(r"libro_execute_(?:result|args)_(\d+)_[0-9a-f]{16}(\.\w+)*")
+
+_owned_results: set[str] = set()
+
+
+def shared_memory_name(kind: str, owner: int | None = None) -> str:
+    """A new ``libro_execute_{kind}_*`` name owned by ``owner``, this process
+    by default."""
+    owner = os.getpid() if owner is None else owner
+    return f"libro_execute_{kind}_{owner}_{uuid.uuid4().hex[:16]}"
+
+
+def own_shared_result(path: str):
+    """Release a result in shared memory when this process exits, unless it
+    is released before."""
+    _owned_results.add(path)
+
+
+def release_shared_result(path: str) -> bool:
+    """Remove a result written to shared memory, other paths are left alone."""
+    _owned_results.discard(path)
+    directory = shared_memory_dir()
+    if directory is None or os.path.dirname(os.path.abspath(path)) != directory:
+        return False
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+@atexit.register
+def release_owned_shared_results():
+    for path in list(_owned_results):
+        release_shared_result(path)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def sweep_shared_memory() -> int:
+    """Remove the libro segments in shared memory whose owning process is
+    gone, returns how many were removed."""
+    directory = shared_memory_dir()
+    if directory is None:
+        return 0
+    removed = 0
+    for name in os.listdir(directory):
+        match = _SEGMENT_NAME.fullmatch(name)
+        if match is None or _process_alive(int(match.group(1))):
+            continue
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            continue
+        removed += 1
+    return removed
@@ -0,0 +1,128 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import nbformat
+import pytest
+from libro_flow import LibroNotebookClient
+
+
+@pytest.fixture(autouse=True, scope="session")
+def kernel_path():
+    # kernels and servers started by the tests import libro_flow from where
+    # the tests do, also when it is not installed
+    path = os.environ.get("PYTHONPATH")
+    os.environ["PYTHONPATH"] = os.pathsep.join(sys.path)
+    yield
+    if path is None:
+        del os.environ["PYTHONPATH"]
+    else:
+        os.environ["PYTHONPATH"] = path
+
+
+@pytest.fixture
+def make_notebook():
+    def make_notebook(*sources: str):
+        return nbformat.v4.new_notebook(
+            cells=[nbformat.v4.new_code_cell(source) for source in sources],
+            metadata={"kernelspec": {"name": "python3", "display_name": "Python 3"}},
+        )
+
+    return make_notebook
+
+
+@pytest.fixture
+def make_client(make_notebook):
+    def make_client(*sources: str, client_class=LibroNotebookClient, **kwargs):
+        # like create_notebook_client, every client gets its own execution
+        client = client_class(make_notebook(*sources), **kwargs)
+        client.update_execution()
+        return client
+
+    return make_client
+
+
+class JupyterServer:
+    """A jupyter server with libro_flow loaded, running in a subprocess."""
+
+    token = "libro-test"
+
+    def __init__(self, root_dir: str, setup: str = "", settings: dict | None = None):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        code = f"{setup}\nfrom jupyter_server.serverapp import ServerApp\nServerApp.launch_instance()"
+        argv = [
+            f"--IdentityProvider.token={self.token}",
+            f"--ServerApp.port={self.port}",
+            f"--ServerApp.root_dir={root_dir}",
+            "--ServerApp.allow_root=True",
+            "--ServerApp.open_browser=False",
+            "--ServerApp.disable_check_xsrf=True",
+            "--ServerApp.jpserver_extensions={'libro_flow': True}",
+            f"--ServerApp.tornado_settings={settings or {}!r}",
+        ]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.execution_url = f"{self.url}/jupyter-server/api/execution"
+        self.log = open(os.path.join(root_dir, "server.log"), "w")
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", code, *argv],
+            stdout=subprocess.DEVNULL,
+            stderr=self.log,
+        )
+        deadline = time.time() + 30
+        while True:
+            try:
+                self.request("GET", f"{self.url}/api/status")
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError("jupyter server did not start")
+                time.sleep(0.2)
+
+    def request(self, method: str, url: str, body=None):
+        request = urllib.request.Request(
+            url,
+            method=method,
+            data=json.dumps(body).encode() if body is not None else None,
+            headers={"Authorization": f"token {self.token}"},
+        )
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read() or b"{}")
+
+    def wait_for(self, id: str, timeout: float = 60) -> dict:
+        deadline = time.time() + timeout
+        while True:
+            status = self.request("GET", f"{self.execution_url}?id={id}")
+            if status["status"] in ("finished", "failed", "cancelled"):
+                return status
+            if time.time() > deadline:
+                raise TimeoutError(f"execution {id} is still {status['status']}")
+            time.sleep(0.2)
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.log.close()
+
+
+@pytest.fixture
+def jupyter_server(tmp_path):
+    servers = []
+
+    def jupyter_server(**kwargs) -> JupyterServer:
+        servers.append(JupyterServer(str(tmp_path), **kwargs))
+        return servers[-1]
+
+    yield jupyter_server
+    for server in servers:
+        server.stop()
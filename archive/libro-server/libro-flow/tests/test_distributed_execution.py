@@ -0,0 +1,44 @@
+import asyncio
+import nbformat
+from libro_flow import LibroFlowWorker, load_execution_result
+
+
+def test_worker_runs_job_of_coordinator(tmp_path, jupyter_server, make_notebook):
+    nb = make_notebook(
+        "from libro_flow import dump_execution_result\n"
+        "x = __libro_execute_args_dict__['x']\n"
+        "dump_execution_result({'x': x, 'pad': b'y' * 5000})"
+    )
+    nbformat.write(nb, str(tmp_path / "job.ipynb"))
+    server = jupyter_server(
+        setup=(
+            "from libro_flow import LibroJobQueue\n"
+            "from libro_flow.execution_handler import LibroExecutionBaseHandler\n"
+            "LibroExecutionBaseHandler.job_queue = LibroJobQueue()"
+        )
+    )
+    id = server.request("POST", server.execution_url, {"file": "job.ipynb", "args": {"x": 4}})["id"]
+    assert server.request("GET", f"{server.execution_url}?id={id}")["status"] == "queued"
+
+    async def work():
+        # small chunks, so the result is uploaded in several requests
+        worker = LibroFlowWorker(
+            server.execution_url,
+            token=server.token,
+            poll_wait=1,
+            heartbeat_interval=1,
+            upload_chunk_size=1000,
+        )
+        task = asyncio.ensure_future(worker.run())
+        try:
+            return await asyncio.to_thread(server.wait_for, id)
+        finally:
+            worker.stop()
+            await asyncio.wait_for(task, 30)
+
+    status = asyncio.run(work())
+    assert status["status"] == "finished", status["error"]
+    assert status["worker"]
+    result = load_execution_result(status["execute_result_path"])
+    assert result["x"] == 4
+    assert len(result["pad"]) == 5000
@@ -0,0 +1,55 @@
+import nbformat
+import pytest
+from libro_flow import LibroExecutionCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LibroExecutionCache(str(tmp_path / "cache"))
+
+
+def finished(client, output: str):
+    client.nb.cells[0].outputs = [
+        nbformat.v4.new_output("stream", name="stdout", text=output)
+    ]
+    client.execution.status = "finished"
+    return client
+
+
+def test_hit_and_invalidation(cache, make_client):
+    client = finished(make_client("print(1)", args={"x": 1}), "1\n")
+    key = cache.client_key(client)
+    cache.store(key, client)
+    again = make_client("print(1)", args={"x": 1})
+    assert cache.client_key(again) == key
+    assert cache.restore(key, again)
+    assert again.execution.status == "finished"
+    assert again.nb.cells[0].outputs[0].text == "1\n"
+    # other args or sources miss
+    assert cache.client_key(make_client("print(1)", args={"x": 2})) != key
+    assert cache.client_key(make_client("print(2)", args={"x": 1})) != key
+    assert cache.invalidate(key)
+    assert not cache.restore(key, make_client("print(1)", args={"x": 1}))
+
+
+def test_filtered_runs_get_their_own_entries(cache, make_client):
+    full = finished(make_client("print(1)"), "1\n")
+    headless = finished(make_client("print(1)", headless=True), "")
+    assert cache.client_key(full) != cache.client_key(headless)
+    cache.store(cache.client_key(full), full)
+    cache.store(cache.client_key(headless), headless)
+    assert cache.invalidate_notebook(full.nb, None, "python3")
+    assert cache.get(cache.client_key(full)) is None
+    assert cache.get(cache.client_key(headless)) is None
+
+
+def test_eviction_keeps_recent_entries(tmp_path, make_client):
+    cache = LibroExecutionCache(str(tmp_path / "cache"))
+    client = finished(make_client("print(1)"), "x" * 1000)
+    key = cache.client_key(client)
+    cache.store(key, client)
+    cache.max_size = cache.size() + 100
+    other = finished(make_client("print(2)"), "y" * 1000)
+    cache.store(cache.client_key(other), other)
+    assert cache.get(key) is None
+    assert cache.get(cache.client_key(other)) is not None
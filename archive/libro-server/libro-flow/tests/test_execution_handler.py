@@ -0,0 +1,19 @@
+import urllib.error
+import nbformat
+import pytest
+
+
+def test_full_queue_answers_429(tmp_path, jupyter_server, make_notebook):
+    nbformat.write(make_notebook("import time\ntime.sleep(1)"), str(tmp_path / "sleep.ipynb"))
+    server = jupyter_server(
+        settings={"libro_execution_max_workers": 1, "libro_execution_max_queue_size": 1}
+    )
+    ids = [
+        server.request("POST", server.execution_url, {"file": "sleep.ipynb"})["id"]
+        for _ in range(2)
+    ]
+    with pytest.raises(urllib.error.HTTPError) as e:
+        server.request("POST", server.execution_url, {"file": "sleep.ipynb"})
+    assert e.value.code == 429
+    for id in ids:
+        assert server.wait_for(id)["status"] == "finished"
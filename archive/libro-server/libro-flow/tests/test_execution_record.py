@@ -0,0 +1,45 @@
+import os
+import nbformat
+import pytest
+from libro_flow import ExecutionRecordJournal, read_execution_journal, read_execution_record
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_journal_compact_replay(tmp_path, make_notebook, compression):
+    record_path = str(tmp_path / "run.ipynb")
+    nb = make_notebook("a = 1", "print(a)")
+    journal = ExecutionRecordJournal(record_path, compression)
+    journal.start(nb)
+    cell = nbformat.v4.new_code_cell("print(a)", execution_count=2)
+    cell.outputs = [nbformat.v4.new_output("stream", name="stdout", text="1\n")]
+    journal.append_cell(1, cell)
+    journal.append_metadata({"libro_execute_end_time": "now"})
+    # a running record is read from its journal
+    replayed = read_execution_record(record_path)
+    assert replayed.cells[1].outputs[0].text == "1\n"
+    assert replayed.metadata["libro_execute_end_time"] == "now"
+    journal.compact()
+    assert not os.path.exists(journal.journal_path)
+    record = read_execution_record(record_path)
+    assert record.cells[1].execution_count == 2
+    assert record.cells[1].outputs[0].text == "1\n"
+    assert record.metadata["libro_execute_end_time"] == "now"
+    assert record.cells[0].source == "a = 1"
+
+
+def test_journal_ignores_partial_last_line(tmp_path, make_notebook):
+    record_path = str(tmp_path / "run.ipynb")
+    journal = ExecutionRecordJournal(record_path)
+    journal.start(make_notebook("a = 1"))
+    journal.write_lines(['{"type": "cell", "index": 0, "cel'])
+    journal.close()
+    assert read_execution_journal(journal.journal_path).cells[0].source == "a = 1"
+
+
+def test_compact_replaces_record_in_another_compression(tmp_path, make_notebook):
+    record_path = str(tmp_path / "run.ipynb")
+    ExecutionRecordJournal(record_path).compact(make_notebook("a = 1"))
+    journal = ExecutionRecordJournal(record_path, "gzip")
+    journal.compact(make_notebook("a = 2"))
+    assert not os.path.exists(record_path)
+    assert read_execution_record(record_path).cells[0].source == "a = 2"
@@ -0,0 +1,97 @@
+import os
+import pytest
+from libro_flow import LibroExecutionRegistry, LibroResultDescriptor
+from libro_flow import execution_registry
+from libro_flow.result_format import shared_memory_dir, shared_memory_name
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(execution_registry.time, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def finished(make_client):
+    def finished(result_path: str | None = None):
+        client = make_client("pass")
+        client.execution.status = "finished"
+        if result_path is not None:
+            client.execution.result_descriptor = LibroResultDescriptor(
+                path=result_path,
+                format="pickle5",
+                size=0,
+                shared_memory=os.path.basename(result_path),
+            )
+        return client
+
+    return finished
+
+
+def test_ttl_eviction(clock, finished):
+    registry = LibroExecutionRegistry(ttl=60)
+    old = finished()
+    registry.add(old, "old.ipynb")
+    id = str(old.execution.id)
+    assert registry.get(id=id).status == "finished"
+    clock.now += 30
+    registry.add(finished(), "new.ipynb")
+    assert registry.get(file="old.ipynb") is not None
+    clock.now += 61
+    # reads refresh the access time of new.ipynb only
+    registry.get(file="new.ipynb")
+    registry.evict()
+    assert registry.get(id=id) is None
+    assert registry.get(file="old.ipynb") is None
+    assert registry.get(file="new.ipynb") is not None
+
+
+def test_lru_eviction(clock, finished):
+    registry = LibroExecutionRegistry(max_entries=2)
+    first, second, third = finished(), finished(), finished()
+    registry.add(first, "first.ipynb")
+    clock.now += 1
+    registry.add(second, "second.ipynb")
+    clock.now += 1
+    registry.get(id=str(first.execution.id))
+    clock.now += 1
+    registry.add(third, "third.ipynb")
+    assert registry.get(id=str(second.execution.id)) is None
+    assert registry.get(id=str(first.execution.id)) is not None
+    assert registry.get(id=str(third.execution.id)) is not None
+
+
+def test_active_until_done(make_client):
+    registry = LibroExecutionRegistry()
+    client = make_client("pass")
+    registry.add(client, "run.ipynb")
+    id = str(client.execution.id)
+    assert registry.get_client(id) is client
+    client.execution.status = "finished"
+    client._run_done_callbacks()
+    assert registry.get_client(id) is None
+    assert registry.get(file="run.ipynb").status == "finished"
+
+
+@pytest.mark.skipif(shared_memory_dir() is None, reason="no shared memory")
+def test_shared_results_are_released(clock, finished):
+    paths = [os.path.join(shared_memory_dir(), shared_memory_name("result")) for _ in range(2)]
+    for path in paths:
+        open(path, "wb").close()
+    registry = LibroExecutionRegistry(ttl=60)
+    registry.add(finished(paths[0]), "evicted.ipynb")
+    clock.now += 61
+    registry.add(finished(paths[1]), "kept.ipynb")
+    assert not os.path.exists(paths[0])
+    assert os.path.exists(paths[1])
+    registry.close()
+    assert not os.path.exists(paths[1])
@@ -0,0 +1,112 @@
+import asyncio
+import pytest
+from libro_flow import ExecutionQueueFull, LibroExecutionScheduler, LibroNotebookClient
+
+
+class BlockingClient(LibroNotebookClient):
+    """Runs no kernel, each run waits for ``release`` and logs its name."""
+
+    def __init__(self, nb, name, log, release, **kwargs):
+        super().__init__(nb, **kwargs)
+        self.update_execution()
+        self.name = name
+        self.log_ = log
+        self.release = release
+
+    async def _async_execute_notebook(self, **kwargs):
+        self.log_.append(self.name)
+        await self.release.wait()
+        return self.nb
+
+
+def test_queue_full(make_notebook):
+    async def main():
+        scheduler = LibroExecutionScheduler(max_workers=1, max_queue_size=1)
+        release = asyncio.Event()
+        log = []
+        clients = [
+            BlockingClient(make_notebook("pass"), name, log, release)
+            for name in ("running", "queued", "rejected")
+        ]
+        scheduler.submit(clients[0])
+        await asyncio.sleep(0)
+        assert scheduler.running_count == 1
+        scheduler.submit(clients[1])
+        assert scheduler.full
+        with pytest.raises(ExecutionQueueFull):
+            scheduler.submit(clients[2])
+        release.set()
+        while scheduler.running_count or scheduler.queued_count:
+            await asyncio.sleep(0.01)
+        assert log == ["running", "queued"]
+        assert clients[1].execution.status == "finished"
+
+    asyncio.run(main())
+
+
+def test_priority_order(make_notebook):
+    async def main():
+        scheduler = LibroExecutionScheduler(max_workers=1)
+        release = asyncio.Event()
+        log = []
+
+        def submit(name, priority=0):
+            client = BlockingClient(make_notebook("pass"), name, log, release)
+            scheduler.submit(client, priority=priority)
+            return client
+
+        submit("first")
+        await asyncio.sleep(0)
+        submit("low", -1)
+        submit("normal-1")
+        submit("high", 5)
+        submit("normal-2")
+        release.set()
+        while scheduler.running_count or scheduler.queued_count:
+            await asyncio.sleep(0.01)
+        assert log == ["first", "high", "normal-1", "normal-2", "low"]
+
+    asyncio.run(main())
+
+
+def test_cancel_queued_and_running(make_notebook):
+    async def main():
+        scheduler = LibroExecutionScheduler(max_workers=1)
+        release = asyncio.Event()
+        log = []
+        running = BlockingClient(make_notebook("pass"), "running", log, release)
+        queued = BlockingClient(make_notebook("pass"), "queued", log, release)
+        scheduler.submit(running)
+        scheduler.submit(queued)
+        while not log:
+            await asyncio.sleep(0)
+        assert queued.execution.status == "queued"
+        await queued.async_cancel()
+        assert queued.execution.status == "cancelled"
+        await running.async_cancel()
+        assert running.execution.status == "cancelled"
+        while scheduler.running_count or scheduler.queued_count:
+            await asyncio.sleep(0.01)
+        # the cancelled client never started
+        assert log == ["running"]
+
+    asyncio.run(main())
+
+
+def test_hold_blocks_workers(make_notebook):
+    async def main():
+        scheduler = LibroExecutionScheduler(max_workers=2)
+        release = asyncio.Event()
+        log = []
+        async with scheduler.hold(5) as held:
+            assert held == 2
+            client = BlockingClient(make_notebook("pass"), "client", log, release)
+            scheduler.submit(client)
+            await asyncio.sleep(0.05)
+            assert log == []
+        release.set()
+        while scheduler.running_count or scheduler.queued_count:
+            await asyncio.sleep(0.01)
+        assert log == ["client"]
+
+    asyncio.run(main())
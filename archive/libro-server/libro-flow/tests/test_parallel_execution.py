@@ -0,0 +1,47 @@
+from libro_flow import CellDependencyGraph
+
+
+def test_independent_cells(make_notebook):
+    graph = CellDependencyGraph(make_notebook("a = 1", "b = 2", "c = a + b"))
+    assert graph.depends == {0: set(), 1: set(), 2: {0, 1}}
+    assert graph.sources[2] == {"a": 0, "b": 1}
+    assert graph.width() == 2
+    assert graph.readers(0) == 1
+
+
+def test_redefinition_waits_for_readers(make_notebook):
+    graph = CellDependencyGraph(make_notebook("a = 1", "print(a)", "a = 2"))
+    assert graph.depends[2] == {0, 1}
+
+
+def test_method_call_redefines_unless_imported(make_notebook):
+    graph = CellDependencyGraph(
+        make_notebook("import os", "items = []", "items.append(os.sep)", "print(items)")
+    )
+    assert graph.depends[2] == {0, 1}
+    assert graph.depends[3] == {2}
+    assert "os" not in graph.defines[2]
+
+
+def test_args_cells_are_barriers(make_notebook):
+    graph = CellDependencyGraph(
+        make_notebook("a = 1", "x = __libro_execute_args_dict__['x']", "b = 2")
+    )
+    assert graph.depends[1] == {0}
+    assert graph.depends[2] == {1}
+    assert graph.width() == 1
+
+
+def test_metadata_overrides(make_notebook):
+    nb = make_notebook("a = 1", "b = 2", "c = 3")
+    nb.cells[1].metadata["libro_uses"] = ["a"]
+    nb.cells[2].metadata["libro_depends_on"] = [nb.cells[1].id]
+    graph = CellDependencyGraph(nb)
+    assert graph.depends[1] == {0}
+    assert graph.depends[2] == {1}
+
+
+def test_unparsable_cell_is_a_barrier(make_notebook):
+    graph = CellDependencyGraph(make_notebook("a = 1", "%time b = a", "c = 3"))
+    assert graph.depends[1] == {0}
+    assert graph.depends[2] == {1}
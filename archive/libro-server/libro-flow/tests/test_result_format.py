@@ -0,0 +1,88 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from IPython.core.interactiveshell import InteractiveShell
+from libro_flow import dump_execution_result, load_execution_result
+from libro_flow.result_format import (
+    detect_result_format,
+    get_result_format,
+    select_result_format,
+    shared_memory_dir,
+    shared_memory_name,
+    sweep_shared_memory,
+)
+
+
+def test_pickle5_round_trip(tmp_path):
+    path = str(tmp_path / "result.pickle5")
+    result = {"array": np.arange(1000, dtype=np.float64), "name": "x"}
+    result_format = get_result_format("pickle5")
+    result_format.dump(result, path)
+    assert detect_result_format(path) is result_format
+    for mmap in (False, True):
+        loaded = result_format.load(path, mmap=mmap)
+        np.testing.assert_array_equal(loaded["array"], result["array"])
+        assert loaded["name"] == "x"
+    loaded = result_format.load(path)
+    # buffers are read into memory the result owns
+    assert loaded["array"].flags.writeable
+    loaded["array"][0] = 1.0
+
+
+def test_pickle5_loads_plain_pickle(tmp_path):
+    path = str(tmp_path / "result.pickle")
+    get_result_format("pickle").dump([1, 2], path)
+    assert get_result_format("pickle5").load(path) == [1, 2]
+
+
+def test_arrow_round_trip(tmp_path):
+    path = str(tmp_path / "result.arrow")
+    frame = pd.DataFrame({"a": [1, 2, 3], "b": ["x", "y", "z"]})
+    result_format = select_result_format(frame)
+    assert result_format.name == "arrow"
+    result_format.dump(frame, path)
+    assert detect_result_format(path) is result_format
+    pd.testing.assert_frame_equal(result_format.load(path), frame)
+    pd.testing.assert_frame_equal(result_format.load(path, mmap=True), frame)
+
+
+@pytest.fixture
+def shell():
+    shell = InteractiveShell.instance()
+    yield shell
+    for name in list(shell.user_ns):
+        if name.startswith("__libro_execute_"):
+            del shell.user_ns[name]
+
+
+def test_arrow_falls_back_to_pickle5(shell):
+    # pandas refuses to write duplicate column names as arrow
+    frame = pd.DataFrame([[1, 2]], columns=["a", "a"])
+    dump_execution_result(frame)
+    descriptor = shell.user_ns["__libro_execute_result_descriptor__"]
+    try:
+        assert descriptor["format"] == "pickle5"
+        pd.testing.assert_frame_equal(load_execution_result(descriptor["path"]), frame)
+    finally:
+        os.remove(descriptor["path"])
+
+
+@pytest.mark.skipif(shared_memory_dir() is None, reason="no shared memory")
+def test_sweep_removes_segments_of_exited_processes():
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    stale = os.path.join(shared_memory_dir(), shared_memory_name("result", process.pid))
+    live = os.path.join(shared_memory_dir(), shared_memory_name("args") + ".msgpack")
+    for path in (stale, live):
+        open(path, "w").close()
+    try:
+        assert sweep_shared_memory() >= 1
+        assert not os.path.exists(stale)
+        assert os.path.exists(live)
+    finally:
+        for path in (stale, live):
+            if os.path.exists(path):
+                os.remove(path)